@@ -1,11 +1,15 @@
 import argparse
+import copy
+import fcntl
 import math
 import os
 import random
 import shutil
+import sys
 import time
 import warnings
 import numpy as np
+import scipy.sparse as sp
 
 import torch
 import torch.nn as nn
@@ -14,21 +18,14 @@ import torch.backends.cudnn as cudnn
 import torch.optim
 import torch.utils.data
 import torch.utils.data.distributed
-import torchvision.models as models
 
 import pcl.loader
 import pcl.builder
+import pcl.cluster
+import pcl.embed
 
-from sklearn.cluster import KMeans
-
-import scanpy as sc
-import pandas as pd
-
-from metrics import compute_metrics
-
-model_names = sorted(name for name in models.__dict__
-    if name.islower() and not name.startswith("__")
-    and callable(models.__dict__[name]))
+# scanpy, pandas and sklearn are imported in main_worker, so that importing
+# this module (e.g. for its parser or helpers) stays fast
 
 parser = argparse.ArgumentParser(description='PyTorch scRNA-seq CLEAR Training')
 
@@ -39,6 +36,32 @@ parser.add_argument('--input_h5ad_path', type=str, default= "",
 parser.add_argument('--obs_label_colname', type=str, default= None,
                     help='column name of the label in obs')
 
+# raw input, preprocessed with preprocess/generate_h5ad.py through a cache of preprocessed files
+parser.add_argument('--input_10X_path', type=str, default=None,
+                    help='path to input 10X file, preprocessed through the cache')
+parser.add_argument('--count_csv_path', type=str, default=None,
+                    help='path to counts csv file, preprocessed through the cache')
+parser.add_argument('--label_csv_path', type=str, default=None,
+                    help='path to labels csv file of --count_csv_path')
+
+parser.add_argument('--filter', action="store_true",
+                    help='preprocess the input: filtering')
+parser.add_argument('--norm', action="store_true",
+                    help='preprocess the input: normalization')
+parser.add_argument("--log", action="store_true",
+                    help='preprocess the input: log operation')
+parser.add_argument("--scale", action="store_true",
+                    help='preprocess the input: scale operation')
+parser.add_argument("--defer_scale", action="store_true",
+                    help='with --scale, keep X sparse and scale the rows of each batch in the loader')
+parser.add_argument("--select_hvg", action="store_true",
+                    help="preprocess the input: select highly variable genes")
+
+parser.add_argument('--cache_dir', type=str, default="./data/cache",
+                    help='directory of the cache of preprocessed files')
+parser.add_argument('--cache_max_gb', type=float, default=50.0,
+                    help='size limit of the cache, least recently used files are evicted beyond it')
+
 # 2.hyper-parameters
 parser.add_argument('-j', '--workers', default=1, type=int, metavar='N',
                     help='number of data loading workers (default: 32)')
@@ -92,12 +115,37 @@ parser.add_argument("--aug_prob", type=float, default=0.5,
                     help="The prob of doing augmentation")
 
 # cluster
-parser.add_argument('--cluster_name', default='kmeans', type=str,
+parser.add_argument('--cluster_name', default='kmeans', type=str, choices=['kmeans', 'leiden', 'louvain'],
                     help='name of clustering method', dest="cluster_name")
 
+parser.add_argument('--resolution', default=[1.0], type=float, nargs='+',
+                    help='resolutions of leiden/louvain, the kNN graph is shared by all of them')
+
+parser.add_argument('--knn_k', default=15, type=int,
+                    help='number of neighbours of the kNN graph for leiden/louvain')
+
 parser.add_argument('--num_cluster', default=-1, type=int,
                     help='number of clusters', dest="num_cluster")
 
+# auto-tuning of batch size and data loading workers
+parser.add_argument('--auto_tune', action='store_true',
+                    help='time a few training steps to choose --batch_size and --workers before training')
+
+parser.add_argument('--tune_batch_sizes', default=[128, 256, 512, 1024, 2048], type=int, nargs='+',
+                    help='candidate batch sizes of --auto_tune (must divide --pcl_r)')
+
+parser.add_argument('--tune_workers', default=[0, 1, 2, 4, 8], type=int, nargs='+',
+                    help='candidate numbers of data loading workers of --auto_tune')
+
+parser.add_argument('--tune_steps', default=5, type=int,
+                    help='number of timed training steps per candidate')
+
+parser.add_argument('--tune_max_mem', default=0.9, type=float,
+                    help='maximum fraction of GPU memory a candidate may use')
+
+parser.add_argument('--eval_batch_size', default=-1, type=int,
+                    help='batch size of inference (default: 5 x batch size)')
+
 # random
 parser.add_argument('--seed', default=0, type=int,
                     help='seed for initializing training. ')
@@ -138,20 +186,31 @@ def main():
         warnings.warn('You have chosen a specific GPU. This will completely '
                       'disable data parallelism.')
 
+    resolve_input(args)
     main_worker(args)
 
 
-def main_worker(args):
-    print(args)
+def resolve_input(args):
+    """
+    With raw input (10X, csv) or preprocessing options, preprocess it through the cache
+    of preprocess/cache.py; args.input_h5ad_path is set to the cached preprocessed file.
+    """
+    do_preprocess = args.filter or args.norm or args.log or args.scale or args.select_hvg
+    if args.input_10X_path is None and args.count_csv_path is None and not do_preprocess:
+        return
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "preprocess"))
+    from cache import preprocess_cached
 
-    # 1. Build Dataloader
+    args.input_h5ad_path = preprocess_cached(
+        args.cache_dir, args.cache_max_gb,
+        input_h5ad_path=args.input_h5ad_path or None, input_10X_path=args.input_10X_path,
+        count_csv_path=args.count_csv_path, label_csv_path=args.label_csv_path,
+        do_filter=args.filter, do_log=args.log, do_norm=args.norm, do_select_hvg=args.select_hvg, do_scale=args.scale,
+        defer_scale=args.defer_scale,
+    )
 
-    # Load h5ad data
-    input_h5ad_path = args.input_h5ad_path
-    processed_adata = sc.read_h5ad(input_h5ad_path)
-    obs_label_colname = args.obs_label_colname
 
-    # find dataset name
+def get_dataset_name(input_h5ad_path):
     pre_path, filename = os.path.split(input_h5ad_path)
     dataset_name, ext = os.path.splitext(filename)
     # for batch effect dataset3
@@ -159,14 +218,11 @@ def main_worker(args):
         dataset_name = pre_path.split("/")[-1]
     if dataset_name == "":
         dataset_name = "unknown"
+    return dataset_name
 
-    # save path
-    save_path = os.path.join(args.save_dir, "CLEAR")
-    if os.path.exists(save_path) != True:
-        os.makedirs(save_path)
 
-    # Define Transformation
-    args_transformation = {
+def get_args_transformation(args):
+    return {
         # crop
         # without resize, it's better to remove crop
         
@@ -192,6 +248,39 @@ def main_worker(args):
         'apply_mutation_prob': args.aug_prob
     }
 
+
+def main_worker(args, adata=None):
+    # adata: an already loaded AnnData (e.g. shared by CLEAR_sweep.py); read from
+    # args.input_h5ad_path when None.
+    # returns the training metrics of the last epoch merged with the best eval metrics
+    from sklearn.cluster import KMeans
+    import scanpy as sc
+    import pandas as pd
+    from metrics import compute_metrics
+
+    print(args)
+
+    # 1. Build Dataloader
+
+    # Load h5ad data
+    input_h5ad_path = args.input_h5ad_path
+    if adata is None:
+        processed_adata = sc.read_h5ad(input_h5ad_path)
+    else:
+        processed_adata = adata
+    obs_label_colname = args.obs_label_colname
+
+    # find dataset name
+    dataset_name = get_dataset_name(input_h5ad_path)
+
+    # save path
+    save_path = os.path.join(args.save_dir, "CLEAR")
+    if os.path.exists(save_path) != True:
+        os.makedirs(save_path)
+
+    # Define Transformation
+    args_transformation = get_args_transformation(args)
+
     train_dataset = pcl.loader.scRNAMatrixInstance(
         adata=processed_adata,
         obs_label_colname=obs_label_colname,
@@ -208,17 +297,6 @@ def main_worker(args):
         args.batch_size = train_dataset.num_cells
         args.pcl_r = train_dataset.num_cells
 
-    train_sampler = None
-    eval_sampler = None
-    train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=args.batch_size, shuffle=(train_sampler is None),
-        num_workers=args.workers, pin_memory=True, sampler=train_sampler, drop_last=True)
-
-    # dataloader for center-cropped images, use larger batch size to increase speed
-    eval_loader = torch.utils.data.DataLoader(
-        eval_dataset, batch_size=args.batch_size * 5, shuffle=False,
-        sampler=eval_sampler, num_workers=args.workers, pin_memory=True)
-    
     # 2. Create Model
     print("=> creating model 'MLP'")
     model = pcl.builder.MoCo(
@@ -243,6 +321,19 @@ def main_worker(args):
                                 momentum=args.momentum,
                                 weight_decay=args.weight_decay)
 
+    # optionally time a few training steps to choose batch size and workers
+    if args.auto_tune:
+        autotune(train_dataset, model, criterion, optimizer, args,
+                 log_path=os.path.join(save_path, 'autotune_CLEAR_{}.txt'.format(dataset_name)))
+
+    train_sampler = None
+    train_loader = torch.utils.data.DataLoader(
+        train_dataset, batch_size=args.batch_size, shuffle=(train_sampler is None),
+        num_workers=args.workers, pin_memory=True, sampler=train_sampler, drop_last=True)
+
+    # inference uses larger batches to increase speed
+    eval_batch_size = args.eval_batch_size if args.eval_batch_size > 0 else args.batch_size * 5
+
     # optionally resume from a checkpoint
     if args.resume:
         if os.path.isfile(args.resume):
@@ -263,6 +354,9 @@ def main_worker(args):
 
     # 2. Train Encoder
     # train the model
+    best_eval_supervised_metrics = None
+    knn_graph = None
+    pd_label_colnames = [args.cluster_name]
     for epoch in range(args.start_epoch, args.epochs):
 
         adjust_learning_rate(optimizer, epoch, args)
@@ -282,7 +376,7 @@ def main_worker(args):
 
         # inference log & supervised metrics
         if epoch % args.eval_freq == 0 or epoch == args.epochs - 1:
-            embeddings, gt_labels = inference(eval_loader, model)
+            embeddings, gt_labels = inference(eval_dataset, model, eval_batch_size)
 
             # perform kmeans
             if args.cluster_name == "kmeans":
@@ -314,15 +408,69 @@ def main_worker(args):
                     else:
                         best_pd_labels = None
 
+            # the kNN graph of graph-based clustering is an exact search over all pairs of cells,
+            # so it is built at the final epoch only; earlier evaluations log kmeans metrics instead
+            elif args.cluster_name in ["leiden", "louvain"] and epoch < args.epochs - 1:
+                if train_dataset.label is not None:
+                    num_cluster = len(train_dataset.unique_label) if args.num_cluster == -1 else args.num_cluster
+                    pd_labels = KMeans(n_clusters=num_cluster, random_state=args.seed).fit(embeddings).labels_
+                    eval_kmeans_metrics = compute_metrics(gt_labels, pd_labels)
+                    print("Epoch: {}\t kmeans {}\n".format(epoch, eval_kmeans_metrics))
+
+                    with open(os.path.join(save_path, 'log_CLEAR_{}.txt'.format(dataset_name)), "a") as f:
+                        f.writelines("{}\teval_kmeans\t{}\n".format(epoch, eval_kmeans_metrics))
+
+            # perform graph-based clustering on a kNN graph of the embeddings
+            elif args.cluster_name in ["leiden", "louvain"]:
+                # build the graph once and reuse it for every resolution
+                knn_graph = pcl.cluster.knn_graph(embeddings, args.knn_k, n_jobs=max(args.workers, 1))
+                graph = pcl.cluster.graph_to_igraph(knn_graph)
+
+                best_ari, best_eval_supervised_metrics, best_pd_labels = -1, None, None
+                resolution_pd_labels = []
+                for resolution in args.resolution:
+                    pd_labels = pcl.cluster.graph_clustering(graph, args.cluster_name, resolution, seed=args.seed)
+                    print("resolution {}: {} clusters".format(resolution, len(np.unique(pd_labels))))
+                    resolution_pd_labels.append(pd_labels)
+
+                    # if gt_label exists, keep the resolution with the best ARI
+                    if train_dataset.label is not None:
+                        eval_supervised_metrics = compute_metrics(gt_labels, pd_labels)
+                        if eval_supervised_metrics["ARI"] > best_ari:
+                            best_ari = eval_supervised_metrics["ARI"]
+                            best_eval_supervised_metrics = eval_supervised_metrics
+                            best_pd_labels = pd_labels
+
+                if train_dataset.label is not None:
+                    print("Epoch: {}\t {}\n".format(epoch, best_eval_supervised_metrics))
+
+                    with open(os.path.join(save_path, 'log_CLEAR_{}.txt'.format(dataset_name)), "a") as f:
+                        f.writelines("{}\teval\t{}\n".format(epoch, best_eval_supervised_metrics))
+                else:
+                    # otherwise save the clustering of every resolution
+                    best_pd_labels = np.stack(resolution_pd_labels, axis=1)
+                    pd_label_colnames = ["{}_{}".format(args.cluster_name, r) for r in args.resolution]
+
 
     # 3. Final Savings
+    # save the model, used by pcl.embed to embed new cells
+    save_checkpoint({
+        'epoch': args.epochs,
+        'state_dict': model.state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'var_names': list(processed_adata.var_names),
+    }, False, filename=os.path.join(save_path, "checkpoint_CLEAR_{}.pth.tar".format(dataset_name)))
+
     # save feature & labels
     np.savetxt(os.path.join(save_path, "feature_CLEAR_{}.csv".format(dataset_name)), embeddings, delimiter=',')
 
     if best_pd_labels is not None:
-        pd_labels_df = pd.DataFrame(best_pd_labels, columns=['kmeans'])
+        pd_labels_df = pd.DataFrame(best_pd_labels, columns=pd_label_colnames)
         pd_labels_df.to_csv(os.path.join(save_path, "pd_label_CLEAR_{}.csv".format(dataset_name)))
 
+    if knn_graph is not None:
+        sp.save_npz(os.path.join(save_path, "knn_graph_CLEAR_{}.npz".format(dataset_name)), knn_graph)
+
     if train_dataset.label is not None:
         label_decoded = [train_dataset.label_decoder[i] for i in gt_labels]
         save_labels_df = pd.DataFrame(label_decoded, columns=['x'])
@@ -332,13 +480,16 @@ def main_worker(args):
             # write metrics into txt
             best_metrics = best_eval_supervised_metrics
             txt_path = os.path.join(save_path, "metric_CLEAR.txt")
-            f = open(txt_path, "a")
             record_string = dataset_name
             for key in best_metrics.keys():
                 record_string += " {}".format(best_metrics[key])
             record_string += "\n"
-            f.write(record_string)
-            f.close()
+            append_locked(txt_path, record_string)
+
+    results = dict(train_unsupervised_metrics)
+    if best_eval_supervised_metrics is not None:
+        results.update(best_eval_supervised_metrics)
+    return results
 
 
 def train(train_loader, model, criterion, optimizer, epoch, args):
@@ -391,27 +542,147 @@ def train(train_loader, model, criterion, optimizer, epoch, args):
 
     return unsupervised_metrics
             
-def inference(eval_loader, model):
+def autotune(train_dataset, model, criterion, optimizer, args, log_path=None):
+    """
+    Time a few training steps for every candidate (batch size, workers) and set the
+    fastest one into args.batch_size / args.workers.
+    Candidates must divide the queue size (--pcl_r), fit in the dataset and stay under
+    --tune_max_mem of the GPU memory, the inference pass at their eval batch size included
+    (--eval_batch_size, or 5 times the batch size). Batch sizes are tried in increasing order and
+    the search stops at the first one out of memory. Model and optimizer states, the random states
+    and the augmentation pool are restored afterwards, so training with the chosen -b/-j is the same
+    as a rerun with them.
+    """
+    model_state = copy.deepcopy(model.state_dict())
+    optimizer_state = copy.deepcopy(optimizer.state_dict())
+    # the shuffles and the worker seeds draw from the global generators
+    random_states = (random.getstate(), np.random.get_state(), torch.get_rng_state(),
+                     torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None)
+    # the crossover writes into the pool (in this process with 0 workers): tune on a copy-on-write
+    # pool over the (still untouched) training pool instead
+    pool = train_dataset.dataset_for_transform
+    if pool is not None and not isinstance(pool, pcl.loader.ScaledRows):
+        train_dataset.dataset_for_transform = pcl.loader.OverwrittenRows(
+            pool.rows if isinstance(pool, pcl.loader.OverwrittenRows) else pool)
+
+    batch_sizes = sorted(b for b in set(args.tune_batch_sizes)
+                         if b <= train_dataset.num_cells and args.pcl_r % b == 0)
+    if len(batch_sizes) == 0:
+        batch_sizes = [args.batch_size]
+    max_workers = os.cpu_count() or 1
+    workers = sorted(set(w for w in args.tune_workers if w <= max_workers)) or [args.workers]
+    total_memory = torch.cuda.get_device_properties(args.gpu).total_memory if torch.cuda.is_available() else None
+
+    records = []
+    out_of_memory = False
+    for batch_size in batch_sizes:
+        if out_of_memory:
+            # larger batch sizes would run out of memory as well
+            break
+        eval_batch_size = args.eval_batch_size if args.eval_batch_size > 0 else batch_size * 5
+        for num_workers in workers:
+            model.train()
+            loader = torch.utils.data.DataLoader(
+                train_dataset, batch_size=batch_size, shuffle=True,
+                num_workers=num_workers, pin_memory=True, drop_last=True)
+            if total_memory is not None:
+                torch.cuda.reset_peak_memory_stats(args.gpu)
+            try:
+                num_samples, elapsed = 0, 0.
+                for i, (images, index, label) in enumerate(loader):
+                    # the first step pays worker startup and cudnn autotuning, it is not timed
+                    if i == 1:
+                        if total_memory is not None:
+                            torch.cuda.synchronize(args.gpu)
+                        start = time.time()
+                    if i > args.tune_steps:
+                        break
+                    images[0] = images[0].cuda(args.gpu, non_blocking=True)
+                    images[1] = images[1].cuda(args.gpu, non_blocking=True)
+                    output, target, output_proto, target_proto = model(im_q=images[0], im_k=images[1])
+                    loss = criterion(output, target)
+                    optimizer.zero_grad()
+                    loss.backward()
+                    optimizer.step()
+                    if i >= 1:
+                        num_samples += batch_size
+                if total_memory is not None:
+                    torch.cuda.synchronize(args.gpu)
+                if num_samples > 0:
+                    elapsed = time.time() - start
+                # one block of the inference pass, for its peak memory
+                pcl.embed.embed_array(model.encoder_k, train_dataset.data[:eval_batch_size], eval_batch_size,
+                                      scaling=train_dataset.scaling)
+            except RuntimeError as e:
+                if "out of memory" not in str(e):
+                    raise
+                out_of_memory = True
+                optimizer.zero_grad(set_to_none=True)
+                torch.cuda.empty_cache()
+                print("=> auto-tune: batch size {} (eval batch size {}) is out of memory, "
+                      "larger batch sizes are skipped".format(batch_size, eval_batch_size))
+                break
+            finally:
+                del loader
+
+            peak = torch.cuda.max_memory_allocated(args.gpu) / total_memory if total_memory is not None else 0.
+            throughput = num_samples / elapsed if elapsed > 0 else 0.
+            records.append((batch_size, num_workers, throughput, peak))
+            print("=> auto-tune: batch size {}, workers {}: {:.1f} cells/s, peak memory {:.1%}"
+                  .format(batch_size, num_workers, throughput, peak))
+
+    model.load_state_dict(model_state)
+    optimizer.load_state_dict(optimizer_state)
+    train_dataset.dataset_for_transform = pool
+    random.setstate(random_states[0])
+    np.random.set_state(random_states[1])
+    torch.set_rng_state(random_states[2])
+    if random_states[3] is not None:
+        torch.cuda.set_rng_state_all(random_states[3])
+
+    allowed = [r for r in records if r[3] <= args.tune_max_mem and r[2] > 0]
+    if len(allowed) == 0:
+        print("=> auto-tune: no candidate fits, keep batch size {} and workers {}".format(args.batch_size, args.workers))
+        return
+    args.batch_size, args.workers, throughput, peak = max(allowed, key=lambda r: r[2])
+    print("=> auto-tune chose batch size {}, workers {} ({:.1f} cells/s); "
+          "rerun with -b {} -j {} to reproduce".format(args.batch_size, args.workers, throughput,
+                                                        args.batch_size, args.workers))
+
+    if log_path is not None:
+        with open(log_path, "w") as f:
+            f.writelines("batch_size\tworkers\tcells_per_s\tpeak_memory\n")
+            for record in records:
+                f.writelines("{}\t{}\t{:.1f}\t{:.4f}\n".format(*record))
+            f.writelines("chosen\t-b {} -j {}\n".format(args.batch_size, args.workers))
+
+
+def inference(eval_dataset, model, batch_size):
+    # slice the in-memory matrix directly instead of going through a DataLoader
     print('Inference...')
     model.eval()
-    features = []
-    labels = []
-
-    for i, (images, index, label) in enumerate(eval_loader):
-        images = images.cuda()
-        with torch.no_grad():
-            feat = model(images, is_eval=True) 
-        feat_pred = feat.data.cpu().numpy()
-        label_true = label
-        features.append(feat_pred)
-        labels.append(label_true)
-    
-    features = np.concatenate(features, axis=0)
-    labels = np.concatenate(labels, axis=0)
+    features = pcl.embed.embed_array(model.encoder_k, eval_dataset.data, batch_size, scaling=eval_dataset.scaling)
+
+    if eval_dataset.label is not None:
+        labels = np.fromiter((eval_dataset.label_encoder[l] for l in eval_dataset.label),
+                             dtype=np.int64, count=eval_dataset.num_cells)
+    else:
+        labels = np.full(eval_dataset.num_cells, -1, dtype=np.int64)
 
     return features, labels
 
 
+def append_locked(path, text):
+    """Append text to a file shared by concurrent runs, holding an exclusive lock while writing"""
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(text)
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
 def save_checkpoint(state, is_best, filename='checkpoint.pth.tar'):
     torch.save(state, filename)
     if is_best:
@@ -0,0 +1,236 @@
+import argparse
+import copy
+import csv
+import glob
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+parser = argparse.ArgumentParser(description='Run CLEAR on many h5ad files with a process pool. '
+                                             'Unknown arguments are forwarded to CLEAR.py for every dataset.')
+
+# datasets
+parser.add_argument('--input_dir', type=str, default=None,
+                    help='directory of h5ad files, every *.h5ad file is one dataset')
+parser.add_argument('--manifest', type=str, default=None,
+                    help='csv file with a column input_h5ad_path and optionally obs_label_colname')
+parser.add_argument('--obs_label_colname', type=str, default=None,
+                    help='column name of the label in obs, used when the manifest does not provide one')
+
+# scheduling
+parser.add_argument('--gpus', type=int, nargs='+', default=[0],
+                    help='GPU ids, each worker process is pinned to one of them')
+parser.add_argument('--max_parallel', type=int, default=1,
+                    help='maximum number of concurrent CLEAR runs')
+parser.add_argument('--force', action='store_true',
+                    help='rerun datasets whose outputs are up to date')
+
+# savings
+parser.add_argument('--save_dir', default='./result', type=str,
+                    help='result saving directory')
+parser.add_argument('--store', default=None, type=str,
+                    help='sqlite results store (default: save_dir/CLEAR/results_CLEAR.sqlite)')
+
+
+class ResultStore(object):
+    """
+    Results of CLEAR runs in a sqlite database, one row per (dataset file, configuration).
+    sqlite serializes the writers, so several batch runners can share one store.
+    """
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS runs ("
+                         "input_path TEXT, config TEXT, dataset TEXT, "
+                         "input_size INTEGER, input_mtime REAL, status TEXT, "
+                         "metrics TEXT, error TEXT, duration REAL, finished REAL, "
+                         "PRIMARY KEY (input_path, config))")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def get(self, input_path, config):
+        with self._connect() as conn:
+            row = conn.execute("SELECT input_size, input_mtime, status FROM runs WHERE input_path=? AND config=?",
+                               (input_path, config)).fetchone()
+        return row
+
+    def put(self, input_path, config, dataset, status, metrics=None, error=None, duration=None):
+        stat = os.stat(input_path)
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (input_path, config, dataset, stat.st_size, stat.st_mtime, status,
+                          json.dumps(metrics) if metrics is not None else None, error, duration, time.time()))
+
+    def export_csv(self, csv_path):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT dataset, input_path, config, metrics FROM runs "
+                                "WHERE status='done' ORDER BY dataset").fetchall()
+        keys = []
+        records = []
+        for dataset, input_path, config, metrics in rows:
+            metrics = json.loads(metrics)
+            keys += [key for key in metrics if key not in keys]
+            records.append([dataset, input_path, config, metrics])
+
+        # write to a temporary file first so readers never see a partial table
+        tmp_path = csv_path + ".tmp"
+        with open(tmp_path, "w", newline="") as f:
+            csv_writer = csv.writer(f)
+            csv_writer.writerow(["dataset", "input_path", "config"] + keys)
+            for dataset, input_path, config, metrics in records:
+                csv_writer.writerow([dataset, input_path, config] + [metrics.get(key, "") for key in keys])
+        os.replace(tmp_path, csv_path)
+
+
+def config_hash(args):
+    # hash of the CLEAR arguments that change the result
+    ignored = {"input_h5ad_path", "gpu", "save_dir", "exp_dir", "workers", "log_freq", "cache_dir", "cache_max_gb"}
+    config = {k: v for k, v in sorted(vars(args).items()) if k not in ignored}
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:12]
+
+
+def list_datasets(batch_args):
+    datasets = []
+    if batch_args.manifest is not None:
+        with open(batch_args.manifest, newline="") as f:
+            for row in csv.DictReader(f):
+                label_colname = row.get("obs_label_colname") or batch_args.obs_label_colname
+                datasets.append((row["input_h5ad_path"], label_colname))
+    if batch_args.input_dir is not None:
+        for path in sorted(glob.glob(os.path.join(batch_args.input_dir, "*.h5ad"))):
+            datasets.append((path, batch_args.obs_label_colname))
+    if len(datasets) == 0:
+        raise Exception("No dataset found, please specify --input_dir or --manifest")
+    return datasets
+
+
+def run_dir(save_dir, args, config):
+    """
+    Own output directory of a (dataset file, configuration) run: save_dir/CLEAR/<dataset>_<hash>,
+    where the hash covers the input path and the configuration, so runs of files with the same
+    name or of other configurations never share their outputs.
+    """
+    import CLEAR
+
+    run_hash = hashlib.sha1(json.dumps([args.input_h5ad_path, config]).encode()).hexdigest()[:8]
+    return os.path.join(save_dir, "CLEAR", "{}_{}".format(CLEAR.get_dataset_name(args.input_h5ad_path), run_hash))
+
+
+def output_dataset_name(args):
+    # name of the outputs of main_worker, which reads the preprocessed file when resolve_input preprocesses
+    import CLEAR
+
+    dataset_name = CLEAR.get_dataset_name(args.input_h5ad_path)
+    if args.filter or args.norm or args.log or args.scale or args.select_hvg:
+        dataset_name += "_preprocessed"
+    return dataset_name
+
+
+def is_up_to_date(store, args, config):
+    row = store.get(args.input_h5ad_path, config)
+    if row is None:
+        return False
+    input_size, input_mtime, status = row
+    stat = os.stat(args.input_h5ad_path)
+    if status != "done" or stat.st_size != input_size or stat.st_mtime != input_mtime:
+        return False
+    # outputs of this run only, main_worker writes them into args.save_dir/CLEAR
+    feature_path = os.path.join(args.save_dir, "CLEAR", "feature_CLEAR_{}.csv".format(output_dataset_name(args)))
+    return os.path.exists(feature_path) and os.path.getmtime(feature_path) >= stat.st_mtime
+
+
+# GPU id of this worker process
+_gpu = None
+
+
+def _worker_init(gpu_queue):
+    global _gpu
+    _gpu = gpu_queue.get()
+
+
+def _run_dataset(args):
+    import torch
+    import CLEAR
+
+    args.gpu = _gpu
+    if args.seed is not None:
+        random.seed(args.seed)
+        torch.manual_seed(args.seed)
+        torch.backends.cudnn.deterministic = True
+
+    start = time.time()
+    try:
+        # preprocessing options (--filter, --norm, ...) go through the cache, as in CLEAR.py
+        CLEAR.resolve_input(args)
+        return CLEAR.main_worker(args), None, time.time() - start
+    except Exception:
+        return None, traceback.format_exc(), time.time() - start
+
+
+def main():
+    batch_args, clear_argv = parser.parse_known_args()
+
+    import CLEAR
+
+    base_args = CLEAR.parser.parse_args(clear_argv)
+    base_args.save_dir = batch_args.save_dir
+    if base_args.input_10X_path is not None or base_args.count_csv_path is not None:
+        parser.error("--input_10X_path and --count_csv_path are not supported, "
+                     "the datasets are the h5ad files of --input_dir or --manifest")
+
+    save_path = os.path.join(batch_args.save_dir, "CLEAR")
+    if os.path.exists(save_path) != True:
+        os.makedirs(save_path)
+    store_path = batch_args.store or os.path.join(save_path, "results_CLEAR.sqlite")
+    store = ResultStore(store_path)
+
+    # 1. collect the datasets to run
+    jobs = []
+    for input_path, label_colname in list_datasets(batch_args):
+        args = copy.deepcopy(base_args)
+        args.input_h5ad_path = os.path.abspath(input_path)
+        args.obs_label_colname = label_colname
+        config = config_hash(args)
+        args.save_dir = run_dir(batch_args.save_dir, args, config)
+        if not batch_args.force and is_up_to_date(store, args, config):
+            print("=> skip {}, outputs are up to date".format(input_path))
+            continue
+        jobs.append((args, config))
+    print("=> {} datasets to run".format(len(jobs)))
+
+    # 2. run them, each worker process owns one GPU
+    ctx = get_context("spawn")
+    gpu_queue = ctx.Queue()
+    for i in range(batch_args.max_parallel):
+        gpu_queue.put(batch_args.gpus[i % len(batch_args.gpus)])
+
+    with ProcessPoolExecutor(max_workers=batch_args.max_parallel, mp_context=ctx,
+                             initializer=_worker_init, initargs=(gpu_queue,)) as executor:
+        futures = {executor.submit(_run_dataset, args): (args, config) for args, config in jobs}
+        for future in as_completed(futures):
+            args, config = futures[future]
+            metrics, error, duration = future.result()
+            dataset_name = CLEAR.get_dataset_name(args.input_h5ad_path)
+            if error is None:
+                store.put(args.input_h5ad_path, config, dataset_name, "done", metrics=metrics, duration=duration)
+                print("=> {} finished in {:.1f}s: {}, outputs in {}".format(dataset_name, duration, metrics,
+                                                                            args.save_dir))
+            else:
+                store.put(args.input_h5ad_path, config, dataset_name, "failed", error=error, duration=duration)
+                print("=> {} failed:\n{}".format(dataset_name, error))
+
+    # 3. aggregated table of all finished runs in the store
+    csv_path = os.path.join(save_path, "metrics_CLEAR.csv")
+    store.export_csv(csv_path)
+    print("Aggregated results saved to {}".format(csv_path))
+
+
+if __name__ == '__main__':
+    main()
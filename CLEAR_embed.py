@@ -0,0 +1,33 @@
+# Slim entry point to embed cells with a trained CLEAR model.
+# Only torch, h5py and numpy are imported: no scanpy/anndata/pandas/sklearn,
+# the h5ad file is streamed block by block with h5py.
+import argparse
+
+parser = argparse.ArgumentParser(description='Embed the cells of an h5ad file with a trained CLEAR model')
+
+parser.add_argument('--checkpoint', type=str, required=True,
+                    help='CLEAR checkpoint (checkpoint_CLEAR_{dataset}.pth.tar) or int8 artifact with --quantized')
+parser.add_argument('--input_h5ad_path', type=str, required=True,
+                    help='path to input h5ad file')
+parser.add_argument('--output', type=str, required=True,
+                    help='output .npy file of the embeddings (written as a memory-mapped array)')
+parser.add_argument('--chunk_size', default=8192, type=int,
+                    help='number of cells read and embedded at once')
+parser.add_argument('--device', default=None, type=str,
+                    help='torch device (default: cuda if available)')
+parser.add_argument('--quantized', action='store_true',
+                    help='the checkpoint is an int8 encoder saved by CLEAR_quantize.py')
+
+
+def main():
+    args = parser.parse_args()
+
+    from pcl.embed import embed_to_memmap
+
+    embeddings = embed_to_memmap(args.checkpoint, args.input_h5ad_path, args.output,
+                                 chunk_size=args.chunk_size, device=args.device, quantized=args.quantized)
+    print("Saved embeddings of shape {} to {}".format(embeddings.shape, args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+import argparse
+import os
+import random
+
+import numpy as np
+import scipy.sparse as sp
+import torch
+import torch.nn as nn
+import torch.backends.cudnn as cudnn
+
+import pcl.builder
+import pcl.embed
+import pcl.loader
+
+parser = argparse.ArgumentParser(description='Incremental fine-tuning of a trained CLEAR model on appended cells. '
+                                             'Unknown arguments (e.g. --lr, --batch_size, --aug_prob, --gpu) '
+                                             'are forwarded to CLEAR.py.')
+
+parser.add_argument('--checkpoint', type=str, required=True,
+                    help='CLEAR checkpoint of the reference (model and queue)')
+parser.add_argument('--reference_h5ad_path', type=str, required=True,
+                    help='h5ad file of the reference cells the checkpoint was trained on')
+parser.add_argument('--input_h5ad_path', type=str, required=True,
+                    help='h5ad file of the new cells')
+parser.add_argument('--obs_label_colname', type=str, default=None,
+                    help='column name of the label in obs')
+
+parser.add_argument('--reference_feature_path', type=str, default=None,
+                    help='saved embeddings of the reference (feature_CLEAR_*.csv); recomputed when not given')
+parser.add_argument('--reference_pd_label_path', type=str, default=None,
+                    help='saved cluster assignments of the reference (pd_label_CLEAR_*.csv); '
+                         'KMeans with --num_cluster when not given')
+
+parser.add_argument('--incremental_epochs', default=5, type=int,
+                    help='number of fine-tuning epochs')
+parser.add_argument('--replay_ratio', default=1.0, type=float,
+                    help='number of replayed reference cells per new cell')
+parser.add_argument('--drift_threshold', default=0.05, type=float,
+                    help='reference cells whose embedding moved by more than this cosine distance are updated')
+
+
+def scaled_X(adata, rows=None, block_size=8192):
+    """
+    adata.X (or some of its rows) as CSR, or with its deferred scaling (pcl.loader.get_scaling)
+    as a dense float32 array scaled row block by row block
+    """
+    scaling = pcl.loader.get_scaling(adata)
+    X = sp.csr_matrix(adata.X, dtype=np.float32 if scaling is None else None)
+    if rows is not None:
+        X = X[rows]
+    if scaling is None:
+        return X
+    out = np.empty(X.shape, dtype=np.float32)
+    for start in range(0, X.shape[0], block_size):
+        out[start:start + block_size] = pcl.loader.apply_scaling(X[start:start + block_size], scaling)
+    return out
+
+
+def align_genes(adata, var_names):
+    """X of adata with its columns in the order of var_names, genes missing in adata are zero"""
+    position = {name: i for i, name in enumerate(var_names)}
+    columns = np.array([position.get(name, -1) for name in adata.var_names])
+    found = columns >= 0
+    print("{} of {} reference genes found in the new cells".format(found.sum(), len(var_names)))
+    X = scaled_X(adata)[:, np.where(found)[0]]
+    # permutation/padding matrix from the found genes to the reference genes
+    P = sp.csr_matrix((np.ones(found.sum(), dtype=np.float32), (np.arange(found.sum()), columns[found])),
+                      shape=(found.sum(), len(var_names)))
+    return (X @ P).astype(np.float32)
+
+
+def cluster_centroids(embeddings, labels):
+    clusters = np.unique(labels)
+    centroids = np.stack([embeddings[labels == c].mean(0) for c in clusters])
+    centroids /= np.linalg.norm(centroids, axis=1, keepdims=True) + 1e-12
+    return clusters, centroids
+
+
+def main():
+    inc_args, clear_argv = parser.parse_known_args()
+
+    import anndata
+    import pandas as pd
+    import scanpy as sc
+    from sklearn.cluster import KMeans
+    import CLEAR
+
+    args = CLEAR.parser.parse_args(clear_argv)
+    args.input_h5ad_path = inc_args.input_h5ad_path
+    args.obs_label_colname = inc_args.obs_label_colname
+    if args.seed is not None:
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+        torch.manual_seed(args.seed)
+
+    reference_name = CLEAR.get_dataset_name(inc_args.reference_h5ad_path)
+    save_path = os.path.join(args.save_dir, "CLEAR")
+    if os.path.exists(save_path) != True:
+        os.makedirs(save_path)
+    output_name = "{}_incremental".format(reference_name)
+
+    # 1. load the reference model, including its queue of negative keys
+    checkpoint = torch.load(inc_args.checkpoint, map_location="cpu")
+    state_dict = checkpoint["state_dict"]
+    num_genes = state_dict["encoder_k.encoder.0.0.weight"].shape[1]
+    args.low_dim, args.pcl_r = state_dict["queue"].shape
+
+    model = pcl.builder.MoCo(pcl.builder.MLPEncoder, int(num_genes),
+                             args.low_dim, args.pcl_r, args.moco_m, args.temperature)
+    model.load_state_dict(state_dict)
+
+    cudnn.benchmark = True
+    torch.cuda.set_device(args.gpu)
+    model = model.cuda(args.gpu)
+
+    criterion = nn.CrossEntropyLoss()
+    optimizer = torch.optim.SGD(model.parameters(), args.lr,
+                                momentum=args.momentum,
+                                weight_decay=args.weight_decay)
+    if "optimizer" in checkpoint:
+        optimizer.load_state_dict(checkpoint["optimizer"])
+    # fine-tuning uses a constant learning rate
+    for param_group in optimizer.param_groups:
+        param_group['lr'] = args.lr
+
+    # 2. reference and new cells, in the gene order of the reference
+    reference_adata = sc.read_h5ad(inc_args.reference_h5ad_path)
+    var_names = list(checkpoint.get("var_names", reference_adata.var_names))
+    if list(reference_adata.var_names) != var_names:
+        raise Exception("Genes of the reference do not match the genes of the checkpoint")
+    # the reference stays as stored, a deferred scaling is applied block by block when embedding it
+    reference_scaling = pcl.loader.get_scaling(reference_adata)
+    reference_X = scaled_X(reference_adata) if reference_scaling is None else sp.csr_matrix(reference_adata.X)
+    new_adata = sc.read_h5ad(inc_args.input_h5ad_path)
+    new_X = align_genes(new_adata, var_names)
+
+    if inc_args.reference_feature_path is not None:
+        old_embeddings = np.loadtxt(inc_args.reference_feature_path, delimiter=',', dtype=np.float32)
+    else:
+        old_embeddings = pcl.embed.embed_array(model.encoder_k, reference_X, args.batch_size * 5,
+                                               scaling=reference_scaling)
+
+    # 3. fine-tune on the new cells mixed with a replay sample of the reference
+    num_replay = min(int(new_X.shape[0] * inc_args.replay_ratio), reference_X.shape[0])
+    replay = np.sort(np.random.choice(reference_X.shape[0], num_replay, replace=False))
+    parts = [new_X, scaled_X(reference_adata, rows=replay)]
+    if any(isinstance(part, np.ndarray) for part in parts):
+        train_X = np.vstack([part.toarray() if sp.issparse(part) else part for part in parts])
+    else:
+        train_X = sp.vstack(parts).tocsr()
+    print("=> fine-tuning on {} new and {} replayed cells".format(new_X.shape[0], num_replay))
+
+    train_dataset = pcl.loader.scRNAMatrixInstance(
+        adata=anndata.AnnData(X=train_X),
+        obs_label_colname=None,
+        transform=True,
+        args_transformation=CLEAR.get_args_transformation(args)
+        )
+    # the batch size has to divide the queue size of the checkpoint
+    batch_size = min(args.batch_size, train_dataset.num_cells)
+    while args.pcl_r % batch_size != 0:
+        batch_size -= 1
+    train_loader = torch.utils.data.DataLoader(
+        train_dataset, batch_size=batch_size, shuffle=True,
+        num_workers=args.workers, pin_memory=True, drop_last=True)
+
+    for epoch in range(inc_args.incremental_epochs):
+        CLEAR.train(train_loader, model, criterion, optimizer, epoch, args)
+
+    # 4. drift of the reference embeddings, only the cells that moved are updated
+    new_reference_embeddings = pcl.embed.embed_array(model.encoder_k, reference_X, args.batch_size * 5,
+                                                     scaling=reference_scaling)
+    drift = 1 - (old_embeddings * new_reference_embeddings).sum(1)
+    affected = drift > inc_args.drift_threshold
+    reference_embeddings = old_embeddings.copy()
+    reference_embeddings[affected] = new_reference_embeddings[affected]
+    new_embeddings = pcl.embed.embed_array(model.encoder_k, new_X, args.batch_size * 5)
+
+    drift_report = {
+        "mean_drift": float(drift.mean()),
+        "median_drift": float(np.median(drift)),
+        "p95_drift": float(np.percentile(drift, 95)),
+        "max_drift": float(drift.max()),
+        "updated_reference_cells": int(affected.sum()),
+        "updated_fraction": float(affected.mean()),
+    }
+    for key, value in drift_report.items():
+        print("{}\t{}".format(key, value))
+
+    # 5. cluster assignments: unaffected reference cells keep theirs,
+    # the others go to the nearest centroid of the reference clusters
+    if inc_args.reference_pd_label_path is not None:
+        old_labels = pd.read_csv(inc_args.reference_pd_label_path, index_col=0).iloc[:, 0].values
+    else:
+        num_cluster = args.num_cluster
+        if num_cluster <= 0 and args.obs_label_colname in reference_adata.obs:
+            num_cluster = reference_adata.obs[args.obs_label_colname].nunique()
+        if num_cluster <= 0:
+            raise Exception("Please give --reference_pd_label_path or --num_cluster")
+        old_labels = KMeans(n_clusters=num_cluster, random_state=args.seed).fit(old_embeddings).labels_
+
+    clusters, centroids = cluster_centroids(reference_embeddings, old_labels)
+    reference_labels = old_labels.copy()
+    reference_labels[affected] = clusters[np.argmax(reference_embeddings[affected] @ centroids.T, axis=1)]
+    new_labels = clusters[np.argmax(new_embeddings @ centroids.T, axis=1)]
+    drift_report["reassigned_reference_cells"] = int((reference_labels != old_labels).sum())
+
+    # 6. savings: reference rows first, then the new cells
+    embeddings = np.concatenate([reference_embeddings, new_embeddings], axis=0)
+    pd_labels = np.concatenate([reference_labels, new_labels], axis=0)
+    np.savetxt(os.path.join(save_path, "feature_CLEAR_{}.csv".format(output_name)), embeddings, delimiter=',')
+    pd.DataFrame(pd_labels, columns=['kmeans']).to_csv(
+        os.path.join(save_path, "pd_label_CLEAR_{}.csv".format(output_name)))
+
+    if args.obs_label_colname in reference_adata.obs and args.obs_label_colname in new_adata.obs:
+        from metrics import compute_metrics
+        gt_labels = np.concatenate([reference_adata.obs[args.obs_label_colname].astype(str).values,
+                                    new_adata.obs[args.obs_label_colname].astype(str).values])
+        drift_report.update(compute_metrics(gt_labels, pd_labels))
+
+    with open(os.path.join(save_path, "drift_CLEAR_{}.txt".format(output_name)), "w") as f:
+        for key, value in drift_report.items():
+            f.writelines("{}\t{}\n".format(key, value))
+
+    CLEAR.save_checkpoint({
+        'epoch': checkpoint.get('epoch', 0) + inc_args.incremental_epochs,
+        'state_dict': model.state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'var_names': var_names,
+    }, False, filename=os.path.join(save_path, "checkpoint_CLEAR_{}.pth.tar".format(output_name)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+
+import pcl.embed
+import pcl.loader
+import pcl.quantize
+
+parser = argparse.ArgumentParser(description='Int8 dynamic quantization of a trained CLEAR encoder for CPU inference')
+
+parser.add_argument('--checkpoint', type=str, required=True,
+                    help='path to a CLEAR checkpoint (checkpoint_CLEAR_{dataset}.pth.tar)')
+parser.add_argument('--input_h5ad_path', type=str, required=True,
+                    help='held-out h5ad file used to check the accuracy of the quantized encoder')
+parser.add_argument('--obs_label_colname', type=str, default=None,
+                    help='column name of the label in obs')
+parser.add_argument('--num_cluster', default=-1, type=int,
+                    help='number of KMeans clusters (default: number of labels)')
+parser.add_argument('--batch_size', default=8192, type=int,
+                    help='inference batch size')
+parser.add_argument('--threads', default=None, type=int,
+                    help='number of CPU threads of torch')
+parser.add_argument('--seed', default=0, type=int,
+                    help='seed of KMeans')
+parser.add_argument('--save_path', type=str, default=None,
+                    help='path of the quantized artifact (default: next to the checkpoint, *_int8.pt)')
+
+
+def timed_embedding(encoder, X, batch_size, scaling=None, repeats=3):
+    # best of a few runs, the first one also warms up the kernels
+    best = np.inf
+    for _ in range(repeats):
+        start = time.time()
+        embeddings = pcl.embed.embed_array(encoder, X, batch_size, device="cpu", scaling=scaling)
+        best = min(best, time.time() - start)
+    return embeddings, best
+
+
+def main():
+    args = parser.parse_args()
+
+    import scanpy as sc
+    from sklearn.cluster import KMeans
+    from metrics import compute_metrics
+    import CLEAR
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    # 1. quantize and serialize
+    encoder, var_names = pcl.embed.load_encoder(args.checkpoint, device="cpu")
+    num_genes = encoder.encoder[0][0].in_features
+    save_path = args.save_path
+    if save_path is None:
+        save_path = args.checkpoint.replace(".pth.tar", "") + "_int8.pt"
+    pcl.quantize.save_quantized_encoder(pcl.quantize.quantize_encoder(encoder), save_path, num_genes, var_names)
+    qencoder, _ = pcl.quantize.load_quantized_encoder(save_path)
+    print("Saved quantized encoder: {} ({:.1f} MB, float checkpoint {:.1f} MB)".format(
+        save_path, os.path.getsize(save_path) / 2**20, os.path.getsize(args.checkpoint) / 2**20))
+
+    # 2. embed the held-out data with both encoders
+    adata = sc.read_h5ad(args.input_h5ad_path)
+    if var_names is not None and list(adata.var_names) != list(var_names):
+        raise Exception("Genes of {} do not match the genes of the checkpoint".format(args.input_h5ad_path))
+    X = adata.X
+    scaling = pcl.loader.get_scaling(adata)
+
+    float_embeddings, float_time = timed_embedding(encoder, X, args.batch_size, scaling)
+    int8_embeddings, int8_time = timed_embedding(qencoder, X, args.batch_size, scaling)
+    cosine = (float_embeddings * int8_embeddings).sum(1)
+
+    report = {
+        "float_time": float_time,
+        "int8_time": int8_time,
+        "speedup": float_time / int8_time,
+        "mean_cosine": float(cosine.mean()),
+        "min_cosine": float(cosine.min()),
+    }
+
+    # 3. clustering accuracy of both embeddings against the labels
+    if args.obs_label_colname is not None and args.obs_label_colname in adata.obs:
+        gt_labels = adata.obs[args.obs_label_colname].values
+        num_cluster = len(np.unique(gt_labels)) if args.num_cluster == -1 else args.num_cluster
+        for name, embeddings in [("float", float_embeddings), ("int8", int8_embeddings)]:
+            pd_labels = KMeans(n_clusters=num_cluster, random_state=args.seed).fit(embeddings).labels_
+            for key, value in compute_metrics(gt_labels, pd_labels).items():
+                report["{}_{}".format(name, key)] = value
+
+    for key, value in report.items():
+        print("{}\t{}".format(key, value))
+
+    dataset_name = CLEAR.get_dataset_name(args.input_h5ad_path)
+    report_path = os.path.join(os.path.dirname(save_path), "quantize_CLEAR_{}.txt".format(dataset_name))
+    with open(report_path, "w") as f:
+        for key, value in report.items():
+            f.writelines("{}\t{}\n".format(key, value))
+
+
+if __name__ == '__main__':
+    main()
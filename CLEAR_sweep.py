@@ -0,0 +1,192 @@
+import argparse
+import copy
+import itertools
+import os
+import random
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context, shared_memory
+
+import numpy as np
+import pandas as pd
+
+parser = argparse.ArgumentParser(description='Hyper-parameter sweep for CLEAR on one shared dataset. '
+                                             'Unknown arguments are forwarded to CLEAR.py for every trial.')
+
+parser.add_argument('--input_h5ad_path', type=str, default="",
+                    help='path to input h5ad file (loaded once for all trials); raw input (--input_10X_path, '
+                         '--count_csv_path) and preprocessing options are resolved once through the cache')
+parser.add_argument('--obs_label_colname', type=str, default=None,
+                    help='column name of the label in obs')
+
+# search space, every combination is one trial
+parser.add_argument('--aug_prob', type=float, nargs='+', default=[0.5],
+                    help='values of --aug_prob to try')
+parser.add_argument('--temperature', type=float, nargs='+', default=[0.2],
+                    help='values of --temperature to try')
+parser.add_argument('--pcl_r', type=int, nargs='+', default=[1024],
+                    help='values of --pcl_r to try')
+parser.add_argument('--lr', type=float, nargs='+', default=[5e-3],
+                    help='values of --lr to try')
+parser.add_argument('--low_dim', type=int, nargs='+', default=[128],
+                    help='values of --low_dim to try')
+parser.add_argument('--repeats', type=int, default=1,
+                    help='number of seeds per configuration')
+parser.add_argument('--seed', type=int, default=0,
+                    help='seed of the first trial, trial i uses seed + i')
+
+# scheduling
+parser.add_argument('--gpus', type=int, nargs='+', default=[0],
+                    help='GPU ids, trials are assigned round-robin')
+parser.add_argument('--max_parallel', type=int, default=1,
+                    help='number of trials running concurrently (1 = back-to-back in one worker)')
+
+parser.add_argument('--save_dir', default='./result', type=str,
+                    help='result saving directory')
+
+SWEEP_PARAMS = ['aug_prob', 'temperature', 'pcl_r', 'lr', 'low_dim']
+
+
+def share_adata(adata, obs_label_colname=None):
+    """
+    Densify adata.X once into a shared memory block, deferred scaling (if any) applied.
+    Returns the block (keep a reference alive in the parent) and a picklable handle for the workers.
+    """
+    from pcl.loader import apply_scaling, get_scaling
+    scaling = get_scaling(adata)
+    if scaling is not None:
+        X = apply_scaling(adata.X, scaling)
+    else:
+        X = adata.X if isinstance(adata.X, np.ndarray) else adata.X.toarray()
+    shm = shared_memory.SharedMemory(create=True, size=max(X.nbytes, 1))
+    X_shared = np.ndarray(X.shape, dtype=X.dtype, buffer=shm.buf)
+    X_shared[:] = X
+
+    # only the label column is needed by scRNAMatrixInstance
+    columns = [obs_label_colname] if obs_label_colname in adata.obs.columns else []
+    handle = {
+        "name": shm.name,
+        "shape": X.shape,
+        "dtype": X.dtype.str,
+        "obs": adata.obs[columns].copy(),
+        "var_names": adata.var_names.copy(),
+    }
+    return shm, handle
+
+
+# per-process state of the sweep workers
+_shm = None
+_adata = None
+
+
+def _worker_init(handle):
+    global _shm, _adata
+    import anndata
+
+    _shm = shared_memory.SharedMemory(name=handle["name"])
+    X = np.ndarray(handle["shape"], dtype=np.dtype(handle["dtype"]), buffer=_shm.buf)
+    # read-only: the augmentation pool of each trial then copies only the rows its crossover takes
+    # (pcl.loader.OverwrittenRows), so the trials do not start with a private copy of X
+    X.flags.writeable = False
+    _adata = anndata.AnnData(X=X, obs=handle["obs"])
+    _adata.var_names = handle["var_names"]
+
+
+def _run_trial(trial_id, args):
+    import torch
+    import CLEAR
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    torch.backends.cudnn.deterministic = True
+
+    start = time.time()
+    try:
+        results, error = CLEAR.main_worker(args, adata=_adata), None
+    except Exception:
+        results, error = {}, traceback.format_exc()
+    results["time"] = time.time() - start
+    return trial_id, results, error
+
+
+def write_table(records, table_path):
+    table = pd.DataFrame([records[i] for i in sorted(records)])
+    tmp_path = table_path + ".tmp"
+    table.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, table_path)
+
+
+def build_trials(sweep_args, base_args):
+    trials = []
+    grid = itertools.product(*[getattr(sweep_args, name) for name in SWEEP_PARAMS])
+    for values in grid:
+        for _ in range(sweep_args.repeats):
+            trial_id = len(trials)
+            args = copy.deepcopy(base_args)
+            for name, value in zip(SWEEP_PARAMS, values):
+                setattr(args, name, value)
+            args.seed = sweep_args.seed + trial_id
+            args.gpu = sweep_args.gpus[trial_id % len(sweep_args.gpus)]
+            args.save_dir = os.path.join(sweep_args.save_dir, "sweep", "trial_{}".format(trial_id))
+            trials.append(args)
+    return trials
+
+
+def main():
+    sweep_args, clear_argv = parser.parse_known_args()
+
+    import scanpy as sc
+    import CLEAR
+
+    base_args = CLEAR.parser.parse_args(clear_argv)
+    base_args.input_h5ad_path = sweep_args.input_h5ad_path
+    base_args.obs_label_colname = sweep_args.obs_label_colname
+    # preprocess once for all trials, they all read the resolved file
+    CLEAR.resolve_input(base_args)
+    if base_args.input_h5ad_path == "":
+        parser.error("an input is required: --input_h5ad_path, --input_10X_path or --count_csv_path")
+
+    trials = build_trials(sweep_args, base_args)
+    print("=> {} trials".format(len(trials)))
+
+    adata = sc.read_h5ad(base_args.input_h5ad_path)
+    shm, handle = share_adata(adata, sweep_args.obs_label_colname)
+    del adata
+
+    dataset_name = CLEAR.get_dataset_name(base_args.input_h5ad_path)
+    save_path = os.path.join(sweep_args.save_dir, "CLEAR")
+    if os.path.exists(save_path) != True:
+        os.makedirs(save_path)
+    table_path = os.path.join(save_path, "sweep_CLEAR_{}.csv".format(dataset_name))
+
+    records = {}
+    try:
+        # spawn is required for CUDA in the workers
+        with ProcessPoolExecutor(max_workers=sweep_args.max_parallel, mp_context=get_context("spawn"),
+                                 initializer=_worker_init, initargs=(handle,)) as executor:
+            futures = [executor.submit(_run_trial, trial_id, args) for trial_id, args in enumerate(trials)]
+            for future in as_completed(futures):
+                trial_id, results, error = future.result()
+                args = trials[trial_id]
+                record = {"trial": trial_id, "seed": args.seed, "gpu": args.gpu,
+                          "status": "done" if error is None else "failed"}
+                record.update({name: getattr(args, name) for name in SWEEP_PARAMS})
+                record.update(results)
+                record["error"] = error
+                records[trial_id] = record
+                if error is None:
+                    print("=> trial {} finished: {}".format(trial_id, record))
+                else:
+                    print("=> trial {} failed:\n{}".format(trial_id, error))
+                # one table for the whole sweep, rewritten as the trials finish
+                write_table(records, table_path)
+    finally:
+        shm.close()
+        shm.unlink()
+    print("Sweep results saved to {}".format(table_path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# Write and read timings of the storage profiles of preprocess/writers.py.
+# usage: python benchmarks/bench_h5ad_io.py [--input_h5ad_path file.h5ad | --n 200000 --n_genes 2000 --density 0.1]
+#                                          [--dense] [--repeats 3]
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "preprocess"))
+
+parser = argparse.ArgumentParser(description='Benchmark of the h5ad output profiles')
+parser.add_argument('--input_h5ad_path', default=None, type=str,
+                    help='h5ad file to write with each profile (default: synthetic counts)')
+parser.add_argument('--n', default=200000, type=int)
+parser.add_argument('--n_genes', default=2000, type=int)
+parser.add_argument('--density', default=0.1, type=float)
+parser.add_argument('--dense', action='store_true',
+                    help='dense float64 X, as written after --scale')
+parser.add_argument('--repeats', default=3, type=int)
+parser.add_argument('--chunk_size', default=8192, type=int,
+                    help='cells per block of the streamed read')
+
+
+def synthetic_adata(n, n_genes, density, dense, seed=0):
+    import anndata
+    rng = np.random.RandomState(seed)
+    X = sp.random(n, n_genes, density=density, format="csr", dtype=np.float64, random_state=rng,
+                  data_rvs=lambda k: np.log1p(rng.poisson(2, k) + 1))
+    if dense:
+        X = X.toarray()
+    obs = pd.DataFrame({"x": rng.randint(10, size=n).astype(str)}, index=["cell{}".format(i) for i in range(n)])
+    return anndata.AnnData(X=X, obs=obs, var=pd.DataFrame(index=["gene{}".format(i) for i in range(n_genes)]))
+
+
+def best_time(function, repeats):
+    best = np.inf
+    for _ in range(repeats):
+        start = time.time()
+        function()
+        best = min(best, time.time() - start)
+    return best
+
+
+def stream(path, chunk_size):
+    from pcl.embed import iter_h5ad_rows
+    for _ in iter_h5ad_rows(path, chunk_size):
+        pass
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    warnings.filterwarnings("ignore")
+    import anndata
+    from writers import PROFILES, write_h5ad
+
+    if args.input_h5ad_path is not None:
+        adata = anndata.read_h5ad(args.input_h5ad_path)
+    else:
+        adata = synthetic_adata(args.n, args.n_genes, args.density, args.dense)
+    print("data: {} cells x {} genes, X {} {}".format(adata.shape[0], adata.shape[1], type(adata.X).__name__,
+                                                      adata.X.dtype))
+
+    directory = tempfile.mkdtemp()
+    try:
+        print("{:<10}{:>10}{:>10}{:>12}{:>14}".format("profile", "size MB", "write s", "read s", "stream s"))
+        for profile in PROFILES:
+            path = os.path.join(directory, "{}.h5ad".format(profile))
+            write_time = best_time(lambda: write_h5ad(adata, path, profile), args.repeats)
+            read_time = best_time(lambda: anndata.read_h5ad(path), args.repeats)
+            stream_time = best_time(lambda: stream(path, args.chunk_size), args.repeats)
+            print("{:<10}{:>10.1f}{:>10.2f}{:>12.2f}{:>14.2f}".format(
+                profile, os.path.getsize(path) / 2**20, write_time, read_time, stream_time))
+    finally:
+        shutil.rmtree(directory)
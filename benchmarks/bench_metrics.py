@@ -0,0 +1,72 @@
+# Compare metrics.compute_metrics with the previous implementation (seven sklearn calls,
+# each rebuilding the contingency table, and a python loop for CA).
+# usage: python benchmarks/bench_metrics.py [--n 1000000] [--n_classes 30] [--n_clusters 30]
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metrics import compute_metrics
+
+parser = argparse.ArgumentParser(description='Benchmark of metrics.compute_metrics')
+parser.add_argument('--n', default=1000000, type=int)
+parser.add_argument('--n_classes', default=30, type=int)
+parser.add_argument('--n_clusters', default=30, type=int)
+parser.add_argument('--seed', default=0, type=int)
+
+
+def previous_compute_metrics(y_true, y_pred):
+    from sklearn.metrics import homogeneity_score, completeness_score, v_measure_score
+    from sklearn.metrics import adjusted_rand_score as ARI
+    from sklearn.metrics import normalized_mutual_info_score as NMI
+    from sklearn.metrics.cluster import pair_confusion_matrix
+    from scipy.optimize import linear_sum_assignment
+
+    def cluster_acc(y_true, y_pred):
+        y_pred = y_pred.astype(np.int64)
+        label_to_number = {label: number for number, label in enumerate(set(y_true))}
+        y_true = np.array([label_to_number[i] for i in y_true]).astype(np.int64)
+        D = max(y_pred.max(), y_true.max()) + 1
+        w = np.zeros((D, D), dtype=np.int64)
+        for i in range(y_pred.size):
+            w[y_pred[i], y_true[i]] += 1
+        row_ind, col_ind = linear_sum_assignment(w.max() - w)
+        return sum([w[i, j] for i, j in zip(row_ind, col_ind)]) * 1.0 / y_pred.size
+
+    def Jaccard_index(y_true, y_pred):
+        contingency = pair_confusion_matrix(y_true, y_pred)
+        return contingency[1, 1] / (contingency[1, 1] + contingency[0, 1] + contingency[1, 0])
+
+    return {
+        "ARI": ARI(y_true, y_pred),
+        "NMI": NMI(y_true, y_pred),
+        "CA": cluster_acc(y_true, y_pred),
+        "JI": Jaccard_index(y_true, y_pred),
+        "CS": completeness_score(y_true, y_pred),
+        "HS": homogeneity_score(y_true, y_pred),
+        "VMS": v_measure_score(y_true, y_pred),
+    }
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    rng = np.random.RandomState(args.seed)
+    y_true = rng.randint(args.n_classes, size=args.n)
+    # noisy predictions: 70% follow the classes (permuted), the rest random
+    y_pred = np.where(rng.rand(args.n) < 0.7, (y_true * 7 + 3) % args.n_clusters, rng.randint(args.n_clusters, size=args.n))
+
+    start = time.time()
+    new = compute_metrics(y_true, y_pred)
+    new_time = time.time() - start
+
+    start = time.time()
+    old = previous_compute_metrics(y_true, y_pred)
+    old_time = time.time() - start
+
+    print("{:<6}{:>22}{:>22}".format("metric", "previous", "contingency"))
+    for key in old:
+        print("{:<6}{:>22.12f}{:>22.12f}".format(key, old[key], new[key]))
+    print("time  {:>21.3f}s{:>21.3f}s  speed-up {:.1f}x".format(old_time, new_time, old_time / new_time))
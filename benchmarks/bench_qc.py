@@ -0,0 +1,94 @@
+# Compare the fused QC filter of generate_h5ad.qc_filter with the previous sequence of scanpy calls
+# (filter_cells, filter_genes, calculate_qc_metrics for MT- then ERCC-, a slice after each step).
+# usage: python benchmarks/bench_qc.py [--n 1000000] [--n_genes 2000] [--density 0.12]
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "preprocess"))
+
+parser = argparse.ArgumentParser(description='Benchmark of the --filter step of generate_h5ad.py')
+parser.add_argument('--n', default=1000000, type=int)
+parser.add_argument('--n_genes', default=2000, type=int)
+parser.add_argument('--density', default=0.12, type=float)
+parser.add_argument('--seed', default=0, type=int)
+
+
+def make_adata(n, n_genes, density, seed, chunk_size=100000):
+    """Sparse counts with MT- and ERCC- genes, some cells with few genes or high MT/ERCC fractions"""
+    import anndata
+    rng = np.random.RandomState(seed)
+    blocks = []
+    for start in range(0, n, chunk_size):
+        rows = min(chunk_size, n - start)
+        block = sp.random(rows, n_genes, density=density, format="csr", dtype=np.float32, random_state=rng,
+                          data_rvs=lambda k: rng.poisson(2, k) + 1)
+        row_of = np.repeat(np.arange(rows), np.diff(block.indptr))
+        # a tenth of the cells keep a quarter of their genes, many fall below 200 genes
+        sparse_cells = rng.rand(rows) < 0.1
+        block.data[sparse_cells[row_of] & (rng.rand(block.nnz) < 0.75)] = 0
+        # 5% of the cells get 20 times more MT-/ERCC- counts (the first 40 genes)
+        high_qc = rng.rand(rows) < 0.05
+        block.data[high_qc[row_of] & (block.indices < 40)] *= 20
+        block.eliminate_zeros()
+        blocks.append(block)
+    names = ["GENE{}".format(i) for i in range(n_genes)]
+    names[:13] = ["MT-{}".format(i) for i in range(13)]
+    names[13:40] = ["ERCC-{}".format(i) for i in range(27)]
+    obs = pd.DataFrame(index=["cell{}".format(i) for i in range(n)])
+    return anndata.AnnData(X=sp.vstack(blocks, format="csr"), obs=obs, var=pd.DataFrame(index=names))
+
+
+def previous_filter(adata):
+    import scanpy as sc
+    sc.pp.filter_cells(adata, min_genes=200)
+    sc.pp.filter_genes(adata, min_cells=3)
+    adata.var['mt'] = adata.var_names.str.startswith('MT-')
+    sc.pp.calculate_qc_metrics(adata, qc_vars=['mt'], percent_top=None, log1p=False, inplace=True)
+    adata = adata[(adata.obs.pct_counts_mt < 5)]
+    adata.var['ERCC'] = adata.var_names.str.startswith('ERCC-')
+    sc.pp.calculate_qc_metrics(adata, qc_vars=['ERCC'], percent_top=None, log1p=False, inplace=True)
+    adata = adata[(adata.obs.pct_counts_ERCC < 10)]
+    # the views are made actual by the next step of the preprocessing
+    return adata.copy()
+
+
+def timed(function, adata):
+    tracemalloc.start()
+    start = time.time()
+    result = function(adata)
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    warnings.filterwarnings("ignore")
+    import anndata
+    from generate_h5ad import qc_filter
+
+    adata = make_adata(args.n, args.n_genes, args.density, args.seed)
+    print("data: {} cells x {} genes, {} nonzeros".format(adata.shape[0], adata.shape[1], adata.X.nnz))
+
+    # qc_filter only adds obs/var columns, so both runs can share X
+    fused, fused_time, fused_peak = timed(qc_filter, anndata.AnnData(X=adata.X, obs=adata.obs.copy(),
+                                                                     var=adata.var.copy()))
+    previous, previous_time, previous_peak = timed(previous_filter, adata)
+
+    same = (list(fused.obs_names) == list(previous.obs_names) and list(fused.var_names) == list(previous.var_names)
+            and all(np.allclose(fused.obs[c], previous.obs[c], equal_nan=True) for c in previous.obs.columns)
+            and all(np.allclose(fused.var[c], previous.var[c], equal_nan=True) for c in previous.var.columns))
+    print("kept {} cells x {} genes, identical masks and QC columns: {}".format(fused.shape[0], fused.shape[1], same))
+    print("{:<10}{:>12}{:>16}".format("", "time", "peak memory"))
+    print("{:<10}{:>11.2f}s{:>13.0f} MB".format("previous", previous_time, previous_peak / 2**20))
+    print("{:<10}{:>11.2f}s{:>13.0f} MB".format("fused", fused_time, fused_peak / 2**20))
+    print("speed-up {:.1f}x".format(previous_time / fused_time))
@@ -0,0 +1,51 @@
+# Startup time of the CLEAR entry points, measured in fresh interpreters.
+# usage: python benchmarks/bench_startup.py [--repeats 5] [--checkpoint ckpt --input_h5ad_path file.h5ad]
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+parser = argparse.ArgumentParser(description='Startup benchmark of CLEAR entry points')
+parser.add_argument('--repeats', default=5, type=int)
+parser.add_argument('--checkpoint', default=None, type=str,
+                    help='optional checkpoint to also time a full CLEAR_embed.py run')
+parser.add_argument('--input_h5ad_path', default=None, type=str)
+
+# the imports CLEAR.py used to pay at module import time, against the ones of the slim path
+CASES = [
+    ("previous CLEAR.py imports", [sys.executable, "-c",
+                                   "import torch, torchvision.models, PIL.ImageFilter, torchvision.datasets, "
+                                   "sklearn.cluster, scanpy, pandas, sklearn.metrics"]),
+    ("import CLEAR", [sys.executable, "-c", "import CLEAR"]),
+    ("CLEAR.py --help", [sys.executable, "CLEAR.py", "--help"]),
+    ("slim imports (torch, h5py)", [sys.executable, "-c", "import torch, h5py"]),
+    ("import pcl.embed", [sys.executable, "-c", "import pcl.embed"]),
+    ("CLEAR_embed.py --help", [sys.executable, "CLEAR_embed.py", "--help"]),
+]
+
+
+def timeit(command, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        subprocess.run(command, cwd=ROOT, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.time() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    cases = list(CASES)
+    if args.checkpoint is not None and args.input_h5ad_path is not None:
+        output = os.path.join(tempfile.mkdtemp(), "embeddings.npy")
+        cases.append(("CLEAR_embed.py run", [sys.executable, "CLEAR_embed.py", "--checkpoint", args.checkpoint,
+                                             "--input_h5ad_path", args.input_h5ad_path, "--output", output]))
+
+    print("{:<32}{:>12}".format("case", "median (s)"))
+    for name, command in cases:
+        print("{:<32}{:>12.3f}".format(name, timeit(command, args.repeats)))
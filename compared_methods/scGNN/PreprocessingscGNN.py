@@ -6,6 +6,9 @@ import pickle
 import os.path
 import scipy.sparse as sp
 import scipy.io
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir, 'preprocess'))
+from readers import read_10x_mtx
 
 parser = argparse.ArgumentParser(description='Main Entrance of scGNN')
 parser.add_argument('--datasetName', type=str, default='481193cb-c021-4e04-b477-0b7cfef4614b.mtx',
@@ -60,186 +63,52 @@ def preprocessing10X(dir, datasetName, csvFilename, transform='log', cellRatio=0
     if not os.path.exists(filefolder):
         print('Dataset ' + filefolder + ' not exists!')
 
-    # Three files of 10x
-    featuresFilename = filefolder + 'features.tsv'
-    if os.path.exists(featuresFilename+'.gz'):
-        featuresFilename = featuresFilename+'.gz'
-    elif not os.path.exists(featuresFilename):
-        print('features.tsv or features.tsv.gz not exists!')
-
-    barcodesFilename = filefolder + 'barcodes.tsv'
-    if os.path.exists(barcodesFilename+'.gz'):
-        barcodesFilename = barcodesFilename+'.gz'
-    elif not os.path.exists(barcodesFilename):
-        print('barcodes.tsv or barcodes.tsv.gz not exists!')
-
-    expressionFilename = filefolder + 'matrix.mtx'
-    if os.path.exists(expressionFilename+'.gz'):
-        expressionFilename = expressionFilename+'.gz'
-    elif not os.path.exists(expressionFilename):
-        print('matrix.mtx or matrix.mtx.gz not exists!')
-
     print('Input scRNA data in 10X is validated, start reading...')
 
-    genes = pd.read_csv(featuresFilename, header=None, delim_whitespace=True)
-    cells = pd.read_csv(barcodesFilename, header=None, delim_whitespace=True)
-    df = pd.read_csv(expressionFilename, header=None,
-                     skiprows=2, delim_whitespace=True)
+    # cells x genes, matrix.mtx parsed by the shared reader of preprocess/readers.py
+    X, barcodes, features = read_10x_mtx(filefolder, dtype=np.float64)
+    geneIDs = features['gene_ids'].values
 
     print('Data loaded, start filtering...')
 
-    geneNamelist = []
-    cellNamelist = []
-
-    geneNameDict = {}
-    cellNameDict = {}
-
-    expressionDict = {}
-    expressionCellDict = {}
-    for i in range(len(genes)):
-        expressionDict[i] = []
-        expressionCellDict[i] = []
-
-    # Preprocessing before generating the whole data strcture
-    tmpgenelist = []
-    tmpdatalist = []
-    oldcellindex = -1
-    cellNum = 0
-
-    for row in df.itertuples():
-        if row.Index % 1000000 == 0:
-            print(str(row.Index)+' items in expression has been proceed.')
-        if not (row[2]-1) == oldcellindex:
-            if (row[2]-1) < oldcellindex:
-                print('Potential error in 10X data: '+str(oldcellindex)+'!')
-            if len(tmpgenelist) >= len(genes)*(1-cellRatio) and not oldcellindex == -1:
-                for i in range(len(tmpgenelist)):
-                    tmplist = expressionDict[tmpgenelist[i]]
-                    tmplist.append(tmpdatalist[i])
-                    expressionDict[tmpgenelist[0]] = tmplist
-
-                    tmplist = expressionCellDict[tmpgenelist[i]]
-                    tmplist.append(oldcellindex)
-                    expressionCellDict[tmpgenelist[0]] = tmplist
-
-                cellNamelist.append(oldcellindex)
-                cellNameDict[oldcellindex] = cellNum
-                cellNum += 1
-            tmpgenelist = []
-            tmpdatalist = []
-            oldcellindex = row[2]-1
-
-        tmpgenelist.append(row[1]-1)
-        tmpdata = row[3]
-        if transform == 'log':
-            tmpdatalist.append(np.log(tmpdata+1))
-        elif transform == None:
-            tmpdatalist.append(tmpdata)
-
-    # post processing
-    if len(tmpgenelist) >= len(genes)*(1-cellRatio):
-        for i in range(len(tmpgenelist)):
-            tmplist = expressionDict[tmpgenelist[i]]
-            tmplist.append(tmpdatalist[i])
-            expressionDict[tmpgenelist[0]] = tmplist
-
-            tmplist = expressionCellDict[tmpgenelist[i]]
-            tmplist.append(oldcellindex)
-            expressionCellDict[tmpgenelist[0]] = tmplist
-
-        cellNamelist.append(oldcellindex)
-        cellNameDict[oldcellindex] = cellNum
-        cellNum += 1
-
+    # cells with at least (1-cellRatio) of the genes
+    cellNamelist = np.flatnonzero(np.diff(X.indptr) >= X.shape[1]*(1-cellRatio))
+    X = X[cellNamelist]
+    if transform == 'log':
+        X.data = np.log(X.data+1)
     print('After preprocessing, {} cells remaining'.format(len(cellNamelist)))
 
-    # Now work on genes:
-    finalList = []
-    for i in range(len(genes)):
-        tmplist = expressionDict[i]
-        if len(tmplist) >= len(cellNamelist)*(1-geneRatio):
-            geneNamelist.append(i)
-            if geneCriteria == 'variance':
-                finalList.append(-np.var(tmplist))
-
+    # genes expressed in at least (1-geneRatio) of the remaining cells
+    X = X.tocsc()
+    nonzeros = np.diff(X.indptr)
+    geneNamelist = np.flatnonzero(nonzeros >= len(cellNamelist)*(1-geneRatio))
     print('After preprocessing, {} genes have {} nonzero'.format(
         len(geneNamelist), geneRatio))
 
+    finalList = []
+    if geneCriteria == 'variance':
+        # variance of the nonzero values of each gene
+        geneOf = np.repeat(np.arange(X.shape[1]), nonzeros)
+        counts = np.maximum(nonzeros, 1)
+        means = np.bincount(geneOf, weights=X.data, minlength=X.shape[1])/counts
+        variances = np.bincount(geneOf, weights=(X.data-means[geneOf])**2, minlength=X.shape[1])/counts
+        finalList = -variances[geneNamelist]
     tmpChooseIndex = np.argsort(finalList)[:geneSelectnum]
-    tmpChooseIndex = tmpChooseIndex.tolist()
-
-    for i in range(len(tmpChooseIndex)):
-        geneNameDict[geneNamelist[tmpChooseIndex[i]]] = i
-
-    genelist = []
-    celllist = []
-    datalist = []
-
-    outgenelist = []
-    outcelllist = []
-
-    # output
-    outList = []
-    header = 'Gene_ID'
-    for i in range(len(cellNamelist)):
-        # print('{}\t{}\t{}'.format(cellNamelist[i],cells[cellNamelist[i]],cells[cellNamelist[i]][0]))
-        header = header + ',' + cells[0][cellNamelist[i]]
-        outcelllist.append(cells[0][cellNamelist[i]])
-    outList.append(header+'\n')
-
-    for index in tmpChooseIndex:
-        # print(index)
-        geneindex = geneNamelist[index]
-        clist = expressionCellDict[geneindex]
-        elist = expressionDict[geneindex]
-
-        # For output sparse purpose
-        if sparseOut:
-            for i in range(len(elist)):
-                # print('{}*{}'.format(geneindex,geneNameDict[geneindex]))
-                genelist.append(geneNameDict[geneindex])
-                celllist.append(cellNameDict[clist[i]])
-                datalist.append(elist[i])
-
-        # print('*')
-        tmpline = genes[0][index]
-        outgenelist.append(tmpline)
-        # print(str(len(cellNamelist))+' '+str(len(clist)))
-        k = 0
-        for l in range(len(cellNamelist)):
-            for j in range(k, len(clist)):
-                # print(j)
-                if cellNamelist[l] == clist[j]:
-                    tmpline = tmpline + ','
-                    tmpline = tmpline + str(elist[j])
-                    k = j+1
-                    break
-                elif cellNamelist[l] < clist[j]:
-                    tmpline = tmpline + ','
-                    tmpline = tmpline + str(0.0)
-                    k = j
-                    break
-
-        size = tmpline.split(',')
-        for i in range(len(size), len(cellNamelist)+1):
-            tmpline = tmpline + ','
-            tmpline = tmpline + str(0.0)
-
-        outList.append(tmpline+'\n')
-        size = tmpline.split(',')
-        # For debug usage
-        # print(str(index)+'*'+str(len(size)))
+    selectedGenes = geneNamelist[tmpChooseIndex]
 
+    # output: genes x cells
+    data = X[:, selectedGenes].T.tocsr()
+    outgenelist = list(geneIDs[selectedGenes])
+    outcelllist = [barcodes[i] for i in cellNamelist]
     with open(csvFilename, 'w') as fw:
-        fw.writelines(outList)
-        fw.close()
+        fw.write(','.join(['Gene_ID']+outcelllist)+'\n')
+        for i, gene in enumerate(outgenelist):
+            fw.write(','.join([gene]+[str(value) for value in data[i].toarray()[0].tolist()])+'\n')
     print('Write CSV done')
 
     # For output sparse purpose
     if sparseOut:
-        data = scipy.sparse.csr_matrix((datalist, (genelist, celllist)), shape=(
-            len(tmpChooseIndex), len(cellNamelist))).tolil()
-        pickle.dump(data, open(csvFilename.replace(
+        pickle.dump(data.tolil(), open(csvFilename.replace(
             '.csv', '_sparse.npy'), "wb"))
         print('Write sparse output done')
 
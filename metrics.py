@@ -1,17 +1,79 @@
-from sklearn.metrics import homogeneity_score
-from sklearn.metrics import completeness_score
-from sklearn.metrics import v_measure_score
-from sklearn.metrics import adjusted_rand_score as ARI
-from sklearn.metrics import normalized_mutual_info_score as NMI
-
 import numpy as np
 import pandas as pd
 import os
 import sys
 import csv
+import hashlib
+import json
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import scipy.sparse as sp
+from scipy.optimize import linear_sum_assignment as linear_assignment
+from scipy.special import chdtrc
+
+from pcl.cluster import knn_search
+
+def _fingerprint(path, previous=None):
+    """
+    size/mtime/sha1 of a file; the content is only hashed again when size or mtime
+    changed since the previous fingerprint
+    """
+    stat = os.stat(path)
+    if previous is not None and previous["size"] == stat.st_size and previous["mtime"] == stat.st_mtime:
+        return previous
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(block)
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "sha1": sha1.hexdigest()}
+
+
+def _score_pair(gt_label_path, pd_label_path):
+    gt_label = pd.read_csv(gt_label_path, index_col=0).iloc[:, 0].values
+    pd_label = pd.read_csv(pd_label_path, index_col=0).iloc[:, 0].values
+    return compute_metrics(gt_label, pd_label)
+
+
+def _atomic_write(path, write):
+    # write to a temporary file in the same directory, then rename over the target
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def traverse_folder_compute_metrics(root_path, save_path, n_jobs=None):
+    """
+    Score every gt_label/pd_label pair of root_path into save_path/new_metrics.csv.
+    Pairs are scored in a process pool; a manifest of the label files (size/mtime/sha1)
+    lets unchanged pairs be skipped, and the csv holds one row per (dataset, method).
+    """
+    if os.path.exists(save_path) != True:
+        os.makedirs(save_path)
+    csv_path = os.path.join(save_path, "new_metrics.csv")
+    manifest_path = os.path.join(save_path, "new_metrics_manifest.json")
+
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
 
-def traverse_folder_compute_metrics(root_path, save_path):
-    for filename in os.listdir(root_path):
+    # existing results, keyed by (dataset, method); later rows win over duplicates
+    records = {}
+    if os.path.exists(csv_path):
+        with open(csv_path, encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                records[(row["dataset"], row["method"])] = row
+
+    # 1. find the pairs whose label files changed
+    jobs = {}
+    new_manifest = {}
+    for filename in sorted(os.listdir(root_path)):
         if "gt_label" not in filename:
             continue
         pre_filename, ext = os.path.splitext(filename)
@@ -19,58 +81,477 @@ def traverse_folder_compute_metrics(root_path, save_path):
 
         gt_label_path = os.path.join(root_path, filename)
         pd_label_path = os.path.join(root_path, filename.replace("gt_label", "pd_label"))
-        gt_label = pd.read_csv(gt_label_path, index_col=0).iloc[:, 0]
-        pd_label = pd.read_csv(pd_label_path, index_col=0).iloc[:, 0]
-        print(gt_label.shape)
-        print(pd_label.shape)
-
-        metrics = compute_metrics(gt_label, pd_label)
-
-        print("{} - {}: \n {}".format(dataset_name, method_name, metrics))
-
-        # save txt
-        #save_path = os.path.join(save_path, method_name)
-        if os.path.exists(save_path) != True:
-            os.makedirs(save_path)
-        #txt_path = os.path.join(save_path, "new_metrics.txt")
-        #f = open(txt_path, "a")
-        # f.write("{} {} {}\n".format(dataset_name, ari_score, nmi_score))
-
-        #record_string = dataset_name + " " + method_name
-        #for key in metrics.keys():
-        #    record_string += " {}".format(metrics[key])
-        #record_string += "\n"
-        #f.write(record_string)
-        #f.close()
-
-        csv_path = os.path.join(save_path, "new_metrics.csv")
-        need_head = False
-        if os.path.exists(csv_path) != True:
-            need_head = True
-        f = open(csv_path, "a", encoding="utf-8’", newline="")
+        if not os.path.exists(pd_label_path):
+            print("Missing prediction for {}".format(gt_label_path))
+            continue
+
+        previous = manifest.get(filename, {})
+        entry = {"gt": _fingerprint(gt_label_path, previous.get("gt")),
+                 "pd": _fingerprint(pd_label_path, previous.get("pd"))}
+        new_manifest[filename] = entry
+        unchanged = (previous.get("gt", {}).get("sha1") == entry["gt"]["sha1"]
+                     and previous.get("pd", {}).get("sha1") == entry["pd"]["sha1"])
+        if unchanged and (dataset_name, method_name) in records:
+            continue
+        jobs[(dataset_name, method_name)] = (gt_label_path, pd_label_path)
+
+    print("{} pairs to score, {} up to date".format(len(jobs), len(new_manifest) - len(jobs)))
+
+    # 2. score them in parallel
+    if len(jobs) > 0:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = {executor.submit(_score_pair, *paths): key for key, paths in jobs.items()}
+            for future in as_completed(futures):
+                dataset_name, method_name = futures[future]
+                metrics = future.result()
+                print("{} - {}: \n {}".format(dataset_name, method_name, metrics))
+                record = {"dataset": dataset_name, "method": method_name}
+                record.update(metrics)
+                records[(dataset_name, method_name)] = record
+
+    # 3. rewrite the csv and the manifest atomically
+    head = ["dataset", "method"]
+    for record in records.values():
+        head += [key for key in record if key not in head]
+
+    def write_csv(f):
         csv_writer = csv.writer(f)
-        record = [dataset_name, method_name]
-        head = ["dataset", "method"]
-        for key in metrics.keys():
-            record.append(metrics[key])
-            head.append(key)
-        if need_head == True:
-            csv_writer.writerow(head)
-        csv_writer.writerow(record)
-        f.close()
+        csv_writer.writerow(head)
+        for key in sorted(records):
+            csv_writer.writerow([records[key].get(column, "") for column in head])
+
+    _atomic_write(csv_path, write_csv)
+    _atomic_write(manifest_path, lambda f: json.dump(new_manifest, f))
+
+
+def contingency_table(y_true, y_pred):
+    """
+    Contingency table [n_classes, n_clusters] of two label vectors, built once with
+    np.unique codes and a single bincount; every metric below is derived from it.
+    """
+    y_true = np.asarray(y_true).ravel()
+    y_pred = np.asarray(y_pred).ravel()
+    assert y_true.size == y_pred.size
+    _, true_codes = np.unique(y_true, return_inverse=True)
+    _, pred_codes = np.unique(y_pred, return_inverse=True)
+    n_classes = true_codes.max() + 1 if true_codes.size else 0
+    n_clusters = pred_codes.max() + 1 if pred_codes.size else 0
+    table = np.bincount(true_codes.ravel() * n_clusters + pred_codes.ravel(), minlength=n_classes * n_clusters)
+    return table.reshape(n_classes, n_clusters)
+
+
+def _entropy(counts, n):
+    p = counts[counts > 0] / n
+    return float(-(p * np.log(p)).sum())
 
 
+def _mutual_info(contingency, n, a, b):
+    rows, cols = np.nonzero(contingency)
+    nij = contingency[rows, cols].astype(np.float64)
+    mi = (nij / n * (np.log(nij) + np.log(n) - np.log(a[rows]) - np.log(b[cols]))).sum()
+    return max(float(mi), 0.0)
+
+
+def _pair_confusion(contingency, n, a, b):
+    # same as sklearn's pair_confusion_matrix (ordered pairs), as python ints to avoid overflow
+    sum_squares = int((contingency.astype(np.int64) ** 2).sum())
+    tp = sum_squares - n
+    fp = int((b.astype(np.int64) ** 2).sum()) - sum_squares
+    fn = int((a.astype(np.int64) ** 2).sum()) - sum_squares
+    tn = n * n - fp - fn - sum_squares
+    return tn, fp, fn, tp
+
+
+def _jaccard(tp, fp, fn):
+    # undefined (nan) when no pair is in the same group in either labelling
+    return tp / (tp + fp + fn) if tp + fp + fn > 0 else float("nan")
+
+
+def metrics_from_contingency(contingency):
+    """ARI, NMI, CA, JI, CS, HS and VMS of a contingency table (rows: true labels, columns: predictions)"""
+    n = int(contingency.sum())
+    a = contingency.sum(1)
+    b = contingency.sum(0)
+    n_classes, n_clusters = contingency.shape
+    metrics = {}
+
+    # adjusted rand index
+    tn, fp, fn, tp = _pair_confusion(contingency, n, a, b)
+    if fn == 0 and fp == 0:
+        metrics["ARI"] = 1.0
+    else:
+        metrics["ARI"] = 2. * (tp * tn - fn * fp) / ((tp + fn) * (fn + tn) + (tp + fp) * (fp + tn))
+
+    # normalized mutual information (arithmetic mean normalization)
+    h_true, h_pred = _entropy(a, n), _entropy(b, n)
+    mi = _mutual_info(contingency, n, a, b) if n > 0 else 0.0
+    if n_classes == n_clusters == 1 or n_classes == n_clusters == 0:
+        metrics["NMI"] = 1.0
+    elif mi == 0:
+        metrics["NMI"] = 0.0
+    else:
+        metrics["NMI"] = mi / max((h_true + h_pred) / 2, np.finfo("float64").eps)
+
+    # cluster accuracy, best one-to-one matching of clusters and classes
+    row_ind, col_ind = linear_assignment(contingency, maximize=True)
+    metrics["CA"] = contingency[row_ind, col_ind].sum() * 1.0 / n
+
+    # jaccard index
+    metrics["JI"] = _jaccard(tp, fp, fn)
+
+    # completeness, homogeneity and v-measure
+    homogeneity = mi / h_true if h_true else 1.0
+    completeness = mi / h_pred if h_pred else 1.0
+    metrics["CS"] = completeness
+    metrics["HS"] = homogeneity
+    if homogeneity + completeness == 0.0:
+        metrics["VMS"] = 0.0
+    else:
+        metrics["VMS"] = 2. * homogeneity * completeness / (homogeneity + completeness)
+
+    return metrics
+
 
 def compute_metrics(y_true, y_pred):
+    return metrics_from_contingency(contingency_table(y_true, y_pred))
+
+
+def _xlogx_sum(x, axis):
+    x = x.astype(np.float64)
+    return (x * np.log(np.where(x > 0, x, 1))).sum(axis)
+
+
+def metrics_from_contingencies(tables):
+    """
+    metrics_from_contingency for a stack of tables [num_tables, n_classes, n_clusters],
+    as batched array operations (CA still solves one assignment per table).
+    Empty rows/columns are ignored, as if the labels were absent. Return: {metric: [num_tables]}
+    """
+    tables = np.asarray(tables, dtype=np.float64)
+    n = tables.sum((1, 2))
+    a = tables.sum(2)
+    b = tables.sum(1)
+    n_classes = (a > 0).sum(1)
+    n_clusters = (b > 0).sum(1)
     metrics = {}
-    metrics["ARI"] = ARI(y_true, y_pred)
-    metrics["NMI"] = NMI(y_true, y_pred)
-    metrics["CA"] = cluster_acc(y_true, y_pred)
-    metrics["JI"] = Jaccard_index(y_true, y_pred)
-    metrics["CS"] = completeness_score(y_true, y_pred)
-    metrics["HS"] = homogeneity_score(y_true, y_pred)
-    metrics["VMS"] = v_measure_score(y_true, y_pred)
 
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # adjusted rand index, from the pair confusion matrix
+        sum_squares = (tables ** 2).sum((1, 2))
+        tp = sum_squares - n
+        fp = (b ** 2).sum(1) - sum_squares
+        fn = (a ** 2).sum(1) - sum_squares
+        tn = n * n - fp - fn - sum_squares
+        ari = 2. * (tp * tn - fn * fp) / ((tp + fn) * (fn + tn) + (tp + fp) * (fp + tn))
+        metrics["ARI"] = np.where((fn == 0) & (fp == 0), 1.0, ari)
+
+        # entropies and mutual information from sums of x*log(x)
+        log_n = np.log(n)
+        s_a = _xlogx_sum(a, 1) / n
+        s_b = _xlogx_sum(b, 1) / n
+        h_true = np.where(n_classes > 1, log_n - s_a, 0.0)
+        h_pred = np.where(n_clusters > 1, log_n - s_b, 0.0)
+        mi = np.maximum(log_n + _xlogx_sum(tables, (1, 2)) / n - s_a - s_b, 0.0)
+        nmi = mi / np.maximum((h_true + h_pred) / 2, np.finfo("float64").eps)
+        nmi = np.where(mi == 0, 0.0, nmi)
+        metrics["NMI"] = np.where((n_classes == 1) & (n_clusters == 1), 1.0, nmi)
+
+        metrics["CA"] = np.array([table[linear_assignment(table, maximize=True)].sum() for table in tables]) / n
+
+        metrics["JI"] = np.where(tp + fp + fn > 0, tp / (tp + fp + fn), np.nan)
+
+        homogeneity = np.where(h_true > 0, mi / h_true, 1.0)
+        completeness = np.where(h_pred > 0, mi / h_pred, 1.0)
+        metrics["CS"] = completeness
+        metrics["HS"] = homogeneity
+        vms = 2. * homogeneity * completeness / (homogeneity + completeness)
+        metrics["VMS"] = np.where(homogeneity + completeness == 0, 0.0, vms)
+
+    return metrics
+
+
+def bootstrap_metrics(y_true, y_pred, n_boot=1000, alpha=0.05, seed=0, batch_size=256):
+    """
+    Percentile bootstrap confidence intervals of the clustering metrics.
+    Resampling the cells with replacement only changes the contingency table, so each
+    replicate is a multinomial draw of the table and the metrics of a batch of replicates
+    are computed at once with metrics_from_contingencies.
+    Return: {metric: point estimate, metric_lo: lower bound, metric_hi: upper bound}
+    """
+    contingency = contingency_table(y_true, y_pred)
+    n = int(contingency.sum())
+    p = contingency.ravel() / n
+    rng = np.random.default_rng(seed)
+
+    replicates = {}
+    for start in range(0, n_boot, batch_size):
+        size = min(batch_size, n_boot - start)
+        tables = rng.multinomial(n, p, size=size).reshape(size, *contingency.shape)
+        for key, values in metrics_from_contingencies(tables).items():
+            replicates.setdefault(key, []).append(values)
+
+    result = {}
+    for key, value in metrics_from_contingency(contingency).items():
+        values = np.concatenate(replicates[key])
+        result[key] = value
+        result[key + "_lo"], result[key + "_hi"] = np.nanpercentile(values, [100 * alpha / 2, 100 * (1 - alpha / 2)])
+    return result
+
+
+# label-free metrics of an embedding, computed by blocks of cells so memory stays bounded
+def _label_codes(labels, num_cells):
+    _, codes = np.unique(np.asarray(labels).ravel(), return_inverse=True)
+    codes = codes.ravel()
+    counts = np.bincount(codes)
+    if not 1 < len(counts) < num_cells:
+        raise ValueError("Number of labels is {}. Valid values are 2 to n_samples - 1 (inclusive)".format(len(counts)))
+    return codes, counts
+
+
+def _pairwise_distances(query, X, X_sqnorm, metric):
+    # in place on the product, the blocks are large
+    distances = query @ X.T
+    if metric == "cosine":
+        # rows are L2-normalized beforehand
+        np.subtract(1, distances, out=distances)
+        return np.maximum(distances, 0, out=distances)
+    distances *= -2
+    distances += (query ** 2).sum(1)[:, None]
+    distances += X_sqnorm[None, :]
+    np.maximum(distances, 0, out=distances)
+    return np.sqrt(distances, out=distances)
+
+
+def _cluster_distance_sums(query, X, X_sqnorm, codes, n_labels, metric, ref_chunk_size):
+    """[m, n_labels] sums of the distances from every query cell to the cells of each label"""
+    sums = np.zeros((query.shape[0], n_labels))
+    for start in range(0, X.shape[0], ref_chunk_size):
+        stop = min(start + ref_chunk_size, X.shape[0])
+        onehot = np.zeros((stop - start, n_labels))
+        onehot[np.arange(stop - start), codes[start:stop]] = 1
+        sums += _pairwise_distances(query, X[start:stop], X_sqnorm[start:stop], metric) @ onehot
+    return sums
+
+
+def silhouette_samples(X, labels, query_idx=None, metric="euclidean", chunk_size=1024, ref_chunk_size=4096, n_jobs=1):
+    """
+    Exact silhouette of the cells query_idx (default: all cells) against all cells of X.
+    Distances are computed for chunk_size x ref_chunk_size blocks at a time and reduced
+    to per-label sums right away, query blocks run in parallel threads.
+    metric: "euclidean" or "cosine"
+    """
+    X = np.asarray(X, dtype=np.float64)
+    if metric == "cosine":
+        X = X / np.maximum(np.linalg.norm(X, axis=1, keepdims=True), 1e-12)
+    codes, counts = _label_codes(labels, X.shape[0])
+    X_sqnorm = (X ** 2).sum(1)
+    query_idx = np.arange(X.shape[0]) if query_idx is None else np.asarray(query_idx)
+
+    def run(start):
+        rows = query_idx[start:start + chunk_size]
+        sums = _cluster_distance_sums(X[rows], X, X_sqnorm, codes, len(counts), metric, ref_chunk_size)
+        own = codes[rows]
+        r = np.arange(len(rows))
+        a = sums[r, own] / np.maximum(counts[own] - 1, 1)
+        mean_distances = sums / counts
+        mean_distances[r, own] = np.inf
+        b = mean_distances.min(1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            s = np.nan_to_num((b - a) / np.maximum(a, b))
+        # cells alone in their cluster score 0
+        return np.where(counts[own] > 1, s, 0)
+
+    # numpy matmul releases the GIL, threads are enough to use all cores
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        results = list(executor.map(run, range(0, len(query_idx), chunk_size)))
+    return np.concatenate(results) if results else np.zeros(0)
+
+
+def silhouette_score(X, labels, sample_size=None, seed=0, metric="euclidean", chunk_size=1024, n_jobs=1):
+    """
+    Mean silhouette. With sample_size, only a stratified sample of cells (proportional to
+    the label sizes, at least one per label) is scored, each against all cells, and the
+    per-label means are weighted by the label sizes, which keeps the estimate unbiased.
+    """
+    if sample_size is None or sample_size >= len(labels):
+        return float(silhouette_samples(X, labels, metric=metric, chunk_size=chunk_size, n_jobs=n_jobs).mean())
+    codes, counts = _label_codes(labels, len(labels))
+    rng = np.random.default_rng(seed)
+    allocation = np.minimum(np.maximum(np.round(sample_size * counts / counts.sum()).astype(np.int64), 1), counts)
+    order = np.argsort(codes, kind="stable")
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    query_idx = np.concatenate([rng.choice(order[offsets[c]:offsets[c + 1]], allocation[c], replace=False)
+                                for c in range(len(counts))])
+    s = silhouette_samples(X, labels, query_idx, metric=metric, chunk_size=chunk_size, n_jobs=n_jobs)
+    label_means = np.bincount(codes[query_idx], weights=s, minlength=len(counts)) / allocation
+    return float((label_means * counts).sum() / counts.sum())
+
+
+def _centroids(X, codes, counts, chunk_size):
+    sums = np.zeros((len(counts), X.shape[1]))
+    for start in range(0, X.shape[0], chunk_size):
+        block = np.asarray(X[start:start + chunk_size], dtype=np.float64)
+        onehot = sp.csr_matrix((np.ones(block.shape[0]), (codes[start:start + block.shape[0]], np.arange(block.shape[0]))),
+                               shape=(len(counts), block.shape[0]))
+        sums += onehot @ block
+    return sums / counts[:, None]
+
+
+def _distances_to_centroids(X, codes, centroids, chunk_size):
+    # distance of every cell to the centroid of its label, block by block
+    distances = np.empty(X.shape[0])
+    for start in range(0, X.shape[0], chunk_size):
+        block = np.asarray(X[start:start + chunk_size], dtype=np.float64)
+        distances[start:start + block.shape[0]] = np.linalg.norm(block - centroids[codes[start:start + block.shape[0]]], axis=1)
+    return distances
+
+
+def calinski_harabasz_score(X, labels, chunk_size=65536):
+    codes, counts = _label_codes(labels, X.shape[0])
+    n, k = X.shape[0], len(counts)
+    centroids = _centroids(X, codes, counts, chunk_size)
+    mean = (centroids * counts[:, None]).sum(0) / n
+    extra_disp = float((counts * ((centroids - mean) ** 2).sum(1)).sum())
+    intra_disp = float((_distances_to_centroids(X, codes, centroids, chunk_size) ** 2).sum())
+    return 1.0 if intra_disp == 0.0 else extra_disp * (n - k) / (intra_disp * (k - 1.0))
+
+
+def davies_bouldin_score(X, labels, chunk_size=65536):
+    codes, counts = _label_codes(labels, X.shape[0])
+    centroids = _centroids(X, codes, counts, chunk_size)
+    intra_dists = np.bincount(codes, weights=_distances_to_centroids(X, codes, centroids, chunk_size)) / counts
+    centroid_distances = np.linalg.norm(centroids[:, None, :] - centroids[None, :, :], axis=2)
+    if np.allclose(intra_dists, 0) or np.allclose(centroid_distances, 0):
+        return 0.0
+    centroid_distances[centroid_distances == 0] = np.inf
+    return float(np.max((intra_dists[:, None] + intra_dists[None, :]) / centroid_distances, axis=1).mean())
+
+
+def compute_metrics_no_label(X, labels, sample_size=None, seed=0, metric="euclidean", n_jobs=1):
+    """Silhouette (ASW), Calinski-Harabasz (CH, higher is better) and Davies-Bouldin (DB, lower is better)"""
+    return {
+        "ASW": silhouette_score(X, labels, sample_size, seed, metric, n_jobs=n_jobs),
+        "CH": calinski_harabasz_score(X, labels),
+        "DB": davies_bouldin_score(X, labels),
+    }
+
+
+# batch-mixing metrics of an integrated embedding, sharing one kNN search
+def _kbet_acceptance(idx, codes, frequencies, alpha):
+    """Fraction of cells whose neighbourhood batch composition passes a chi-square test against the global one"""
+    n_codes = len(frequencies)
+    counts = np.bincount(np.repeat(np.arange(idx.shape[0]), idx.shape[1]) * n_codes + codes[idx].ravel(),
+                         minlength=idx.shape[0] * n_codes).reshape(idx.shape[0], n_codes)
+    expected = idx.shape[1] * frequencies
+    statistic = ((counts - expected) ** 2 / expected).sum(1)
+    p_values = chdtrc(n_codes - 1, statistic)
+    return float((p_values >= alpha).mean())
+
+
+def _lisi(distances, idx, codes, n_codes, perplexity, n_iter=50, tol=1e-5):
+    """
+    Inverse Simpson index of the codes of the neighbours, weighted by a gaussian kernel
+    whose bandwidth is calibrated to the perplexity, as in the lisi package; the binary
+    search on the bandwidth runs for all cells at once.
+    """
+    num_cells = distances.shape[0]
+    beta = np.ones(num_cells)
+    beta_min = np.full(num_cells, -np.inf)
+    beta_max = np.full(num_cells, np.inf)
+    log_u = np.log(perplexity)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for _ in range(n_iter):
+            P = np.exp(-distances * beta[:, None])
+            sum_p = P.sum(1)
+            entropy_diff = np.log(sum_p) + beta * (distances * P).sum(1) / sum_p - log_u
+            active = np.abs(entropy_diff) > tol
+            if not active.any():
+                break
+            up = active & (entropy_diff > 0)
+            beta_min[up] = beta[up]
+            beta[up] = np.where(np.isinf(beta_max[up]), beta[up] * 2, (beta[up] + beta_max[up]) / 2)
+            down = active & (entropy_diff <= 0)
+            beta_max[down] = beta[down]
+            beta[down] = np.where(np.isinf(beta_min[down]), beta[down] / 2, (beta[down] + beta_min[down]) / 2)
+
+        P = np.exp(-distances * beta[:, None])
+        sum_p = P.sum(1)
+        P /= sum_p[:, None]
+        flat = np.repeat(np.arange(num_cells), idx.shape[1]) * n_codes + codes[idx].ravel()
+        probabilities = np.bincount(flat, weights=P.ravel(), minlength=num_cells * n_codes).reshape(num_cells, n_codes)
+        return np.where(sum_p > 0, 1 / (probabilities ** 2).sum(1), np.nan)
+
+
+def lisi(X, labels, perplexity=30, knn=None, chunk_size=65536, n_jobs=1):
+    """
+    Per-cell LISI of labels (iLISI for batches, cLISI for cell types) on the 3 * perplexity
+    nearest neighbours. knn: (indices, euclidean distances) of a previous knn_search to reuse.
+    """
+    _, codes = np.unique(np.asarray(labels).ravel(), return_inverse=True)
+    codes = codes.ravel()
+    k = 3 * perplexity
+    if knn is None:
+        knn = knn_search(X, k, metric="euclidean", n_jobs=n_jobs)
+    idx, distances = knn[0][:, :k], knn[1][:, :k].astype(np.float64)
+    n_codes = codes.max() + 1
+
+    def run(start):
+        stop = start + chunk_size
+        return _lisi(distances[start:stop], idx[start:stop], codes, n_codes, perplexity)
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        return np.concatenate(list(executor.map(run, range(0, idx.shape[0], chunk_size))))
+
+
+def batch_asw(X, batch, labels=None, sample_size=None, seed=0, n_jobs=1):
+    """
+    1 - |silhouette| of the batches, within every cell type when labels are given
+    (averaged over the cell types present in more than one batch, as in scIB).
+    With sample_size, at most sample_size cells per cell type are scored.
+    """
+    batch = np.asarray(batch).ravel()
+    labels = np.zeros(len(batch)) if labels is None else np.asarray(labels).ravel()
+    rng = np.random.default_rng(seed)
+    scores = []
+    for label in np.unique(labels):
+        group = np.where(labels == label)[0]
+        n_batches = len(np.unique(batch[group]))
+        if n_batches < 2 or n_batches >= len(group):
+            continue
+        query_idx = None
+        if sample_size is not None and len(group) > sample_size:
+            query_idx = np.sort(rng.choice(len(group), sample_size, replace=False))
+        s = silhouette_samples(np.asarray(X)[group], batch[group], query_idx, n_jobs=n_jobs)
+        scores.append((1 - np.abs(s)).mean())
+    return float(np.mean(scores)) if scores else float("nan")
+
+
+def compute_batch_metrics(X, batch, labels=None, k=50, perplexity=30, alpha=0.05, sample_size=None, seed=0, n_jobs=1):
+    """
+    Batch-mixing metrics of an integrated embedding, from one chunked kNN search:
+    kBET acceptance rate (k neighbours, chi-square test at level alpha, higher is better mixing),
+    median iLISI (batches, higher is better mixing), median cLISI (cell types, lower is better
+    separation) and batch ASW (higher is better mixing).
+    sample_size: number of cells tested by kBET and scored per cell type by the batch ASW
+    """
+    batch = np.asarray(batch).ravel()
+    _, batch_codes = np.unique(batch, return_inverse=True)
+    batch_codes = batch_codes.ravel()
+    knn = knn_search(X, max(k, 3 * perplexity), metric="euclidean", n_jobs=n_jobs)
+
+    rng = np.random.default_rng(seed)
+    tested = np.arange(len(batch))
+    if sample_size is not None and sample_size < len(batch):
+        tested = np.sort(rng.choice(len(batch), sample_size, replace=False))
+    frequencies = np.bincount(batch_codes) / len(batch_codes)
+
+    metrics = {
+        "kBET": _kbet_acceptance(knn[0][tested, :k], batch_codes, frequencies, alpha),
+        "iLISI": float(np.nanmedian(lisi(X, batch, perplexity, knn, n_jobs=n_jobs))),
+    }
+    if labels is not None:
+        metrics["cLISI"] = float(np.nanmedian(lisi(X, labels, perplexity, knn, n_jobs=n_jobs)))
+    metrics["batch_ASW"] = batch_asw(X, batch, labels, sample_size, seed, n_jobs)
     return metrics
 
 
@@ -78,47 +559,25 @@ def compute_metrics(y_true, y_pred):
 # 1. Cluster accuracy (CA)
 def cluster_acc(y_true, y_pred):
     """
-    Calculate clustering accuracy. Require scikit-learn installed
+    Calculate clustering accuracy (Hungarian matching on the contingency table)
     # Arguments
         y: true labels, numpy.array with shape `(n_samples,)`
         y_pred: predicted labels, numpy.array with shape `(n_samples,)`
     # Return
         accuracy, in [0,1]
     """
-    if isinstance(y_true, pd.DataFrame):
-        y_true = y_true.values
-
-    if isinstance(y_pred, pd.DataFrame):
-        y_pred = y_pred.values
-
-    # CJY 2021.6.20 for batch effect dataset
-    #y_true = y_true.to_list()
-    y_pred = y_pred.astype(np.int64)
-
-    label_to_number = {label: number for number, label in enumerate(set(y_true))}
-    label_numerical = np.array([label_to_number[i] for i in y_true])
-
-    y_true = label_numerical.astype(np.int64)
-    assert y_pred.size == y_true.size
-    D = max(y_pred.max(), y_true.max()) + 1
-    w = np.zeros((D, D), dtype=np.int64)
-    for i in range(y_pred.size):
-        w[y_pred[i], y_true[i]] += 1
-    # from sklearn.utils.linear_assignment_ import linear_assignment
-    # ind = linear_assignment(w.max() - w)
-    # return sum([w[i, j] for i, j in ind]) * 1.0 / y_pred.size
-    # https://stackoverflow.com/questions/62390517/no-module-named-sklearn-utils-linear-assignment
-    from scipy.optimize import linear_sum_assignment as linear_assignment
-    row_ind, col_ind = linear_assignment(w.max() - w)
-    return sum([w[i, j] for i, j in zip(row_ind, col_ind)]) * 1.0 / y_pred.size
+    contingency = contingency_table(y_true, y_pred)
+    row_ind, col_ind = linear_assignment(contingency, maximize=True)
+    return contingency[row_ind, col_ind].sum() * 1.0 / contingency.sum()
 
 
 # 2. Jaccard score (JS)
 # Please refer to https://scikit-learn.org/stable/modules/generated/sklearn.metrics.jaccard_score.html
 def Jaccard_index(y_true, y_pred):
-    from sklearn.metrics.cluster import pair_confusion_matrix
-    contingency = pair_confusion_matrix(y_true, y_pred)
-    JI = contingency[1,1]/(contingency[1,1]+contingency[0,1]+contingency[1,0])
+    contingency = contingency_table(y_true, y_pred)
+    n = int(contingency.sum())
+    tn, fp, fn, tp = _pair_confusion(contingency, n, contingency.sum(1), contingency.sum(0))
+    JI = _jaccard(tp, fp, fn)
     return JI
 
 # 3. Homogeneity score.
@@ -138,9 +597,10 @@ if __name__=="__main__":
     #save_path = "/home/yanhan/cjy/Single-Cell-Dataset/Single-Cell-Cluster/result/"
     #root_path = r"C:\Users\cjy\Desktop\Seurat"
     #save_path = r"C:\Users\cjy\Desktop\"
-    if len(sys.argv) == 3:
+    if len(sys.argv) in [3, 4]:
         root_path = sys.argv[1]
         save_path = sys.argv[2]
-        traverse_folder_compute_metrics(root_path, save_path)
+        n_jobs = int(sys.argv[3]) if len(sys.argv) == 4 else None
+        traverse_folder_compute_metrics(root_path, save_path, n_jobs)
     else:
         raise Exception("Wrong Argv Num")
\ No newline at end of file
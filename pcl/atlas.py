@@ -0,0 +1,223 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from pcl.cluster import _merge_topk
+
+
+def _assign(X, centroids, chunk_size=65536):
+    # nearest centroid by euclidean distance, chunk by chunk
+    c_sqnorm = (centroids ** 2).sum(1)
+    labels = np.empty(X.shape[0], dtype=np.int64)
+    for start in range(0, X.shape[0], chunk_size):
+        block = X[start:start + chunk_size]
+        labels[start:start + block.shape[0]] = np.argmax(2 * block @ centroids.T - c_sqnorm[None, :], axis=1)
+    return labels
+
+
+def kmeans(X, k, n_iter=20, max_train=100000, seed=0):
+    """Lloyd k-means in numpy on at most max_train sampled rows, used to train the index"""
+    rng = np.random.RandomState(seed)
+    if X.shape[0] > max_train:
+        X = X[np.sort(rng.choice(X.shape[0], max_train, replace=False))]
+    X = np.asarray(X, dtype=np.float32)
+    k = min(k, X.shape[0])
+    centroids = X[rng.choice(X.shape[0], k, replace=False)].copy()
+    for it in range(n_iter):
+        labels = _assign(X, centroids)
+        counts = np.bincount(labels, minlength=k)
+        sums = sp.csr_matrix((np.ones(X.shape[0], dtype=np.float32), (labels, np.arange(X.shape[0]))),
+                             shape=(k, X.shape[0])) @ X
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # re-seed empty clusters on random points
+        centroids[empty] = X[rng.choice(X.shape[0], empty.sum())]
+    return centroids
+
+
+class ReferenceAtlas(object):
+    """
+    Reference cells embedded by CLEAR (encoder_k, L2-normalized) with an inverted-file
+    index for fast cosine kNN search and label transfer of query cells.
+
+    embeddings: [n, d] reference embeddings
+    obs: DataFrame of reference annotations (one row per reference cell)
+    n_lists: number of inverted lists (default: 4 * sqrt(n))
+    pq_m: number of product-quantization sub-vectors, 0 keeps the exact float32 vectors;
+          otherwise every cell is stored as pq_m uint8 codes (d must be divisible by pq_m)
+    """
+    def __init__(self, embeddings=None, obs=None, n_lists=None, pq_m=0, seed=0):
+        self.obs = obs
+        self.centroids = None
+        self.list_offsets = None
+        self.ids = None
+        self.vectors = None
+        self.codes = None
+        self.codebooks = None
+        if embeddings is not None:
+            self.build(embeddings, n_lists, pq_m, seed)
+
+    def build(self, embeddings, n_lists=None, pq_m=0, seed=0):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        n, d = embeddings.shape
+        if n_lists is None:
+            n_lists = max(1, int(4 * np.sqrt(n)))
+
+        # 1. coarse quantizer and inverted lists (cells sorted by list)
+        self.centroids = kmeans(embeddings, n_lists, seed=seed, max_train=max(100000, 64 * n_lists))
+        assign = _assign(embeddings, self.centroids)
+        self.ids = np.argsort(assign, kind="stable")
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=len(self.centroids)))])
+
+        # 2. stored vectors, exact or product-quantized
+        if pq_m > 0:
+            if d % pq_m != 0:
+                raise Exception("Embedding dimension {} is not divisible by pq_m={}".format(d, pq_m))
+            # encode the residuals to the list centroids (IVFADC), which are much smaller than the vectors
+            dsub = d // pq_m
+            sub = (embeddings - self.centroids[assign]).reshape(n, pq_m, dsub)
+            self.codebooks = np.stack([kmeans(sub[:, j], 256, seed=seed + j) for j in range(pq_m)])
+            self.codes = np.stack([_assign(sub[self.ids, j], self.codebooks[j]) for j in range(pq_m)],
+                                  axis=1).astype(np.uint8)
+            self.vectors = None
+        else:
+            self.vectors = embeddings[self.ids]
+            self.codes = None
+            self.codebooks = None
+        return self
+
+    @property
+    def num_cells(self):
+        return len(self.ids)
+
+    def _list_scores(self, query, list_id, coarse=None, table=None):
+        lo, hi = self.list_offsets[list_id], self.list_offsets[list_id + 1]
+        if self.codes is None:
+            return query @ self.vectors[lo:hi].T
+        # asymmetric distance: q.x = q.centroid + q.residual, the latter looked up per sub-vector
+        codes = self.codes[lo:hi]
+        scores = np.repeat(coarse[:, None], hi - lo, axis=1).astype(np.float32)
+        for j in range(codes.shape[1]):
+            scores += table[:, j, codes[:, j]]
+        return scores
+
+    def search(self, query, k=15, n_probe=16):
+        """Top-k reference cells (indices into obs) and cosine similarities of a query block"""
+        query = np.asarray(query, dtype=np.float32)
+        n_query = query.shape[0]
+        n_probe = min(n_probe, len(self.centroids))
+        coarse = query @ self.centroids.T
+        probes = np.argpartition(-coarse, n_probe - 1, axis=1)[:, :n_probe]
+
+        table = None
+        if self.codes is not None:
+            m, _, dsub = self.codebooks.shape
+            table = np.einsum("qmd,mcd->qmc", query.reshape(n_query, m, dsub), self.codebooks)
+
+        best_val = np.full((n_query, k), -np.inf, dtype=np.float32)
+        best_idx = np.full((n_query, k), -1, dtype=np.int64)
+        # scan list by list, every list is compared to all the queries probing it at once;
+        # the queries are grouped by list once, a query probes a list at most once
+        flat = probes.ravel()
+        by_list = np.argsort(flat, kind="stable") // n_probe
+        query_offsets = np.concatenate(([0], np.cumsum(np.bincount(flat, minlength=len(self.centroids)))))
+        for list_id in np.flatnonzero(np.diff(query_offsets)):
+            rows = by_list[query_offsets[list_id]:query_offsets[list_id + 1]]
+            lo, hi = self.list_offsets[list_id], self.list_offsets[list_id + 1]
+            if hi == lo:
+                continue
+            if table is None:
+                scores = self._list_scores(query[rows], list_id)
+            else:
+                scores = self._list_scores(query[rows], list_id, coarse[rows, list_id], table[rows])
+            kk = min(k, hi - lo)
+            part = np.argpartition(-scores, kk - 1, axis=1)[:, :kk]
+            val = np.take_along_axis(scores, part, axis=1).astype(np.float32)
+            best_val[rows], best_idx[rows] = _merge_topk(best_val[rows], best_idx[rows], val, self.ids[lo + part], k)
+
+        order = np.argsort(-best_val, axis=1)
+        return np.take_along_axis(best_idx, order, axis=1), np.take_along_axis(best_val, order, axis=1)
+
+    def transfer_labels(self, idx, sim, columns):
+        """Similarity-weighted majority vote of the neighbours' obs labels"""
+        labels = pd.DataFrame(index=np.arange(idx.shape[0]))
+        valid = idx >= 0
+        weights = np.where(valid, np.clip(sim, 0, None) + 1e-6, 0)
+        for column in columns:
+            codes, categories = pd.factorize(self.obs[column].values)
+            neighbour_codes = np.where(valid, codes[np.where(valid, idx, 0)], -1)
+            # the last column collects the missing neighbours (code -1)
+            num_columns = len(categories) + 1
+            flat = np.repeat(np.arange(idx.shape[0]), idx.shape[1]) * num_columns + neighbour_codes.ravel() % num_columns
+            votes = np.bincount(flat, weights=weights.ravel(), minlength=idx.shape[0] * num_columns)
+            votes = votes.reshape(idx.shape[0], num_columns)[:, :-1]
+            best = votes.argmax(1)
+            labels[column] = np.asarray(categories)[best]
+            labels[column + "_confidence"] = votes[np.arange(len(best)), best] / np.maximum(votes.sum(1), 1e-12)
+        return labels
+
+    def annotate(self, query, columns, k=15, n_probe=16, batch_size=4096):
+        """
+        Yield (start, stop, neighbour indices, similarities, transferred labels) for
+        consecutive batches of query embeddings
+        """
+        for start in range(0, query.shape[0], batch_size):
+            stop = min(start + batch_size, query.shape[0])
+            idx, sim = self.search(query[start:stop], k, n_probe)
+            labels = self.transfer_labels(idx, sim, columns)
+            labels.index = np.arange(start, stop)
+            yield start, stop, idx, sim, labels
+
+    def save(self, save_dir):
+        if os.path.exists(save_dir) != True:
+            os.makedirs(save_dir)
+        arrays = {"centroids": self.centroids, "list_offsets": self.list_offsets, "ids": self.ids}
+        if self.codes is not None:
+            arrays.update(codes=self.codes, codebooks=self.codebooks)
+        else:
+            arrays.update(vectors=self.vectors)
+        for name, array in arrays.items():
+            np.save(os.path.join(save_dir, name + ".npy"), array)
+        if self.obs is not None:
+            self.obs.to_csv(os.path.join(save_dir, "obs.csv"))
+        with open(os.path.join(save_dir, "atlas.json"), "w") as f:
+            json.dump({"num_cells": int(self.num_cells), "n_lists": int(len(self.centroids)),
+                       "pq_m": 0 if self.codes is None else int(self.codes.shape[1])}, f)
+
+    @classmethod
+    def load(cls, save_dir, mmap=True):
+        atlas = cls()
+        mmap_mode = "r" if mmap else None
+
+        def load_array(name):
+            return np.load(os.path.join(save_dir, name + ".npy"), mmap_mode=mmap_mode)
+
+        # with mmap, the stored vectors/codes stay on disk and only the probed lists are paged in
+        atlas.centroids = load_array("centroids")
+        atlas.list_offsets = load_array("list_offsets")
+        atlas.ids = load_array("ids")
+        if os.path.exists(os.path.join(save_dir, "codes.npy")):
+            atlas.codes = load_array("codes")
+            atlas.codebooks = load_array("codebooks")
+        else:
+            atlas.vectors = load_array("vectors")
+        obs_path = os.path.join(save_dir, "obs.csv")
+        if os.path.exists(obs_path):
+            atlas.obs = pd.read_csv(obs_path, index_col=0)
+        return atlas
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint_path, h5ad_path, label_columns=None, n_lists=None, pq_m=0,
+                        chunk_size=8192, seed=0):
+        """Embed a reference h5ad with a trained CLEAR model and index it"""
+        import anndata
+        from pcl.embed import iter_embeddings
+
+        embeddings = np.concatenate([feat for _, _, feat in iter_embeddings(checkpoint_path, h5ad_path, chunk_size)])
+        obs = anndata.read_h5ad(h5ad_path, backed="r").obs
+        if label_columns is not None:
+            obs = obs[label_columns]
+        return cls(embeddings, obs.copy(), n_lists=n_lists, pq_m=pq_m, seed=seed)
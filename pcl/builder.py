@@ -2,7 +2,6 @@ import torch
 import torch.nn as nn
 from random import sample
 from torch.nn.modules.linear import Linear
-import torchvision.models as models
 import math
 import torch.nn.functional as F
 from torch.nn.parameter import Parameter
@@ -0,0 +1,112 @@
+import numpy as np
+import scipy.sparse as sp
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _merge_topk(best_val, best_idx, val, idx, k):
+    # keep the k largest values of the concatenation, row by row
+    val = np.concatenate([best_val, val], axis=1)
+    idx = np.concatenate([best_idx, idx], axis=1)
+    part = np.argpartition(-val, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(val, part, axis=1), np.take_along_axis(idx, part, axis=1)
+
+
+def _block_topk(query, X, X_sqnorm, k, metric, ref_chunk_size):
+    """Top-k similarities of one query block against X, scanning X by blocks of ref_chunk_size rows"""
+    n_query = query.shape[0]
+    best_val = np.full((n_query, 0), -np.inf, dtype=np.float32)
+    best_idx = np.zeros((n_query, 0), dtype=np.int64)
+    for start in range(0, X.shape[0], ref_chunk_size):
+        ref = X[start:start + ref_chunk_size]
+        sim = query @ ref.T
+        if metric == "euclidean":
+            # negative squared distance, so that larger is closer
+            sim = 2 * sim - X_sqnorm[start:start + ref.shape[0]][None, :] - (query ** 2).sum(1)[:, None]
+        kk = min(k, sim.shape[1])
+        part = np.argpartition(-sim, kk - 1, axis=1)[:, :kk]
+        val = np.take_along_axis(sim, part, axis=1).astype(np.float32)
+        best_val, best_idx = _merge_topk(best_val, best_idx, val, part + start, min(k, best_val.shape[1] + kk))
+    order = np.argsort(-best_val, axis=1)
+    return np.take_along_axis(best_val, order, axis=1), np.take_along_axis(best_idx, order, axis=1)
+
+
+def knn_search(X, k=15, query=None, metric="cosine", chunk_size=1024, ref_chunk_size=65536, n_jobs=1):
+    """
+    Exact k nearest neighbours computed block by block, so memory stays at
+    chunk_size x ref_chunk_size similarities whatever the number of cells.
+    X: reference embeddings [n, d]; query: [m, d], defaults to X (self matches are removed)
+    metric: "cosine" (inputs are expected to be L2-normalized, e.g. CLEAR embeddings) or "euclidean"
+    Return: neighbour indices [m, k] and similarities [m, k] (cosine) or distances [m, k] (euclidean)
+    """
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    self_query = query is None
+    query = X if self_query else np.ascontiguousarray(query, dtype=np.float32)
+    k_search = min(k + 1 if self_query else k, X.shape[0])
+    X_sqnorm = (X ** 2).sum(1) if metric == "euclidean" else None
+
+    def run(start):
+        val, idx = _block_topk(query[start:start + chunk_size], X, X_sqnorm, k_search, metric, ref_chunk_size)
+        if self_query:
+            # drop the cell itself, or the last neighbour if a duplicate ranked first
+            rows = np.arange(idx.shape[0])
+            is_self = idx == (rows + start)[:, None]
+            is_self[~is_self.any(1), -1] = True
+            keep = ~is_self
+            val = val[keep].reshape(idx.shape[0], -1)
+            idx = idx[keep].reshape(idx.shape[0], -1)
+        return val, idx
+
+    starts = range(0, query.shape[0], chunk_size)
+    # numpy matmul releases the GIL, threads are enough to use all cores
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        results = list(executor.map(run, starts))
+    val = np.concatenate([r[0] for r in results], axis=0)
+    idx = np.concatenate([r[1] for r in results], axis=0)
+    if metric == "euclidean":
+        val = np.sqrt(np.maximum(-val, 0))
+    return idx, val
+
+
+def knn_graph(embeddings, k=15, chunk_size=1024, n_jobs=1):
+    """
+    Symmetric kNN graph of L2-normalized embeddings as a CSR matrix,
+    edge weights are the (non-negative) cosine similarities.
+    """
+    n = embeddings.shape[0]
+    idx, sim = knn_search(embeddings, k, metric="cosine", chunk_size=chunk_size, n_jobs=n_jobs)
+    rows = np.repeat(np.arange(n), idx.shape[1])
+    graph = sp.csr_matrix((np.clip(sim.ravel(), 1e-6, None), (rows, idx.ravel())), shape=(n, n))
+    # an edge exists if either end has the other as neighbour
+    graph = graph.maximum(graph.T).tocsr()
+    return graph
+
+
+def graph_to_igraph(graph):
+    import igraph as ig
+
+    upper = sp.triu(graph, k=1).tocoo()
+    # numpy arrays straight to igraph, no intermediate Python list of tuples
+    g = ig.Graph(n=graph.shape[0], edges=np.column_stack((upper.row, upper.col)), directed=False)
+    g.es["weight"] = upper.data.astype(np.float64)
+    return g
+
+
+def graph_clustering(graph, method="leiden", resolution=1.0, seed=0):
+    """
+    Community detection on a kNN graph.
+    graph: CSR adjacency from knn_graph, or an igraph.Graph built by graph_to_igraph
+           (pass the latter to reuse it across resolutions)
+    method: "leiden" or "louvain"
+    """
+    if sp.issparse(graph):
+        graph = graph_to_igraph(graph)
+    if method == "leiden":
+        import leidenalg
+        partition = leidenalg.find_partition(graph, leidenalg.RBConfigurationVertexPartition,
+                                             weights="weight", resolution_parameter=resolution, seed=seed)
+        membership = partition.membership
+    elif method == "louvain":
+        membership = graph.community_multilevel(weights="weight", resolution=resolution).membership
+    else:
+        raise Exception("Unknown graph clustering method: {}".format(method))
+    return np.array(membership, dtype=np.int64)
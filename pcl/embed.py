@@ -0,0 +1,187 @@
+import numpy as np
+import torch
+import torch.nn as nn
+import h5py
+
+from pcl.builder import MLPEncoder
+from pcl.loader import apply_scaling, get_scaling
+
+
+def load_encoder(checkpoint_path, device="cpu"):
+    """
+    Build the key encoder (encoder_k) of a trained MoCo from a CLEAR checkpoint.
+    Return: encoder in eval mode, gene names of the training data (None for old checkpoints)
+    """
+    checkpoint = torch.load(checkpoint_path, map_location="cpu")
+    state_dict = checkpoint["state_dict"] if "state_dict" in checkpoint else checkpoint
+
+    prefix = "encoder_k."
+    encoder_state = {k[len(prefix):]: v for k, v in state_dict.items() if k.startswith(prefix)}
+    num_genes = encoder_state["encoder.0.0.weight"].shape[1]
+    num_hiddens = encoder_state["encoder.1.0.weight"].shape[0]
+
+    encoder = MLPEncoder(num_genes=num_genes, num_hiddens=num_hiddens)
+    encoder.load_state_dict(encoder_state)
+    encoder = encoder.to(device).eval()
+    return encoder, checkpoint.get("var_names")
+
+
+def read_h5ad_var_names(h5ad_path):
+    with h5py.File(h5ad_path, "r") as f:
+        var = f["var"]
+        index = var[var.attrs.get("_index", "_index")][:]
+    return [v.decode() if isinstance(v, bytes) else str(v) for v in index]
+
+
+def read_h5ad_scaling(h5ad_path):
+    """pcl.loader.get_scaling read from the file, without loading the AnnData"""
+    with h5py.File(h5ad_path, "r") as f:
+        var = f["var"]
+        if "scale_mean" not in var or "scale_std" not in var:
+            return None
+        scale = f["uns/scale"] if "uns/scale" in f else {}
+        max_value = scale["max_value"][()] if "max_value" in scale else None
+        zero_center = bool(scale["zero_center"][()]) if "zero_center" in scale else True
+        return {
+            "mean": var["scale_mean"][:].astype(np.float64),
+            "std": var["scale_std"][:].astype(np.float64),
+            "max_value": None if max_value is None else float(max_value),
+            "zero_center": zero_center,
+        }
+
+
+def iter_h5ad_rows(h5ad_path, chunk_size=8192):
+    """
+    Yield (start, stop, dense float32 block) of X by reading row blocks from the file,
+    so only one block is in memory. X can be dense or CSR.
+    """
+    with h5py.File(h5ad_path, "r") as f:
+        X = f["X"]
+        if isinstance(X, h5py.Dataset):
+            num_cells = X.shape[0]
+            for start in range(0, num_cells, chunk_size):
+                stop = min(start + chunk_size, num_cells)
+                yield start, stop, np.asarray(X[start:stop], dtype=np.float32)
+        else:
+            encoding = X.attrs.get("encoding-type", X.attrs.get("h5sparse_format", ""))
+            if isinstance(encoding, bytes):
+                encoding = encoding.decode()
+            if encoding not in ("csr_matrix", "csr"):
+                raise Exception("Only dense or CSR X can be streamed, found {}".format(encoding))
+            num_cells, num_genes = X.attrs.get("shape", X.attrs.get("h5sparse_shape"))
+            indptr = X["indptr"][:]
+            data, indices = X["data"], X["indices"]
+            for start in range(0, num_cells, chunk_size):
+                stop = min(start + chunk_size, num_cells)
+                lo, hi = indptr[start], indptr[stop]
+                block = np.zeros((stop - start, num_genes), dtype=np.float32)
+                rows = np.repeat(np.arange(stop - start), np.diff(indptr[start:stop + 1]))
+                block[rows, indices[lo:hi]] = data[lo:hi]
+                yield start, stop, block
+
+
+def iter_adata_rows(adata, chunk_size=8192):
+    """Same as iter_h5ad_rows for an AnnData already in memory"""
+    num_cells = adata.shape[0]
+    for start in range(0, num_cells, chunk_size):
+        stop = min(start + chunk_size, num_cells)
+        block = adata.X[start:stop]
+        if not isinstance(block, np.ndarray):
+            block = block.toarray()
+        yield start, stop, np.asarray(block, dtype=np.float32)
+
+
+# torch.inference_mode only exists from torch 1.9
+inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+
+
+def _encode_block(encoder, block, device, scaling=None):
+    if scaling is not None:
+        block = apply_scaling(block, scaling)
+    elif not isinstance(block, np.ndarray):
+        block = block.toarray()
+    x = torch.from_numpy(np.ascontiguousarray(block, dtype=np.float32)).to(device, non_blocking=True)
+    # entered per block, so the mode never leaks into the caller of a suspended generator
+    with inference_mode():
+        feat = nn.functional.normalize(encoder(x), dim=1)
+    return feat.cpu().numpy()
+
+
+def embed_array(encoder, X, batch_size=8192, device=None, out=None, scaling=None):
+    """
+    L2-normalized encoder outputs of all rows of X, computed on large contiguous row
+    blocks and written into one preallocated [num_cells, dim] array.
+    X: numpy array, np.memmap or scipy sparse matrix
+    out: optional preallocated output (e.g. a memmap); allocated on the first block otherwise
+    scaling: deferred scaling of X (pcl.loader.get_scaling), applied block by block
+    """
+    if device is None:
+        device = next(encoder.parameters()).device
+    encoder.eval()
+    num_cells = X.shape[0]
+    for start in range(0, num_cells, batch_size):
+        stop = min(start + batch_size, num_cells)
+        feat = _encode_block(encoder, X[start:stop], device, scaling)
+        if out is None:
+            out = np.empty((num_cells, feat.shape[1]), dtype=np.float32)
+        out[start:stop] = feat
+    return out
+
+
+def iter_embeddings(checkpoint_path, h5ad_path, chunk_size=8192, backed=True, device=None, quantized=False):
+    """
+    Yield (start, stop, embeddings) of the cells of an h5ad file, chunk by chunk.
+    Embeddings are the L2-normalized encoder_k outputs, as CLEAR.inference computes them.
+    backed: stream X from the file; otherwise the whole AnnData is loaded first
+    quantized: checkpoint_path is an int8 artifact of pcl.quantize (CPU only)
+    """
+    if quantized:
+        from pcl.quantize import load_quantized_encoder
+        device = "cpu"
+        encoder, var_names = load_quantized_encoder(checkpoint_path)
+    else:
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        encoder, var_names = load_encoder(checkpoint_path, device)
+
+    if backed:
+        if var_names is not None and read_h5ad_var_names(h5ad_path) != list(var_names):
+            raise Exception("Genes of {} do not match the genes of the checkpoint".format(h5ad_path))
+        scaling = read_h5ad_scaling(h5ad_path)
+        blocks = iter_h5ad_rows(h5ad_path, chunk_size)
+    else:
+        import anndata
+        adata = anndata.read_h5ad(h5ad_path)
+        if var_names is not None and list(adata.var_names) != list(var_names):
+            raise Exception("Genes of {} do not match the genes of the checkpoint".format(h5ad_path))
+        scaling = get_scaling(adata)
+        blocks = iter_adata_rows(adata, chunk_size)
+
+    for start, stop, block in blocks:
+        yield start, stop, _encode_block(encoder, block, device, scaling)
+
+
+def embed_to_memmap(checkpoint_path, h5ad_path, out_path, chunk_size=8192, backed=True, device=None,
+                    quantized=False):
+    """
+    Write the embeddings of all cells of an h5ad file into a memory-mapped .npy file,
+    one chunk at a time. Return: the memory-mapped array
+    """
+    out = None
+    for start, stop, feat in iter_embeddings(checkpoint_path, h5ad_path, chunk_size, backed, device, quantized):
+        if out is None:
+            num_cells = _num_cells(h5ad_path)
+            out = np.lib.format.open_memmap(out_path, mode="w+", dtype=np.float32,
+                                            shape=(num_cells, feat.shape[1]))
+        out[start:stop] = feat
+    if out is not None:
+        out.flush()
+    return out
+
+
+def _num_cells(h5ad_path):
+    with h5py.File(h5ad_path, "r") as f:
+        X = f["X"]
+        if isinstance(X, h5py.Dataset):
+            return X.shape[0]
+        return int(X.attrs.get("shape", X.attrs.get("h5sparse_shape"))[0])
@@ -1,14 +1,106 @@
-from PIL import ImageFilter
-import random
-from anndata._core.anndata import AnnData
-import torchvision.datasets as datasets
+from typing import TYPE_CHECKING
 from torch.utils.data import Dataset
-import scanpy as sc
 import torch
 from copy import deepcopy
 import numpy as np
-import pandas as pd
 
+if TYPE_CHECKING:
+    # only needed for the annotation, anndata is slow to import
+    from anndata import AnnData
+
+
+def get_scaling(adata):
+    """
+    Deferred scaling stored by preprocess/generate_h5ad.py --scale --defer_scale:
+    per-gene mean/std in adata.var and the clip value in adata.uns["scale"].
+    Return: dict(mean, std, max_value, zero_center), None if X is used as stored
+    """
+    if "scale_mean" not in adata.var or "scale_std" not in adata.var:
+        return None
+    scale = adata.uns.get("scale", {})
+    return {
+        "mean": np.asarray(adata.var["scale_mean"], dtype=np.float64),
+        "std": np.asarray(adata.var["scale_std"], dtype=np.float64),
+        "max_value": scale.get("max_value"),
+        "zero_center": bool(scale.get("zero_center", True)),
+    }
+
+
+def apply_scaling(block, scaling, columns=None):
+    """
+    Dense float32 copy of a row block (numpy or scipy sparse) scaled as sc.pp.scale does:
+    (x - mean) / std, then clipped to max_value (on both sides when zero centered).
+    columns: genes of the block when it holds a subset of the genes
+    """
+    # sc.pp.scale densifies sparse data to float64 and works in place on dense data
+    if hasattr(block, "toarray"):
+        block = block.toarray().astype(np.float64)
+    else:
+        block = np.array(block, dtype=np.result_type(block.dtype, np.float32))
+    mean, std = scaling["mean"], scaling["std"]
+    if columns is not None:
+        mean, std = mean[columns], std[columns]
+    if scaling["zero_center"]:
+        np.subtract(block, mean, out=block, casting="same_kind")
+    np.divide(block, std, out=block, casting="same_kind")
+    if scaling["max_value"] is not None:
+        lower = -scaling["max_value"] if scaling["zero_center"] else None
+        np.clip(block, lower, scaling["max_value"], out=block)
+    return block.astype(np.float32, copy=False)
+
+
+class ScaledRows(object):
+    """
+    Read-only view of a CSR matrix whose rows are scaled when indexed, used as the
+    augmentation pool of scRNAMatrixInstance without densifying the whole matrix.
+    Every read returns a new scaled copy, so what instance_crossover writes into the row it takes
+    is dropped: unlike the dense pool (--scale), the pool does not drift from X during training,
+    and memory stays at the sparse X whatever the number of epochs.
+    """
+    def __init__(self, X, scaling):
+        self.X = X
+        self.scaling = scaling
+
+    def __len__(self):
+        return self.X.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            # element-wise (cells, genes) pairs, as in tf_idf_based_replacement
+            rows, columns = key
+            columns = np.flatnonzero(columns) if np.asarray(columns).dtype == bool else np.asarray(columns)
+            values = np.asarray(self.X[rows, columns], dtype=np.float64).reshape(1, -1)
+            return apply_scaling(values, self.scaling, columns)[0]
+        block = apply_scaling(self.X[key], self.scaling)
+        return block[0] if np.ndim(key) == 0 else block
+
+
+class OverwrittenRows(object):
+    """
+    Augmentation pool over read-only rows (an array shared between processes or ScaledRows).
+    A row is copied when it is taken (by instance_crossover, which writes into it) and later reads see
+    the copy, so the pool behaves as a private copy of the rows while only the rows taken are stored.
+    """
+    def __init__(self, rows):
+        self.rows = rows
+        self.overwrites = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            # element-wise (cells, genes) pairs, as in tf_idf_based_replacement
+            rows, columns = key
+            columns = np.flatnonzero(columns) if np.asarray(columns).dtype == bool else np.asarray(columns)
+            values = np.array(self.rows[rows, columns])
+            for i in np.flatnonzero([row in self.overwrites for row in np.asarray(rows).tolist()]):
+                values[i] = self.overwrites[int(rows[i])][columns[i]]
+            return values
+        key = int(key)
+        if key not in self.overwrites:
+            self.overwrites[key] = np.array(self.rows[key])
+        return self.overwrites[key]
 
 
 class TwoCropsTransform:
@@ -23,33 +115,12 @@ class TwoCropsTransform:
         return [q, k]
 
 
-class GaussianBlur(object):
-    """Gaussian blur augmentation in SimCLR https://arxiv.org/abs/2002.05709"""
-
-    def __init__(self, sigma=[.1, 2.]):
-        self.sigma = sigma
-
-    def __call__(self, x):
-        sigma = random.uniform(self.sigma[0], self.sigma[1])
-        x = x.filter(ImageFilter.GaussianBlur(radius=sigma))
-        return x
-    
-
-class ImageFolderInstance(datasets.ImageFolder):
-    def __getitem__(self, index):
-        path, target = self.samples[index]
-        sample = self.loader(path)
-        if self.transform is not None:
-            sample = self.transform(sample)           
-        return sample, index
-
-
 
 
 
 class scRNAMatrixInstance(Dataset):
     def __init__(self,
-                 adata: AnnData = None,
+                 adata: "AnnData" = None,
                  obs_label_colname: str = "x",
                  transform: bool = False,
                  args_transformation: dict = {}
@@ -61,7 +132,12 @@ class scRNAMatrixInstance(Dataset):
 
         # data
         # scipy.sparse.csr.csr_matrix or numpy.ndarray
-        if isinstance(self.adata.X, np.ndarray):
+        # with deferred scaling, X stays sparse and rows are scaled when a sample is assembled
+        self.scaling = get_scaling(self.adata)
+        if self.scaling is not None:
+            import scipy.sparse as sp
+            self.data = sp.csr_matrix(self.adata.X)
+        elif isinstance(self.adata.X, np.ndarray):
             self.data = self.adata.X
         else:
             self.data = self.adata.X.toarray()
@@ -81,7 +157,18 @@ class scRNAMatrixInstance(Dataset):
         self.num_cells, self.num_genes = self.adata.shape
         self.args_transformation = args_transformation
         
-        self.dataset_for_transform = deepcopy(self.data)
+        # crossover writes into the pool, so only pay for it when augmenting
+        if not self.transform:
+            self.dataset_for_transform = None
+        elif self.scaling is not None:
+            # the crossover writes into scaled copies, which are not kept (see ScaledRows)
+            self.dataset_for_transform = ScaledRows(self.data, self.scaling)
+        elif not self.data.flags.writeable:
+            # shared between processes (CLEAR_sweep.py): rows are copied when the crossover takes them,
+            # so the pool grows with the rows taken, up to a full copy in long runs
+            self.dataset_for_transform = OverwrittenRows(self.data)
+        else:
+            self.dataset_for_transform = deepcopy(self.data)
 
         
     def RandomTransform(self, sample):
@@ -111,7 +198,10 @@ class scRNAMatrixInstance(Dataset):
 
     def __getitem__(self, index):
         
-        sample = self.data[index]
+        if self.scaling is not None:
+            sample = apply_scaling(self.data[index], self.scaling)[0]
+        else:
+            sample = self.data[index]
 
         if self.label is not None:
             label = self.label_encoder[self.label[index]]
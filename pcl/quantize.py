@@ -0,0 +1,28 @@
+import copy
+import json
+
+import torch
+import torch.nn as nn
+
+
+def quantize_encoder(encoder):
+    """Post-training dynamic int8 quantization of the Linear layers of an MLPEncoder (CPU only)"""
+    encoder = copy.deepcopy(encoder).cpu().eval()
+    return torch.quantization.quantize_dynamic(encoder, {nn.Linear}, dtype=torch.qint8)
+
+
+def save_quantized_encoder(qencoder, path, num_genes, var_names=None):
+    """
+    Serialize the quantized encoder as a self-contained TorchScript artifact,
+    loadable without the pcl code; the training gene names are stored alongside.
+    """
+    traced = torch.jit.trace(qencoder, torch.zeros(1, num_genes))
+    extra_files = {"var_names.json": json.dumps(None if var_names is None else list(var_names))}
+    torch.jit.save(traced, path, _extra_files=extra_files)
+
+
+def load_quantized_encoder(path):
+    """Return: quantized encoder, gene names of the training data (or None)"""
+    extra_files = {"var_names.json": ""}
+    qencoder = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+    return qencoder.eval(), json.loads(extra_files["var_names.json"])
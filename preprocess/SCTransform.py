@@ -1,11 +1,10 @@
 import statsmodels.nonparametric.kernel_regression
 from KDEpy import FFTKDE
-from multiprocessing import Pool, Manager, get_context
+from multiprocessing import get_context, shared_memory
 from scipy import stats
 import numpy as np
 import os
 import pandas as pd
-import statsmodels.discrete.discrete_model
 from anndata import AnnData
 import scipy as sp
 
@@ -35,28 +34,63 @@ def is_outlier(y, x, th = 10):
     return np.abs(np.vstack((score1,score2))).min(0)>th
   
     
-def _parallel_init(igenes_bin_regress,iumi_bin,ign,imm,ips):
-    global genes_bin_regress
-    global umi_bin
-    global gn
-    global mm
-    global ps
-    genes_bin_regress = igenes_bin_regress
-    umi_bin = iumi_bin
-    gn = ign
-    mm = imm 
-    ps = ips
-    
-def _parallel_wrapper(j):
-    name = gn[genes_bin_regress[j]]
-    y = umi_bin[:,j].A.flatten()
-    pr = statsmodels.discrete.discrete_model.Poisson(y,mm)
-    res = pr.fit(disp=False)
-    mu = res.predict()
-    theta = theta_ml(y,mu)
-    ps[name] = np.append(res.params,theta)  
-    
-    
+def _share(array):
+    # copy an array into a new shared memory block, return the block and what a worker needs to attach to it
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+def _attach(spec):
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def _parallel_init(ispecs):
+    # the workers attach once to the counts (csc) and the model matrix, and keep them for all the gene ranges
+    global shared
+    shared = {key: _attach(spec) for key, spec in ispecs.items()}
+
+def _parallel_wrapper(gene_range):
+    start, stop = gene_range
+    data, indices, indptr, mm = [shared[key][1] for key in ['data','indices','indptr','mm']]
+    # the fitted means are dense [cells, genes] blocks of about 2**22 values
+    step = max(1, 2**22 // mm.shape[0])
+    params = []
+    for lo in range(start, stop, step):
+        hi = min(lo + step, stop)
+        Y = sp.sparse.csc_matrix((data[indptr[lo]:indptr[hi]], indices[indptr[lo]:indptr[hi]], indptr[lo:hi+1] - indptr[lo]),
+                                 shape=(mm.shape[0], hi - lo))
+        coefs, Mu = poisson_irls(Y, mm)
+        params.append(np.column_stack((coefs, theta_ml_batched(Y, Mu))))
+    return np.vstack(params)
+
+def fit_step1(umi, mm, bin_size=500, n_jobs=None):
+    """
+    Poisson regression of each gene (column of umi) on the model matrix mm, and theta of the negative binomial
+    (poisson_irls and theta_ml_batched). One pool of n_jobs workers, attached to umi and mm through shared memory,
+    fits ranges of at most bin_size genes.
+    Return: [genes, 3] Intercept, log_umi and theta
+    """
+    n_jobs = os.cpu_count() if n_jobs is None else n_jobs
+    umi = sp.sparse.csc_matrix(umi)
+    num_genes = umi.shape[1]
+    # several ranges per worker to balance the load
+    step = max(1, min(bin_size, -(-num_genes // (4 * n_jobs))))
+    gene_ranges = [(start, min(start + step, num_genes)) for start in range(0, num_genes, step)]
+
+    blocks, specs = [], {}
+    try:
+        for key, array in [('data',umi.data),('indices',umi.indices),('indptr',umi.indptr),('mm',np.ascontiguousarray(mm))]:
+            shm, specs[key] = _share(array)
+            blocks.append(shm)
+        with get_context("spawn").Pool(n_jobs, _parallel_init, [specs]) as pool:
+            params = pool.map(_parallel_wrapper, gene_ranges, chunksize=1)
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+    return np.vstack(params) if len(params) > 0 else np.zeros((0, 3))
+
 def gmean(X,axis=0,eps=1):
     X=X.copy()
     X.data[:] = np.log(X.data+eps)       
@@ -89,7 +123,88 @@ def theta_ml(y,mu):
     
     return t0
 
-def SCTransform(adata,min_cells=0,gmean_eps=1,n_genes=2000,n_cells=None,bin_size=500,bw_adjust=3,inplace=True):
+def poisson_irls(Y, mm, maxiter=35, tol=1e-8):
+    """
+    Poisson regression (log link) of every column of Y [cells, genes] on the model matrix mm = (1, x),
+    all genes at once: Newton (IRLS) steps solved in closed form, from the start of statsmodels Poisson.fit.
+    Return: [genes, 2] coefficients, [cells, genes] fitted means
+    """
+    Y = sp.sparse.csc_matrix(Y)
+    x = mm[:,1]
+    # the counts only enter the gradient through their sums
+    y0, y1 = np.asarray(Y.sum(0), dtype=np.float64).flatten(), Y.T @ x
+    beta = np.vstack((np.log(np.maximum(y0 / Y.shape[0], _EPS)), np.full(Y.shape[1], 0.001)))
+    active = np.arange(Y.shape[1])
+    for it in range(maxiter):
+        Mu = np.exp(beta[0,active] + np.outer(x, beta[1,active]))
+        # gradient and Hessian of the log likelihood, 2x2 per gene
+        g0, g1 = y0[active] - Mu.sum(0), y1[active] - x @ Mu
+        h00, h01, h11 = Mu.sum(0), x @ Mu, (x*x) @ Mu
+        det = h00*h11 - h01**2
+        d0 = (h11*g0 - h01*g1) / det
+        d1 = (h00*g1 - h01*g0) / det
+        beta[0,active] += d0
+        beta[1,active] += d1
+        active = active[np.maximum(np.abs(d0), np.abs(d1)) > tol]
+        if active.size == 0:
+            break
+    return beta.T, np.exp(beta[0] + np.outer(x, beta[1]))
+
+def theta_ml_batched(Y, Mu, limit=10):
+    """
+    theta_ml of every column of Y [cells, genes] and the fitted means Mu, the Newton steps run on all genes at once.
+    The digamma and trigamma terms vanish where y = 0 and only depend on (gene, y), so they are evaluated once
+    per distinct count of each gene.
+    """
+    from scipy.special import psi, zeta
+    def trigamma(x):
+        # polygamma(1, x), without the digamma polygamma also evaluates
+        return zeta(2, x)
+
+    Y = sp.sparse.csc_matrix(Y)
+    n, num_genes = Y.shape
+    eps = (_EPS)**0.25
+    cols = np.repeat(np.arange(num_genes), np.diff(Y.indptr))
+    y = Y.data.astype(np.float64)
+    mu = Mu[Y.indices, cols]
+    order = np.lexsort((y, cols))
+    first = np.ones(y.size, dtype=bool)
+    first[1:] = (np.diff(cols[order]) != 0) | (np.diff(y[order]) != 0)
+    pair_gene, pair_y = cols[order][first], y[order][first]
+    pair_count = np.diff(np.append(np.flatnonzero(first), y.size))
+
+    # sum of (y/mu - 1)**2, the zeros of y add 1 each
+    theta = n / (np.bincount(cols, weights=(y/mu)**2 - 2*y/mu, minlength=num_genes) + n)
+    de = np.ones(num_genes)
+    active = np.arange(num_genes)
+    c, pc, py, pw = cols, pair_gene, pair_y, pair_count
+    for it in range(limit - 1):
+        keep = np.abs(de[active]) > eps
+        if not keep.any():
+            break
+        if not keep.all():
+            # drop the converged genes, the others are numbered 0..active.size-1
+            active = active[keep]
+            position = np.cumsum(keep) - 1
+            nz, pairs = keep[c], keep[pc]
+            c, y, mu = position[c[nz]], y[nz], mu[nz]
+            pc, py, pw = position[pc[pairs]], py[pairs], pw[pairs]
+            Mu = Mu[:,keep]
+        th = np.abs(theta[active])
+        thn, thp = th[c], th[pc]
+        A = Mu + th
+        inv = 1 / A
+        score = (np.bincount(pc, weights=pw*(psi(thp + py) - psi(thp)), minlength=active.size)
+                 - np.bincount(c, weights=y/(mu + thn), minlength=active.size)
+                 + n*(np.log(th) + 1) - np.log(A).sum(0) - th*inv.sum(0))
+        info = (np.bincount(pc, weights=pw*(trigamma(thp) - trigamma(thp + py)), minlength=active.size)
+                - np.bincount(c, weights=y/(mu + thn)**2, minlength=active.size)
+                - n/th + 2*inv.sum(0) - th*(inv**2).sum(0))
+        de[active] = score/info
+        theta[active] = th + de[active]
+    return np.maximum(theta, 0)
+
+def SCTransform(adata,min_cells=0,gmean_eps=1,n_genes=2000,n_cells=None,bin_size=500,bw_adjust=3,inplace=True,n_jobs=None):
     """
     This is a port of SCTransform from the Satija lab. See the R package for original documentation.
     
@@ -156,28 +271,11 @@ def SCTransform(adata,min_cells=0,gmean_eps=1,n_genes=2000,n_cells=None,bin_size
         genes_log_gmean_step1 = np.log10(gmean(X[cells_step1,:][:,genes_step1],eps=gmean_eps))
 
 
-    bin_ind = np.ceil(np.arange(1,genes_step1.size+1) / bin_size)
-    max_bin = max(bin_ind)
-
-    ps = Manager().dict()
-
-    for i in range(1,int(max_bin)+1):
-        genes_bin_regress = genes_step1[bin_ind==i]
-        umi_bin = X[cells_step1,:][:,genes_bin_regress]
-
-        mm = np.vstack((np.ones(data_step1.shape[0]),data_step1['log_umi'].values.flatten())).T
-
-        pc_chunksize = umi_bin.shape[1] // os.cpu_count() + 1
-        with get_context("spawn").Pool(os.cpu_count(), _parallel_init, [genes_bin_regress, umi_bin, gn, mm, ps]) as pool:
-            try:
-                pool.map(_parallel_wrapper, range(umi_bin.shape[1]), chunksize=pc_chunksize)
-            finally:
-                pool.close()
-                pool.join()
-
-    ps = ps._getvalue()    
+    umi_step1 = X[cells_step1,:][:,genes_step1]
+    mm = np.vstack((np.ones(data_step1.shape[0]),data_step1['log_umi'].values.flatten())).T
+    ps = fit_step1(umi_step1, mm, bin_size=bin_size, n_jobs=n_jobs)
 
-    model_pars = pd.DataFrame(data = np.vstack([ps[x] for x in gn[genes_step1]]),
+    model_pars = pd.DataFrame(data = ps,
                  columns = ['Intercept','log_umi','theta'],
                  index = gn[genes_step1])
 
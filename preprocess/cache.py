@@ -0,0 +1,183 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+# files whose code decides the content of a preprocessed file
+PREPROCESS_SOURCES = ["generate_h5ad.py", "readers.py", "writers.py", "out_of_core.py"]
+LIBRARIES = ["scanpy", "anndata", "numpy", "scipy", "pandas"]
+
+
+def library_versions():
+    from importlib.metadata import version, PackageNotFoundError
+    versions = {}
+    for name in LIBRARIES:
+        try:
+            versions[name] = version(name)
+        except PackageNotFoundError:
+            versions[name] = None
+    return versions
+
+
+def _sha1_file(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _files_of(path):
+    if os.path.isdir(path):
+        return sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    return [path]
+
+
+class PreprocessCache(object):
+    """
+    Content-addressed cache of preprocessed h5ad files.
+    An entry is keyed by the content of the input files, the preprocessing options, the
+    preprocessing code and the library versions; entries are evicted least recently used
+    first once the cache is larger than max_size_gb.
+    Layout: cache_dir/index.json, cache_dir/{key}/{preprocessed file name}
+    """
+    def __init__(self, cache_dir, max_size_gb=50.0):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_gb * 2**30)
+        if os.path.exists(cache_dir) != True:
+            os.makedirs(cache_dir)
+        self.index_path = os.path.join(cache_dir, "index.json")
+
+    @contextlib.contextmanager
+    def _lock(self, name="index"):
+        with open(os.path.join(self.cache_dir, ".{}.lock".format(name)), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _load_index(self):
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                return json.load(f)
+        return {"files": {}, "entries": {}}
+
+    def _save_index(self, index):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _hash_input(self, path, index):
+        # hashes are memoized by size/mtime, so an unchanged 30 GB input is not read again
+        sha1 = hashlib.sha1()
+        for file_path in _files_of(path):
+            file_path = os.path.abspath(file_path)
+            stat = os.stat(file_path)
+            known = index["files"].get(file_path)
+            if known is None or known["size"] != stat.st_size or known["mtime"] != stat.st_mtime:
+                known = {"size": stat.st_size, "mtime": stat.st_mtime, "sha1": _sha1_file(file_path)}
+                index["files"][file_path] = known
+            sha1.update(known["sha1"].encode())
+        return sha1.hexdigest()
+
+    def key(self, input_paths, options, index):
+        source_dir = os.path.dirname(os.path.abspath(__file__))
+        content = {
+            "inputs": [self._hash_input(path, index) for path in input_paths],
+            "options": options,
+            "sources": [_sha1_file(os.path.join(source_dir, name)) for name in PREPROCESS_SOURCES],
+            "versions": library_versions(),
+        }
+        return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def get_or_create(self, input_paths, options, create):
+        """
+        Path of the cached file for these inputs and options. On a miss,
+        create(directory) writes the file into a temporary directory and returns its path.
+        """
+        # hash the inputs without holding the lock, then record the new hashes
+        index = self._load_index()
+        key = self.key(input_paths, options, index)
+        with self._lock():
+            latest = self._load_index()
+            latest["files"].update(index["files"])
+            self._save_index(latest)
+
+        # one creation per key at a time, other keys are not blocked
+        with self._lock(key):
+            with self._lock():
+                index = self._load_index()
+                entry = index["entries"].get(key)
+                if entry is not None and os.path.exists(entry["path"]):
+                    entry["last_used"] = time.time()
+                    self._save_index(index)
+                    print("Preprocessed file found in cache: {}".format(entry["path"]))
+                    return entry["path"]
+
+            tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix=".tmp_")
+            try:
+                file_path = create(tmp_dir)
+                entry_dir = os.path.join(self.cache_dir, key)
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                os.replace(tmp_dir, entry_dir)
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            path = os.path.join(entry_dir, os.path.basename(file_path))
+
+            with self._lock():
+                index = self._load_index()
+                index["entries"][key] = {"path": path, "size": os.path.getsize(path), "last_used": time.time(),
+                                         "inputs": [os.path.abspath(p) for p in input_paths], "options": options}
+                self._evict(index, keep=key)
+                self._save_index(index)
+        return path
+
+    def _evict(self, index, keep=None):
+        entries = index["entries"]
+        total = sum(entry["size"] for entry in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]["last_used"]):
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            print("Evict cached file: {}".format(entries[key]["path"]))
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            total -= entries.pop(key)["size"]
+
+
+def preprocess_cached(cache_dir, max_size_gb=50.0, input_h5ad_path=None, input_10X_path=None, count_csv_path=None,
+                      label_csv_path=None, **options):
+    """
+    Same as generate_h5ad.preprocess_csv_to_h5ad, but the preprocessed file is looked up
+    in (or added to) the cache. options: do_filter, do_log, do_select_hvg, do_norm, do_scale, ...
+    Return: path of the preprocessed h5ad file
+    drop_prob must be a single rate: one cache entry holds one preprocessed file.
+    """
+    if "drop_prob" in options:
+        drop_probs = options["drop_prob"] if isinstance(options["drop_prob"], (list, tuple)) else [options["drop_prob"]]
+        if len(drop_probs) != 1:
+            raise ValueError("preprocess_cached takes a single drop_prob, got {}: call it once per rate"
+                             .format(list(drop_probs)))
+        options["drop_prob"] = float(drop_probs[0])
+    input_paths = [path for path in [input_h5ad_path, input_10X_path, count_csv_path, label_csv_path] if path is not None]
+    # which argument each input is given as matters as well
+    cache_options = dict(options, inputs=[name for name, path in [("h5ad", input_h5ad_path), ("10X", input_10X_path),
+                                                                  ("csv", count_csv_path), ("label", label_csv_path)]
+                                          if path is not None])
+
+    def create(directory):
+        from generate_h5ad import preprocess_csv_to_h5ad
+        before = set(os.listdir(directory))
+        preprocess_csv_to_h5ad(input_h5ad_path, input_10X_path, count_csv_path, label_csv_path, directory, **options)
+        created = sorted(set(os.listdir(directory)) - before)
+        if len(created) != 1:
+            raise Exception("Expected one preprocessed file, found {}".format(created))
+        return os.path.join(directory, created[0])
+
+    return PreprocessCache(cache_dir, max_size_gb).get_or_create(input_paths, cache_options, create)
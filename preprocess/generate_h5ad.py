@@ -2,7 +2,13 @@ import argparse
 import numpy as np
 import pandas as pd
 import scanpy as sc
+import scipy.sparse as sp
 import os
+import time
+
+from readers import read_10x, read_csv_to_csr
+from writers import PROFILES, write_h5ad
+from out_of_core import preprocess_out_of_core
 
 parser = argparse.ArgumentParser(description='PyTorch scRNA-seq format transformation and preprocessing')
 
@@ -10,7 +16,7 @@ parser = argparse.ArgumentParser(description='PyTorch scRNA-seq format transform
 parser.add_argument('--input_h5ad_path', type=str, default=None,
                     help='path to input h5ad file')
 parser.add_argument('--input_10X_path', type=str, default=None,
-                    help='path to input 10X file')
+                    help='path to input 10X directory (matrix.mtx, barcodes.tsv, features.tsv) or .h5 file')
 parser.add_argument('--count_csv_path', type=str, default=None,
                     help='path to counts csv file')
 parser.add_argument('--label_csv_path', type=str, default=None,
@@ -34,17 +40,193 @@ parser.add_argument("--scale", action="store_true",
 parser.add_argument("--select_hvg", action="store_true",
                     help="Whether select highly variable gene")
 
-parser.add_argument("--drop_prob", type=float, default=0.0,
-                    help="simulate dropout events")
+parser.add_argument("--defer_scale", action="store_true",
+                    help="with --scale, only store the per-gene mean/std and keep X sparse; "
+                         "CLEAR applies the scaling when it assembles a batch")
+
+parser.add_argument("--drop_prob", type=float, nargs="+", default=[0.0],
+                    help="simulate dropout events; with several rates, one file is saved per rate")
+
+parser.add_argument("--n_jobs", type=int, default=None,
+                    help="number of processes parsing the counts csv or threads parsing matrix.mtx (default: all cores)")
+
+parser.add_argument("--out_of_core", action="store_true",
+                    help="preprocess an input h5ad file in backed mode, chunk by chunk, for data larger than memory")
+
+parser.add_argument("--chunk_size", type=int, default=50000,
+                    help="number of cells per chunk of --out_of_core")
+
+parser.add_argument("--output_profile", type=str, default="plain", choices=list(PROFILES),
+                    help="storage of the output: plain (as is), fast-read (float32, chunked by cells) "
+                         "or compact (float32, chunked, gzip)")
 
 
 def dropout_events(adata, drop_prob=0.0):
-    adata = adata.copy()
-    nnz = adata.X.nonzero()
-    nnz_size = len(nnz[0])
+    """
+    Simulate dropout events: a fraction drop_prob of the nonzero entries, sampled without
+    replacement, is set to zero directly in the CSR data array.
+    drop_prob: a rate, or a list of rates to get one AnnData per rate in a single pass;
+    the dropped entries are nested, each rate drops a prefix of one random order of the entries.
+    """
+    X = sp.csr_matrix(adata.X)
+    nonzero = np.flatnonzero(X.data)
+    order = np.random.permutation(len(nonzero))
+
+    dropped_adatas = []
+    for p in np.atleast_1d(drop_prob):
+        data = X.data.copy()
+        data[nonzero[order[:int(len(nonzero) * p)]]] = 0
+        dropped = sp.csr_matrix((data, X.indices.copy(), X.indptr.copy()), shape=X.shape)
+        dropped.eliminate_zeros()
+        if not sp.issparse(adata.X):
+            dropped = dropped.toarray()
+        # a copy of the whole AnnData (layers, obsm, obsp, raw...), only X is replaced
+        dropped_adata = adata.copy()
+        dropped_adata.X = dropped
+        dropped_adatas.append(dropped_adata)
+
+    return dropped_adatas if np.ndim(drop_prob) > 0 else dropped_adatas[0]
+
+
+def scale_statistics(adata, max_value=10, zero_center=True):
+    """
+    Deferred sc.pp.scale: the per-gene mean/std it would use are stored in adata.var
+    (scale_mean, scale_std) and the clip settings in adata.uns["scale"]; X is left as is.
+    pcl.loader applies the scaling to the rows of a batch.
+    """
+    X = adata.X
+    num_cells = X.shape[0]
+    # mean and variance (ddof=1) accumulated in float64 from float32 squares, as scanpy computes them
+    if sp.issparse(X):
+        X = sp.csr_matrix(X)
+        # scipy sums float32 data in float32, whatever the dtype argument
+        mean = np.bincount(X.indices, weights=X.data.astype(np.float64), minlength=X.shape[1]) / num_cells
+        mean_sq = np.bincount(X.indices, weights=np.square(X.data).astype(np.float64),
+                              minlength=X.shape[1]) / num_cells
+    else:
+        mean = np.mean(X, axis=0, dtype=np.float64)
+        mean_sq = np.mean(np.square(X), axis=0, dtype=np.float64)
+    std = np.sqrt((mean_sq - np.square(mean)) * num_cells / (num_cells - 1))
+    std[std == 0] = 1
+    adata.var["scale_mean"] = mean
+    adata.var["scale_std"] = std
+    adata.uns["scale"] = {"max_value": max_value, "zero_center": zero_center}
+    return adata
 
-    drop = np.random.choice(nnz_size, int(nnz_size*drop_prob))
-    adata[nnz[0][drop], nnz[1][drop]] = 0
+
+def _iter_csr_rows(X, chunk_size):
+    """Row chunks of X as CSR matrices, sharing the arrays of X when it is CSR"""
+    for start in range(0, X.shape[0], chunk_size):
+        stop = min(start + chunk_size, X.shape[0])
+        if sp.issparse(X) and X.format == "csr":
+            lo, hi = X.indptr[start], X.indptr[stop]
+            yield start, stop, sp.csr_matrix((X.data[lo:hi], X.indices[lo:hi], X.indptr[start:stop + 1] - lo),
+                                             shape=(stop - start, X.shape[1]), copy=False)
+        else:
+            yield start, stop, sp.csr_matrix(X[start:stop])
+
+
+def _indicator(block, condition):
+    """CSR matrix of block with 1 where condition holds for the stored values, 0 elsewhere"""
+    return sp.csr_matrix((condition(block.data).astype(np.int32), block.indices, block.indptr), shape=block.shape,
+                         copy=False)
+
+
+def qc_filter(adata, min_genes=200, min_cells=3, max_pct_mt=5, max_pct_ercc=10, chunk_size=20000):
+    """
+    Fused filter_cells(min_genes) + filter_genes(min_cells) + MT- and ERCC- QC filters.
+    Every per-cell and per-gene QC quantity is a sparse matrix-vector product on row chunks of X
+    (one sweep for genes per cell / cells per gene, one for the counts over the kept genes),
+    then all masks are applied in one slice. Masks and obs/var columns are those of the
+    scanpy calls: row sums in the data type, gene metrics over the cells left after the MT filter.
+    """
+    X = adata.X
+    num_cells, num_genes = X.shape
+    dtype = X.dtype if np.issubdtype(X.dtype, np.floating) else np.float32
+
+    # genes per cell, then cells per gene over the cells with enough genes
+    n_genes = np.zeros(num_cells, dtype=np.int64)
+    n_cells = np.zeros(num_genes, dtype=np.int64)
+    for start, stop, block in _iter_csr_rows(X, chunk_size):
+        positive = _indicator(block, lambda data: data > 0)
+        n_genes[start:stop] = positive @ np.ones(num_genes, dtype=np.int32)
+        n_cells += (n_genes[start:stop] >= min_genes).astype(np.int32) @ positive
+    cell_mask = n_genes >= min_genes
+    gene_mask = n_cells >= min_cells
+
+    # counts over the kept genes; a product with a 0/1 vector sums in the same order as scanpy
+    is_mt = np.asarray(adata.var_names.str.startswith('MT-'))
+    is_ercc = np.asarray(adata.var_names.str.startswith('ERCC-'))
+    weights = np.stack([gene_mask, gene_mask & is_mt, gene_mask & is_ercc], axis=1).astype(dtype)
+    totals = np.zeros((num_cells, 3), dtype=dtype)
+    n_genes_by_counts = np.zeros(num_cells, dtype=np.int32 if sp.issparse(X) else np.int64)
+    low_mt = np.zeros(num_cells, dtype=bool)
+    gene_nnz = np.zeros(num_genes, dtype=np.int64)
+    gene_sum = np.zeros(num_genes)
+    for start, stop, block in _iter_csr_rows(X, chunk_size):
+        totals[start:stop] = block @ weights
+        nonzero = _indicator(block, lambda data: data != 0)
+        n_genes_by_counts[start:stop] = nonzero @ gene_mask.astype(np.int32)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            pct_mt = totals[start:stop, 1] / totals[start:stop, 0] * 100
+        # a cell without counts has a nan percentage and is dropped
+        low_mt[start:stop] = cell_mask[start:stop] & (pct_mt < max_pct_mt)
+        gene_nnz += low_mt[start:stop].astype(np.int32) @ nonzero
+        gene_sum += low_mt[start:stop].astype(np.float64) @ block
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pct_mt = totals[:, 1] / totals[:, 0] * 100
+        pct_ercc = totals[:, 2] / totals[:, 0] * 100
+    keep = low_mt & (pct_ercc < max_pct_ercc)
+
+    print("filtered out {} cells that have less than {} genes expressed".format((~cell_mask).sum(), min_genes))
+    print("filtered out {} genes that are detected in less than {} cells".format((~gene_mask).sum(), min_cells))
+    print("filtered out {} cells by their MT- and ERCC- fractions".format((cell_mask & ~keep).sum()))
+
+    num_low_mt = low_mt.sum()
+    adata.obs["n_genes"] = n_genes
+    adata.var["n_cells"] = n_cells
+    adata.var["mt"] = is_mt
+    adata.obs["n_genes_by_counts"] = n_genes_by_counts
+    adata.obs["total_counts"] = totals[:, 0]
+    adata.obs["total_counts_mt"] = totals[:, 1]
+    adata.obs["pct_counts_mt"] = pct_mt
+    adata.var["n_cells_by_counts"] = gene_nnz
+    adata.var["mean_counts"] = gene_sum / num_low_mt
+    adata.var["pct_dropout_by_counts"] = (1 - gene_nnz / num_low_mt) * 100
+    adata.var["total_counts"] = gene_sum.astype(dtype)
+    adata.var["ERCC"] = is_ercc
+    adata.obs["total_counts_ERCC"] = totals[:, 2]
+    adata.obs["pct_counts_ERCC"] = pct_ercc
+    return adata[keep, slice(None) if gene_mask.all() else gene_mask].copy()
+
+
+def transform_anndata(adata, do_log=False, do_select_hvg=False, do_norm=False, do_scale=False, defer_scale=False):
+    # log operation and select highly variable gene
+    # before normalization, we can select the most variant genes
+    if do_log and np.max(adata.X > 100):
+        sc.pp.log1p(adata)
+
+        if do_select_hvg:
+            sc.pp.highly_variable_genes(adata, min_mean=0.0125, max_mean=3, min_disp=0.5)
+            adata = adata[:, adata.var.highly_variable]
+
+    else:
+        if do_select_hvg and not do_log:
+            sc.pp.highly_variable_genes(adata, flavor="seurat_v3", n_top_genes=5000)
+            adata = adata[:, adata.var.highly_variable]
+
+    if do_norm == True:
+        sc.pp.normalize_total(adata, target_sum=1e4, exclude_highly_expressed=True)
+        adata.raw = adata
+
+    # after that, we do the linear scaling
+    # log operations and scale operations will hurt the
+    # contrastive between the data
+
+    if do_scale == True and defer_scale == True:
+        scale_statistics(adata, max_value=10, zero_center=True)
+    elif do_scale == True:
+        sc.pp.scale(adata, max_value=10, zero_center=True)
 
     return adata
 
@@ -52,8 +234,22 @@ def dropout_events(adata, drop_prob=0.0):
 def preprocess_csv_to_h5ad(
         input_h5ad_path=None, input_10X_path=None, count_csv_path=None, label_csv_path=None, save_h5ad_dir="./",
         do_filter=False, do_log=False, do_select_hvg=False, do_norm=False, do_scale=False,
-        drop_prob=0.0
+        drop_prob=0.0, n_jobs=None, out_of_core=False, chunk_size=50000, defer_scale=False, output_profile="plain"
 ):
+    if out_of_core == True:
+        if input_h5ad_path == None or input_10X_path != None or count_csv_path != None:
+            raise Exception("Out-of-core preprocessing needs an h5ad input file!")
+        if max(np.atleast_1d(drop_prob)) > 0:
+            raise Exception("Dropout simulation is not supported out of core!")
+        _, file_name = os.path.split(input_h5ad_path)
+        if do_filter | do_log | do_select_hvg | do_norm | do_scale:
+            file_name = file_name.replace(".h5ad", "_preprocessed.h5ad")
+        adata = preprocess_out_of_core(input_h5ad_path, os.path.join(save_h5ad_dir, file_name), do_filter, do_log,
+                                       do_select_hvg, do_norm, do_scale, chunk_size=chunk_size,
+                                       defer_scale=defer_scale, profile=output_profile)
+        print("Successfully generate preprocessed file: {}".format(file_name))
+        return adata
+
     # 1. read data from h5ad, 10X or csv files.
     if input_h5ad_path != None and input_10X_path == None and count_csv_path == None:
         adata = sc.read_h5ad(input_h5ad_path)
@@ -63,21 +259,29 @@ def preprocess_csv_to_h5ad(
         save_file_name = h5ad_file_name
 
     elif input_10X_path != None and input_h5ad_path == None and count_csv_path == None:
-        adata = sc.read_10x_mtx(input_10X_path)
+        X, barcodes, features = read_10x(input_10X_path, n_jobs=n_jobs)
+        adata = sc.AnnData(X=X, obs=pd.DataFrame(index=barcodes), var=features)
+        # as sc.read_10x_mtx: gene expression features only, unique gene symbols
+        if "feature_types" in adata.var:
+            adata = adata[:, (adata.var["feature_types"] == "Gene Expression").values].copy()
+        adata.var_names_make_unique()
         print("Read data from 10X file: {}".format(input_10X_path))
 
-        _, input_10X_file_name = os.path.split(input_10X_path)
+        _, input_10X_file_name = os.path.split(os.path.normpath(input_10X_path))
+        if not os.path.isdir(input_10X_path):
+            input_10X_file_name = os.path.splitext(input_10X_file_name)[0]
         save_file_name = input_10X_file_name + ".h5ad"
 
     elif count_csv_path != None and input_h5ad_path == None and input_10X_path == None:
-        # read the count matrix from the path
-        count_frame = pd.read_csv(count_csv_path, index_col=0)
-        print("counts shape:{}".format(count_frame.shape))
+        # read the count matrix from the path, chunk by chunk into a sparse matrix
+        X, cell_names, gene_names = read_csv_to_csr(count_csv_path, n_jobs=n_jobs)
+        cell_frame = pd.DataFrame(index=cell_names)
+        print("counts shape:{}".format(X.shape))
 
         if label_csv_path != None:
             label_frame = pd.read_csv(label_csv_path, index_col=0, header=0)
             print("labels shape:{}".format(label_frame.shape))
-            if count_frame.shape[0] != label_frame.shape[0]:
+            if X.shape[0] != label_frame.shape[0]:
                 raise Exception("The shapes of counts and labels do not match!")
 
             #if rename_label_colname is not None:
@@ -87,13 +291,13 @@ def preprocess_csv_to_h5ad(
                 # label_frame.rename(columns={'celltype': 'x'}, inplace=True)   # dataset1
                 # label_frame.rename(columns={'Group': 'x'}, inplace=True)  # batch effect dataset3
 
-            label_frame.index = count_frame.index
+            label_frame.index = cell_frame.index
 
-            adata = sc.AnnData(X=count_frame, obs=label_frame)
+            adata = sc.AnnData(X=X, obs=label_frame, var=pd.DataFrame(index=gene_names))
             print("Read data from csv file: {}".format(count_csv_path))
             print("Read laebl from csv file: {}".format(label_csv_path))
         else:
-            adata = sc.AnnData(X=count_frame)
+            adata = sc.AnnData(X=X, obs=cell_frame, var=pd.DataFrame(index=gene_names))
             print("Read data from csv file: {}".format(count_csv_path))
 
         _, counts_file_name = os.path.split(count_csv_path)
@@ -104,71 +308,41 @@ def preprocess_csv_to_h5ad(
 
 
     # 2. preprocess anndata
-    preprocessed_flag = do_filter | do_log | do_select_hvg | do_norm | do_scale | (drop_prob > 0)
+    drop_probs = list(np.atleast_1d(drop_prob))
+    preprocessed_flag = do_filter | do_log | do_select_hvg | do_norm | do_scale | (max(drop_probs) > 0)
     # filter operation
     if do_filter == True:
-        # basic filtering, filter the genes and cells
-        # sc.pp.filter_cells(adata, min_counts=5000)
-        sc.pp.filter_cells(adata, min_genes=200)
-
-        sc.pp.filter_genes(adata, min_cells=3)
-
-        # calculate the qc metrics, then do the normalization
-
-        # filter the mitochondrial genes
-        adata.var['mt'] = adata.var_names.str.startswith('MT-')  # annotate the group of mitochondrial genes as 'mt'
-        sc.pp.calculate_qc_metrics(adata, qc_vars=['mt'], percent_top=None, log1p=False, inplace=True)
-        low_MT_MASK = (adata.obs.pct_counts_mt < 5)
-        adata = adata[low_MT_MASK]
-
-        # filter the ERCC spike-in RNAs
-        adata.var['ERCC'] = adata.var_names.str.startswith('ERCC-')  # annotate the group of ERCC spike-in as 'ERCC'
-        sc.pp.calculate_qc_metrics(adata, qc_vars=['ERCC'], percent_top=None, log1p=False, inplace=True)
-        low_ERCC_mask = (adata.obs.pct_counts_ERCC < 10)
-        adata = adata[low_ERCC_mask]
-
-    # dropout operation
-    if drop_prob > 0:
-        adata = dropout_events(adata, drop_prob=drop_prob)
-
-    # log operation and select highly variable gene
-    # before normalization, we can select the most variant genes
-    if do_log and np.max(adata.X > 100):
-        sc.pp.log1p(adata)
-
-        if do_select_hvg:
-            sc.pp.highly_variable_genes(adata, min_mean=0.0125, max_mean=3, min_disp=0.5)
-            adata = adata[:, adata.var.highly_variable]
+        # basic filtering of the genes and cells, then the mitochondrial genes and ERCC spike-in RNAs,
+        # all computed in one sweep and applied in one slice
+        adata = qc_filter(adata, min_genes=200, min_cells=3, max_pct_mt=5, max_pct_ercc=10)
 
+    # dropout operation, one dataset per rate
+    if max(drop_probs) > 0:
+        adatas = dropout_events(adata, drop_prob=drop_probs)
     else:
-        if do_select_hvg and not do_log:
-            sc.pp.highly_variable_genes(adata, flavor="seurat_v3", n_top_genes=5000)
-            adata = adata[:, adata.var.highly_variable]
+        adatas = [adata]
 
-    if do_norm == True:
-        sc.pp.normalize_total(adata, target_sum=1e4, exclude_highly_expressed=True)
-        adata.raw = adata
+    for i, adata in enumerate(adatas):
+        adatas[i] = adata = transform_anndata(adata, do_log, do_select_hvg, do_norm, do_scale, defer_scale)
 
-    # after that, we do the linear scaling
-    # log operations and scale operations will hurt the
-    # contrastive between the data
+        # 3. save preprocessed h5ad
+        if save_h5ad_dir is not None:
+            if os.path.exists(save_h5ad_dir) != True:
+                os.makedirs(save_h5ad_dir)
 
-    if do_scale == True:
-        sc.pp.scale(adata, max_value=10, zero_center=True)
+            file_name = save_file_name
+            if len(drop_probs) > 1:
+                file_name = file_name.replace(".h5ad", "_drop{}.h5ad".format(drop_probs[i]))
+            if preprocessed_flag == True:
+                file_name = file_name.replace(".h5ad", "_preprocessed.h5ad")
+            save_path = os.path.join(save_h5ad_dir, file_name)
 
-    # 3. save preprocessed h5ad
-    if save_h5ad_dir is not None:
-        if os.path.exists(save_h5ad_dir) != True:
-            os.makedirs(save_h5ad_dir)
+            start = time.time()
+            write_h5ad(adata, save_path, output_profile)
+            print("Successfully generate preprocessed file: {} ({} profile, {:.1f} MB, written in {:.1f}s)".format(
+                file_name, output_profile, os.path.getsize(save_path) / 2**20, time.time() - start))
 
-        if preprocessed_flag == True:
-            save_file_name = save_file_name.replace(".h5ad", "_preprocessed.h5ad")
-        save_path = os.path.join(save_h5ad_dir, save_file_name)
-
-        adata.write(save_path)
-        print("Successfully generate preprocessed file: {}".format(save_file_name))
-
-    return adata
+    return adatas if len(adatas) > 1 else adatas[0]
 
 if __name__=="__main__":
     args = parser.parse_args()
@@ -176,5 +350,6 @@ if __name__=="__main__":
     processed_adata = preprocess_csv_to_h5ad(
         args.input_h5ad_path, args.input_10X_path, args.count_csv_path, args.label_csv_path, args.save_h5ad_dir,
         do_filter=args.filter, do_log=args.log, do_norm=args.norm, do_select_hvg=args.select_hvg, do_scale=args.scale,
-        drop_prob=args.drop_prob,
+        drop_prob=args.drop_prob, n_jobs=args.n_jobs, out_of_core=args.out_of_core, chunk_size=args.chunk_size,
+        defer_scale=args.defer_scale, output_profile=args.output_profile,
     )
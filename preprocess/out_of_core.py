@@ -0,0 +1,359 @@
+import os
+
+import anndata
+import h5py
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from writers import PROFILES, dataset_options
+
+
+def iter_backed_rows(X, chunk_size):
+    """Yield (start, stop, CSR block) of a backed X, dense or sparse"""
+    num_cells = X.shape[0]
+    for start in range(0, num_cells, chunk_size):
+        stop = min(start + chunk_size, num_cells)
+        yield start, stop, sp.csr_matrix(X[start:stop])
+
+
+def _scale_rows(block, factors):
+    block.data /= np.repeat(factors, np.diff(block.indptr)).astype(block.dtype)
+    return block
+
+
+class _Stats(object):
+    """Per-gene sum and sum of squares accumulated over row blocks, mean/var as scanpy computes them"""
+    def __init__(self, num_genes):
+        self.n = 0
+        self.sum = np.zeros(num_genes)
+        self.sumsq = np.zeros(num_genes)
+
+    def add(self, block):
+        self.n += block.shape[0]
+        # scipy would sum float32 data in float32
+        self.sum += np.bincount(block.indices, weights=block.data.astype(np.float64), minlength=len(self.sum))
+        self.sumsq += np.bincount(block.indices, weights=np.square(block.data).astype(np.float64),
+                                  minlength=len(self.sumsq))
+
+    def mean_var(self):
+        mean = self.sum / self.n
+        var = (self.sumsq / self.n - np.square(mean)) * self.n / (self.n - 1)
+        return mean, var
+
+
+def _hvg_seurat(mean, var, min_mean=0.0125, max_mean=3, min_disp=0.5, n_bins=20):
+    """sc.pp.highly_variable_genes(flavor="seurat") from the per-gene mean/var of the expm1 data"""
+    mean = mean.copy()
+    mean[mean == 0] = 1e-12
+    dispersion = var / mean
+    dispersion[dispersion == 0] = np.nan
+    dispersion = np.log(dispersion)
+    mean = np.log1p(mean)
+
+    df = pd.DataFrame({"means": mean, "dispersions": dispersion})
+    df["mean_bin"] = pd.cut(df["means"], bins=n_bins)
+    disp_stats = df.groupby("mean_bin", observed=True)["dispersions"].agg(avg="mean", dev="std")
+    # a gene alone in its bin gets a normalized dispersion of 1
+    one_gene_per_bin = disp_stats["dev"].isnull()
+    disp_stats.loc[one_gene_per_bin, "dev"] = disp_stats.loc[one_gene_per_bin, "avg"]
+    disp_stats.loc[one_gene_per_bin, "avg"] = 0
+    disp_stats = disp_stats.loc[df["mean_bin"]].set_index(df.index)
+    df["dispersions_norm"] = (df["dispersions"] - disp_stats["avg"]) / disp_stats["dev"]
+
+    dispersion_norm = np.nan_to_num(df["dispersions_norm"].to_numpy())
+    df["highly_variable"] = (mean > min_mean) & (mean < max_mean) & (dispersion_norm > min_disp)
+    return df.drop(columns="mean_bin")
+
+
+def _hvg_seurat_v3_loess(mean, var, span=0.3):
+    """Regularized std of the genes (loess fit of log variance on log mean)"""
+    from skmisc.loess import loess
+    not_const = var > 0
+    estimat_var = np.zeros(len(mean), dtype=np.float64)
+    model = loess(np.log10(mean[not_const]), np.log10(var[not_const]), span=span, degree=2)
+    model.fit()
+    estimat_var[not_const] = model.outputs.fitted_values
+    return np.sqrt(10 ** estimat_var)
+
+
+def _hvg_seurat_v3(mean, var, reg_std, clipped_sum, clipped_sumsq, num_cells, n_top_genes=5000):
+    """sc.pp.highly_variable_genes(flavor="seurat_v3") from the clipped sums of the raw counts"""
+    norm_gene_var = (1 / ((num_cells - 1) * np.square(reg_std))) * (
+        num_cells * np.square(mean) + clipped_sumsq - 2 * clipped_sum * mean)
+    rank = np.argsort(np.argsort(-norm_gene_var)).astype(np.float32)
+    rank[rank >= n_top_genes] = np.nan
+    df = pd.DataFrame({"highly_variable_rank": rank, "means": mean, "variances": var,
+                       "variances_norm": norm_gene_var})
+    df["highly_variable"] = False
+    top = df.sort_values("highly_variable_rank", na_position="last").index[:int(n_top_genes)]
+    df.loc[top, "highly_variable"] = True
+    return df[["highly_variable", "highly_variable_rank", "means", "variances", "variances_norm"]]
+
+
+def preprocess_out_of_core(input_h5ad_path, save_path, do_filter=False, do_log=False, do_select_hvg=False,
+                           do_norm=False, do_scale=False, chunk_size=50000, defer_scale=False, profile="plain"):
+    """
+    generate_h5ad.preprocess_csv_to_h5ad for an h5ad file larger than memory.
+    The file is opened in backed mode and read chunk_size cells at a time: a few passes accumulate
+    per-cell and per-gene statistics (QC masks, maximum, HVG and normalization statistics),
+    the last pass applies the filters and transforms chunk by chunk and appends the result to
+    save_path. Only one chunk of X and per-cell/per-gene vectors are in memory.
+    The steps and their order are the same as the in-memory version, adata.raw included.
+    defer_scale: with do_scale, store the scaling statistics and keep X sparse (see scale_statistics)
+    profile: storage profile of X and raw.X (writers.PROFILES)
+    Return: AnnData of save_path opened in backed mode
+    """
+    adata = anndata.read_h5ad(input_h5ad_path, backed="r")
+    X = adata.X
+    num_cells, num_genes = adata.shape
+    obs, var, uns = adata.obs.copy(), adata.var.copy(), {}
+    cell_mask = np.ones(num_cells, dtype=bool)
+    gene_mask = np.ones(num_genes, dtype=bool)
+
+    # pass 1: genes per cell, then cells per gene over the cells with enough genes
+    if do_filter:
+        n_genes = np.zeros(num_cells, dtype=np.int64)
+        n_cells = np.zeros(num_genes, dtype=np.int64)
+        for start, stop, block in iter_backed_rows(X, chunk_size):
+            positive = (block > 0).astype(np.int64).tocsr()
+            n_genes[start:stop] = np.asarray(positive.sum(1)).ravel()
+            n_cells += np.asarray(positive[n_genes[start:stop] >= 200].sum(0)).ravel()
+        cell_mask = n_genes >= 200
+        gene_mask = n_cells >= 3
+        obs["n_genes"] = n_genes
+        var["n_cells"] = n_cells
+        print("filtered out {} cells with less than 200 genes expressed".format((~cell_mask).sum()))
+        print("filtered out {} genes that are detected in less than 3 cells".format((~gene_mask).sum()))
+
+    # pass 2: QC metrics over the kept genes, maximum and HVG statistics over the kept cells
+    is_mt = var.index[gene_mask].str.startswith("MT-")
+    is_ercc = var.index[gene_mask].str.startswith("ERCC-")
+    qc_columns = ["n_genes_by_counts", "total_counts", "total_counts_mt", "pct_counts_mt",
+                  "total_counts_ERCC", "pct_counts_ERCC"]
+    qc = np.zeros((num_cells, len(qc_columns)))
+    gene_qc = _Stats(gene_mask.sum())
+    gene_qc_nnz = np.zeros(gene_mask.sum(), dtype=np.int64)
+    hvg_stats = _Stats(gene_mask.sum())
+    max_value = -np.inf
+    if do_filter or do_log or do_select_hvg:
+        for start, stop, block in iter_backed_rows(X, chunk_size):
+            block = block[:, gene_mask]
+            keep = cell_mask[start:stop].copy()
+            if do_filter:
+                total = np.asarray(block.sum(1), dtype=np.float64).ravel()
+                total_mt = np.asarray(block[:, is_mt].sum(1), dtype=np.float64).ravel()
+                total_ercc = np.asarray(block[:, is_ercc].sum(1), dtype=np.float64).ravel()
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    pct_mt = total_mt / total * 100
+                    pct_ercc = total_ercc / total * 100
+                qc[start:stop] = np.stack([block.getnnz(1), total, total_mt, pct_mt, total_ercc, pct_ercc], 1)
+                # a cell with no counts has a nan percentage and is dropped
+                keep &= pct_mt < 5
+                # gene metrics are computed after the MT filter, before the ERCC one
+                gene_qc.add(block[keep])
+                gene_qc_nnz += block[keep].getnnz(0)
+                keep &= pct_ercc < 10
+                cell_mask[start:stop] = keep
+            block = block[keep]
+            if block.nnz > 0:
+                max_value = max(max_value, block.data.max())
+            if do_select_hvg and do_log:
+                # seurat flavor: statistics of expm1 of the log data
+                block.data = np.expm1(np.log1p(block.data))
+            if do_select_hvg:
+                hvg_stats.add(block)
+
+    if do_filter:
+        for i, column in enumerate(qc_columns):
+            obs[column] = qc[:, i]
+        obs["n_genes_by_counts"] = obs["n_genes_by_counts"].astype(np.int64)
+        mean_counts = gene_qc.sum / gene_qc.n
+        var["mt"] = var.index.str.startswith("MT-")
+        var["ERCC"] = var.index.str.startswith("ERCC-")
+        var = var[gene_mask]
+        var["n_cells_by_counts"] = gene_qc_nnz
+        var["mean_counts"] = mean_counts
+        var["pct_dropout_by_counts"] = (1 - gene_qc_nnz / gene_qc.n) * 100
+        var["total_counts"] = gene_qc.sum
+    obs = obs[cell_mask]
+    num_kept = cell_mask.sum()
+
+    # log operation and HVG selection, as in generate_h5ad.transform_anndata
+    log = do_log and max_value > 100
+    hvg_mask = np.ones(gene_mask.sum(), dtype=bool)
+    if log:
+        uns["log1p"] = {"base": None}
+        if do_select_hvg:
+            mean, variance = hvg_stats.mean_var()
+            hvg = _hvg_seurat(mean, variance)
+    elif do_select_hvg and not do_log:
+        # seurat_v3 clips the counts with the loess fit, one more pass for the clipped sums
+        mean, variance = hvg_stats.mean_var()
+        reg_std = _hvg_seurat_v3_loess(mean, variance)
+        clip_val = reg_std * np.sqrt(num_kept) + mean
+        clipped = _Stats(len(mean))
+        for start, stop, block in iter_backed_rows(X, chunk_size):
+            block = block[cell_mask[start:stop]][:, gene_mask].astype(np.float64)
+            np.minimum(block.data, clip_val[block.indices], out=block.data)
+            clipped.add(block)
+        hvg = _hvg_seurat_v3(mean, variance, reg_std, clipped.sum, clipped.sumsq, num_kept)
+    if do_select_hvg and (log or not do_log):
+        uns["hvg"] = {"flavor": "seurat" if log else "seurat_v3"}
+        hvg_mask = hvg["highly_variable"].to_numpy()
+        for column in hvg.columns:
+            var[column] = hvg[column].to_numpy()
+        var = var[hvg_mask]
+    # column indices of the kept genes in the input
+    columns = np.flatnonzero(gene_mask)[hvg_mask]
+    dtype = np.dtype(X.dtype) if np.issubdtype(X.dtype, np.floating) else np.dtype(np.float32)
+
+    def transformed(start, stop, block):
+        block = block[cell_mask[start:stop]][:, columns].astype(dtype)
+        if log:
+            np.log1p(block.data, out=block.data)
+        return block
+
+    # normalize_total(target_sum=1e4, exclude_highly_expressed=True): genes above 5% of the counts of
+    # a cell are excluded from the totals, a second pass computes the totals without them if needed
+    counts_per_cell = None
+    scale_stats = _Stats(len(columns))
+    if do_norm:
+        totals = np.zeros(num_kept)
+        highly_expressed = np.zeros(len(columns), dtype=bool)
+        offset = 0
+        for start, stop, block in iter_backed_rows(X, chunk_size):
+            block = transformed(start, stop, block)
+            total = np.asarray(block.sum(1), dtype=np.float64).ravel()
+            rows = np.repeat(np.arange(block.shape[0]), np.diff(block.indptr))
+            highly_expressed[block.indices[block.data > 0.05 * total.astype(dtype).astype(np.float64)[rows]]] = True
+            totals[offset:offset + block.shape[0]] = total
+            # the statistics for scaling are only valid if no gene turns out to be excluded
+            if do_scale:
+                scale_stats.add(_scale_rows(block, _norm_factors(total, dtype)))
+            offset += block.shape[0]
+
+        if highly_expressed.any():
+            print("{} highly-expressed genes are not considered for the normalization factors".format(
+                highly_expressed.sum()))
+            scale_stats = _Stats(len(columns))
+            offset = 0
+            for start, stop, block in iter_backed_rows(X, chunk_size):
+                block = transformed(start, stop, block)
+                total = np.asarray(block[:, ~highly_expressed].sum(1), dtype=np.float64).ravel()
+                totals[offset:offset + block.shape[0]] = total
+                if do_scale:
+                    scale_stats.add(_scale_rows(block, _norm_factors(total, dtype)))
+                offset += block.shape[0]
+        counts_per_cell = _norm_factors(totals, dtype)
+
+    elif do_scale:
+        for start, stop, block in iter_backed_rows(X, chunk_size):
+            scale_stats.add(transformed(start, stop, block))
+
+    # raw is the normalized data, before scaling
+    raw_var = var.copy()
+    if do_scale:
+        scale_mean, scale_var = scale_stats.mean_var()
+        scale_std = np.sqrt(scale_var)
+        scale_std[scale_std == 0] = 1
+        if defer_scale:
+            var["scale_mean"] = scale_mean
+            var["scale_std"] = scale_std
+            uns["scale"] = {"max_value": 10, "zero_center": True}
+        else:
+            var["mean"] = scale_mean
+            var["std"] = scale_std
+
+    # last pass: write obs/var/uns, then X (and raw) chunk by chunk
+    write_scaled = do_scale and not defer_scale
+    if PROFILES[profile] is not None:
+        dtype = np.dtype(PROFILES[profile]["dtype"])
+    skeleton = anndata.AnnData(X=sp.csr_matrix((num_kept, len(columns)), dtype=dtype), obs=obs, var=var, uns=uns)
+    if do_norm:
+        skeleton.raw = anndata.AnnData(X=skeleton.X, var=raw_var)
+    if os.path.dirname(save_path) != "" and os.path.exists(os.path.dirname(save_path)) != True:
+        os.makedirs(os.path.dirname(save_path))
+    skeleton.write_h5ad(save_path)
+
+    with h5py.File(save_path, "a") as f:
+        del f["X"]
+        if write_scaled:
+            if PROFILES[profile] is None:
+                rows_per_chunk = max(1, min(num_kept, 2**20 // max(len(columns), 1)))
+                options = {"chunks": (rows_per_chunk, max(len(columns), 1))}
+            else:
+                options = dataset_options(profile, (num_kept, len(columns)), dtype)
+            out = f.create_dataset("X", shape=(num_kept, len(columns)), dtype=dtype, **options)
+            out.attrs["encoding-type"] = "array"
+            out.attrs["encoding-version"] = "0.2.0"
+        else:
+            out = _CSRWriter(f, "X", len(columns), dtype, profile)
+        raw = None
+        if do_norm:
+            del f["raw/X"]
+            raw = _CSRWriter(f, "raw/X", len(columns), dtype, profile)
+
+        offset = 0
+        for start, stop, block in iter_backed_rows(X, chunk_size):
+            block = transformed(start, stop, block)
+            if do_norm:
+                _scale_rows(block, counts_per_cell[offset:offset + block.shape[0]])
+                raw.append(block)
+            if write_scaled:
+                dense = block.toarray()
+                dense -= scale_mean
+                dense /= scale_std
+                np.clip(dense, -10, 10, out=dense)
+                out[offset:offset + block.shape[0]] = dense
+            else:
+                out.append(block)
+            offset += block.shape[0]
+
+        if not write_scaled:
+            out.close()
+        if raw is not None:
+            raw.close()
+    adata.file.close()
+    return anndata.read_h5ad(save_path, backed="r")
+
+
+def _norm_factors(totals, dtype):
+    # counts per cell relative to target_sum, cells without counts are left unchanged
+    factors = (totals.astype(dtype) / 1e4).astype(dtype)
+    factors[factors == 0] = 1
+    return factors
+
+
+class _CSRWriter(object):
+    """Append CSR row blocks to a csr_matrix group of an h5ad file"""
+    def __init__(self, f, name, num_genes, dtype, profile="plain"):
+        self.group = f.create_group(name)
+        self.num_genes = num_genes
+        self.profile = profile
+        self.data = self.group.create_dataset("data", shape=(0,), maxshape=(None,), dtype=dtype,
+                                              **self._options(dtype))
+        self.indices = self.group.create_dataset("indices", shape=(0,), maxshape=(None,), dtype=np.int32,
+                                                 **self._options(np.int32))
+        self.indptr = [np.zeros(1, dtype=np.int64)]
+
+    def _options(self, dtype):
+        if PROFILES[self.profile] is None:
+            return {"chunks": (2**18,)}
+        # the final length is unknown, chunks of the profile for a long array
+        return dataset_options(self.profile, (2**40,), dtype)
+
+    def append(self, block):
+        nnz = self.data.shape[0]
+        self.data.resize((nnz + block.nnz,))
+        self.indices.resize((nnz + block.nnz,))
+        self.data[nnz:] = block.data
+        self.indices[nnz:] = block.indices
+        self.indptr.append(block.indptr[1:].astype(np.int64) + nnz)
+
+    def close(self):
+        indptr = np.concatenate(self.indptr)
+        self.group.create_dataset("indptr", data=indptr)
+        self.group.attrs["encoding-type"] = "csr_matrix"
+        self.group.attrs["encoding-version"] = "0.1.0"
+        self.group.attrs["shape"] = (len(indptr) - 1, self.num_genes)
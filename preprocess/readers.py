@@ -0,0 +1,241 @@
+import contextlib
+import csv
+import gzip
+import io
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+
+def _read_header(count_csv_path):
+    """Gene names and the offset of the first data row of a counts csv (cells x genes, cell names first)"""
+    with open(count_csv_path, "rb") as f:
+        header = f.readline()
+        data_start = f.tell()
+        first_row = f.readline()
+    header = next(csv.reader([header.decode()]))
+    num_fields = len(next(csv.reader([first_row.decode()]))) if first_row else len(header)
+    # R writes the header without the cell name column (write.table) or with an empty one (write.csv)
+    gene_names = header if len(header) == num_fields - 1 else header[1:]
+    return gene_names, data_start
+
+
+def _split_ranges(count_csv_path, data_start, num_parts):
+    """Byte ranges of the data rows, cut at line ends"""
+    size = os.path.getsize(count_csv_path)
+    bounds = [data_start]
+    with open(count_csv_path, "rb") as f:
+        for i in range(1, num_parts):
+            f.seek(max(data_start + (size - data_start) * i // num_parts - 1, bounds[-1]))
+            f.readline()
+            bounds.append(max(f.tell(), bounds[-1]))
+    bounds.append(size)
+    return [(lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+
+
+def _parse_range(count_csv_path, start, stop, num_genes, block_size, dtype):
+    """Parse the rows of [start, stop) block by block, each block is converted to CSR right away"""
+    names, blocks = [], []
+    with open(count_csv_path, "rb") as f:
+        f.seek(start)
+        while f.tell() < stop:
+            chunk = f.read(min(block_size, stop - f.tell()))
+            if f.tell() < stop:
+                # finish the last row of the block
+                chunk += f.readline()
+            if not chunk.strip():
+                continue
+            # a dtype per column is much slower to parse than letting pandas infer them
+            frame = pd.read_csv(io.BytesIO(chunk), header=None, index_col=0, dtype={0: str})
+            names.extend(frame.index)
+            # dtype None: the dtype pandas infers, as pd.read_csv of the whole file
+            blocks.append(sp.csr_matrix(frame.to_numpy(dtype=dtype)))
+            del frame
+    if len(blocks) == 0:
+        return names, sp.csr_matrix((0, num_genes), dtype=dtype or np.int64)
+    return names, sp.vstack(blocks, format="csr")
+
+
+def read_csv_to_csr(count_csv_path, n_jobs=None, block_size=64 * 2**20, dtype=None):
+    """
+    Read a dense counts csv (cells x genes) into a CSR matrix without materialising the dense frame.
+    The data rows are split into byte ranges parsed by n_jobs processes, each one block_size bytes
+    at a time, so memory stays at about n_jobs dense blocks plus the sparse result.
+    dtype: dtype of the values; None keeps the dtype pd.read_csv infers (int64 for integer counts,
+    float64 otherwise), np.float32 halves the memory of the result
+    Return: X (csr, [cells, genes]), cell names, gene names
+    """
+    n_jobs = os.cpu_count() if n_jobs is None else n_jobs
+    gene_names, data_start = _read_header(count_csv_path)
+    # a few ranges per process to balance the load, but blocks large enough to parse efficiently
+    num_parts = min(4 * n_jobs, -(-os.path.getsize(count_csv_path) // block_size))
+    ranges = _split_ranges(count_csv_path, data_start, max(num_parts, 1))
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [executor.submit(_parse_range, count_csv_path, lo, hi, len(gene_names), block_size, dtype)
+                   for lo, hi in ranges]
+        results = [future.result() for future in futures]
+
+    cell_names = [name for names, _ in results for name in names]
+    if len(results) == 0:
+        return sp.csr_matrix((0, len(gene_names)), dtype=dtype or np.int64), cell_names, gene_names
+    X = sp.vstack([block for _, block in results], format="csr")
+    return X, cell_names, gene_names
+
+
+def _open(path):
+    return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+
+
+def _read_mtx_header(f):
+    """Shape, number of entries and field of a Matrix Market file, f is left at the first entry"""
+    banner = f.readline().decode().split()
+    if len(banner) != 5 or banner[0] != "%%MatrixMarket" or banner[1].lower() != "matrix":
+        raise ValueError("Not a Matrix Market file")
+    layout, field, symmetry = [word.lower() for word in banner[2:]]
+    if layout != "coordinate" or symmetry != "general" or field not in ["integer", "real", "pattern"]:
+        raise ValueError("Only general coordinate matrices are supported, not {} {} {}".format(
+            layout, field, symmetry))
+    line = f.readline()
+    while line.startswith(b"%") or not line.strip():
+        line = f.readline()
+    num_rows, num_cols, num_entries = [int(value) for value in line.split()]
+    return (num_rows, num_cols), num_entries, field
+
+
+def _parse_mtx_block(chunk, field, dtype):
+    """1-based (row, col[, value]) lines to 0-based indices and values"""
+    # the C parser of pandas releases the GIL while tokenizing, the blocks are parsed in parallel threads;
+    # a single space separator (as written by cellranger) parses 1.5 times faster than any whitespace
+    single_space = not (b"  " in chunk or b"\t" in chunk or b"\n " in chunk or chunk.startswith(b" "))
+    frame = pd.read_csv(io.BytesIO(chunk), sep=" " if single_space else r"\s+", header=None,
+                        usecols=[0, 1] if field == "pattern" else [0, 1, 2],
+                        dtype={0: np.int32, 1: np.int32, 2: np.float64})
+    rows = frame[0].to_numpy() - 1
+    cols = frame[1].to_numpy() - 1
+    values = np.ones(len(frame), dtype=dtype) if field == "pattern" else frame[2].to_numpy().astype(dtype)
+    return rows, cols, values
+
+
+def _mmread_threads(n_jobs):
+    """Context setting the threads of scipy.io.mmread (all cores by default)"""
+    if n_jobs is None:
+        return contextlib.nullcontext()
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        warnings.warn("threadpoolctl is not installed, scipy.io.mmread ignores n_jobs and uses all cores")
+        return contextlib.nullcontext()
+    import scipy.io
+    # the C++ reader registers with threadpoolctl when it is loaded, by its first call
+    scipy.io.mmread(io.BytesIO(b"%%MatrixMarket matrix coordinate real general\n1 1 0\n"))
+    return threadpool_limits(limits={"scipy": n_jobs})
+
+
+def read_mtx(mtx_path, n_jobs=None, block_size=16 * 2**20, dtype=np.float32):
+    """
+    Read a Matrix Market file (plain or gzipped) into a COO matrix. With scipy >= 1.12, scipy.io.mmread
+    (a C++ reader) runs with n_jobs threads through threadpoolctl. With older scipy (whose mmread parses
+    in Python), the entries are read block_size bytes at a time and each block is parsed by one of
+    n_jobs threads while the next one is read (and decompressed).
+    Return: coo_matrix with the shape of the file
+    """
+    import scipy.io
+    if tuple(int(v) for v in scipy.__version__.split(".")[:2]) >= (1, 12):
+        with _mmread_threads(n_jobs):
+            X = scipy.io.mmread(mtx_path)
+        return sp.coo_matrix((X.data.astype(dtype, copy=False), (X.row, X.col)), shape=X.shape)
+
+    n_jobs = os.cpu_count() if n_jobs is None else n_jobs
+    with _open(mtx_path) as f, ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        shape, num_entries, field = _read_mtx_header(f)
+        futures, results = [], []
+        while True:
+            chunk = f.read(block_size)
+            if not chunk:
+                break
+            # finish the last line of the block
+            chunk += f.readline()
+            futures.append(executor.submit(_parse_mtx_block, chunk, field, dtype))
+            # a few blocks in flight, so memory stays at about 2 * n_jobs blocks plus the result
+            while len(futures) > 2 * n_jobs:
+                results.append(futures.pop(0).result())
+        results.extend(future.result() for future in futures)
+
+    if len(results) == 0:
+        results = [(np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=dtype))]
+    rows, cols, values = [np.concatenate(arrays) for arrays in zip(*results)]
+    if len(values) != num_entries:
+        raise ValueError("{} entries in {}, {} expected".format(len(values), mtx_path, num_entries))
+    return sp.coo_matrix((values, (rows, cols)), shape=shape)
+
+
+def _find(directory, names):
+    for name in names:
+        for path in [os.path.join(directory, name), os.path.join(directory, name + ".gz")]:
+            if os.path.exists(path):
+                return path
+    raise FileNotFoundError("None of {} (or .gz) in {}".format(", ".join(names), directory))
+
+
+def read_10x_mtx(directory, n_jobs=None, dtype=np.float32):
+    """
+    Read a 10X directory (matrix.mtx, barcodes.tsv and features.tsv or genes.tsv, gzipped or not).
+    Return: X (csr, [cells, genes]), cell barcodes, features (index gene symbols, columns gene_ids
+    and, since cellranger 3, feature_types)
+    """
+    X = read_mtx(_find(directory, ["matrix.mtx"]), n_jobs=n_jobs, dtype=dtype)
+    barcodes = pd.read_csv(_find(directory, ["barcodes.tsv"]), sep="\t", header=None, dtype=str)[0].tolist()
+    features = pd.read_csv(_find(directory, ["features.tsv", "genes.tsv"]), sep="\t", header=None, dtype=str)
+    columns = {0: "gene_ids", 2: "feature_types"}
+    features = features.set_index(1).rename(columns=columns)[[columns[i] for i in columns if i in features]]
+    features.index.name = None
+    # the file is genes x cells
+    return X.T.tocsr(), barcodes, features
+
+
+def read_10x_h5(h5_path, genome=None, dtype=np.float32):
+    """
+    Read a 10X feature-barcode matrix .h5 (cellranger 2 or 3 and later) straight into CSR:
+    the CSC genes x cells arrays of the file are the CSR cells x genes arrays.
+    Return: X (csr, [cells, genes]), cell barcodes, features (as read_10x_mtx)
+    """
+    import h5py
+
+    def strings(dataset):
+        return [value.decode() for value in dataset[:]]
+
+    keep = None
+    with h5py.File(h5_path, "r") as f:
+        if "matrix" in f:
+            group = f["matrix"]
+            features = pd.DataFrame({"gene_ids": strings(group["features/id"]),
+                                     "feature_types": strings(group["features/feature_type"])},
+                                    index=strings(group["features/name"]))
+            if genome is not None:
+                keep = np.array(strings(group["features/genome"])) == genome
+        else:
+            # cellranger 2: one group per genome
+            genomes = list(f.keys())
+            if genome is None and len(genomes) > 1:
+                raise ValueError("{} contains several genomes ({}), choose one".format(h5_path, ", ".join(genomes)))
+            group = f[genome or genomes[0]]
+            features = pd.DataFrame({"gene_ids": strings(group["genes"])}, index=strings(group["gene_names"]))
+        num_genes, num_cells = group["shape"][:]
+        X = sp.csr_matrix((group["data"][:].astype(dtype, copy=False), group["indices"][:], group["indptr"][:]),
+                          shape=(num_cells, num_genes))
+        barcodes = strings(group["barcodes"])
+    if keep is not None:
+        X, features = X[:, keep], features[keep]
+    return X, barcodes, features
+
+
+def read_10x(path, n_jobs=None, dtype=np.float32):
+    """read_10x_h5 for a .h5 file, read_10x_mtx for a directory"""
+    if os.path.isdir(path):
+        return read_10x_mtx(path, n_jobs=n_jobs, dtype=dtype)
+    return read_10x_h5(path, dtype=dtype)
@@ -0,0 +1,80 @@
+import h5py
+import numpy as np
+import scipy.sparse as sp
+
+# storage profiles of the preprocessed h5ad files
+#   plain: adata.write as is (the dtype of X, no chunking or compression)
+#   fast-read: float32, chunks of about chunk_bytes along the cells, no compression
+#   compact: float32, same chunks, gzip with the byte shuffle filter
+PROFILES = {
+    "plain": None,
+    "fast-read": {"dtype": np.float32, "chunk_bytes": 2**20, "compression": None, "compression_opts": None,
+                  "shuffle": False},
+    "compact": {"dtype": np.float32, "chunk_bytes": 2**20, "compression": "gzip", "compression_opts": 4,
+                "shuffle": True},
+}
+
+
+def dataset_options(profile, shape, dtype):
+    """h5py create_dataset options of a profile, chunks cut along the first axis (cells or nonzeros)"""
+    settings = PROFILES[profile]
+    if shape[0] == 0:
+        return {}
+    row_bytes = int(np.prod(shape[1:], dtype=np.int64)) * np.dtype(dtype).itemsize
+    rows = max(1, min(shape[0], settings["chunk_bytes"] // max(row_bytes, 1)))
+    # the last chunk is allocated in full: spread the rows evenly over the chunks so its padding stays small
+    num_chunks = -(-shape[0] // rows)
+    rows = -(-shape[0] // num_chunks)
+    options = {"chunks": (rows,) + tuple(shape[1:])}
+    if settings["compression"] is not None:
+        options.update(compression=settings["compression"], compression_opts=settings["compression_opts"],
+                       shuffle=settings["shuffle"])
+    return options
+
+
+def write_matrix(f, name, X, profile):
+    """Write X (dense or sparse) as an h5ad matrix element with the options of a profile"""
+    dtype = PROFILES[profile]["dtype"]
+    if sp.issparse(X):
+        X = sp.csr_matrix(X)
+        group = f.create_group(name)
+        group.attrs["encoding-type"] = "csr_matrix"
+        group.attrs["encoding-version"] = "0.1.0"
+        group.attrs["shape"] = X.shape
+        indices_dtype = np.int32 if X.shape[1] < 2**31 else np.int64
+        for key, values in [("data", X.data.astype(dtype, copy=False)),
+                            ("indices", X.indices.astype(indices_dtype, copy=False)), ("indptr", X.indptr)]:
+            group.create_dataset(key, data=values, **dataset_options(profile, values.shape, values.dtype))
+    else:
+        X = np.asarray(X, dtype=dtype)
+        dataset = f.create_dataset(name, data=X, **dataset_options(profile, X.shape, X.dtype))
+        dataset.attrs["encoding-type"] = "array"
+        dataset.attrs["encoding-version"] = "0.2.0"
+
+
+def write_h5ad(adata, save_path, profile="plain"):
+    """
+    adata.write with a storage profile (see PROFILES): obs/var/uns/obsm/varm/obsp/varp/layers are written by anndata,
+    X and raw.X are then written with the dtype, chunks and compression of the profile.
+    """
+    if PROFILES[profile] is None:
+        adata.write(save_path)
+        return
+    import anndata
+
+    # X and raw.X are replaced by empty placeholders, then rewritten; every other element is kept
+    placeholder = sp.csr_matrix(adata.shape, dtype=np.float32)
+    skeleton = anndata.AnnData(X=placeholder, obs=adata.obs, var=adata.var, uns=adata.uns,
+                               obsm=dict(adata.obsm), varm=dict(adata.varm), obsp=dict(adata.obsp),
+                               varp=dict(adata.varp), layers=dict(adata.layers))
+    if adata.raw is not None:
+        skeleton.raw = anndata.AnnData(X=sp.csr_matrix(adata.raw.shape, dtype=np.float32), var=adata.raw.var,
+                                       varm=adata.raw.varm)
+    skeleton.write(save_path)
+
+    with h5py.File(save_path, "a") as f:
+        del f["X"]
+        write_matrix(f, "X", adata.X, profile)
+        if adata.raw is not None:
+            del f["raw/X"]
+            write_matrix(f, "raw/X", adata.raw.X, profile)